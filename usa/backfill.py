@@ -0,0 +1,284 @@
+# backfill.py --------------------------------------------------------------------------------------------------------------------
+#   Historical backfill of DCF valuations for backtesting. Values every company as of every past statement date, using only the
+# statements that were available then: as of the k-th most recent statement, a company is valued with exactly the rows
+# value_company would have seen k periods ago (rows k, k+1, ... of its fundamentals).
+#
+#   The statements of a symbol are read once and its fundamentals are computed once over the whole history. The statement
+# driven figures (capitalized R&D, ROIC, reinvestment rate, interest coverage) of all the as-of dates are then computed together
+# on (as-of date x statement row) arrays, and all the dates are valued with one fade_value call. With base 'latest quarterly',
+# synthetic annual statements ending at each of the four most recent quarters are built from the same quarterly statements, so
+# the company gets a valuation for every quarter.
+#
+#   Market data as of a date: the share price is the last close (from <consolidated_prices_folder>/<symbol>.csv) on or before
+# the statement date plus REPORT_LAG_DAYS (statements are published some time after the period ends), and the number of shares
+# comes from the balance sheet. rfr and erp are the ones stored as of the valuation date in the local rate store (see
+# market_rates), the erp falling back to the reference data's where none is stored. Beta and tax come from the current reference
+# data
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from dcf_engine import fade_value, scenario_frame
+from cost_of_capital import cost_of_capital
+from reference_data import get_reference_data
+from market_rates import rates_as_of
+from dcf_valuation import (load_statements, synthetic_annual_statements, align_statements, annual_check, compute_fundamentals,
+                           MAX_GAP_DAYS)
+
+# Parameters
+consolidated_prices_folder = '/home/dinesh/Documents/security_prices/usa'
+REPORT_LAG_DAYS = 45 # Days between the end of a fiscal period and the date its statements can be assumed to be public
+
+
+# history_states -----------------------------------------------------------------------------------------------------------------
+#   Vectorized dcf_valuation.statement_state for every as-of row of a fundamentals history. Row k is computed from rows k, k+1, ...
+#   of the history only, with the same checks and in the same order as value_company
+#
+# Inputs:
+#   fundamentals: Fundamentals of one company, most recent first (see dcf_valuation.compute_fundamentals)
+#   tax: Tax rate (%)
+#   rir_method: 'last 5 years' or 'latest year only'
+#
+# Outputs:
+#   A pandas dataframe with one row per row of fundamentals and columns 'date', 'roic', 'rir', 'int_cov_ratio', 'bv_debt', 'cash',
+#   'post_tax_opinc', 'reinvestment' and 'reason for failure' (missing where the statement driven part of the valuation succeeds)
+# --------------------------------------------------------------------------------------------------------------------------------
+def history_states(fundamentals, tax, rir_method='last 5 years'):
+    if rir_method not in ['last 5 years', 'latest year only']:
+        raise ValueError('Invalid rir_method parameter. It should be either <last 5 years> or <latest year only>')
+
+    column = lambda name: fundamentals[name].to_numpy(dtype=np.float64)
+    opinc, RnD, intexp = column('opinc'), column('RnD'), column('intexp')
+    n = fundamentals.shape[0]
+    k = np.arange(n)
+    num_rows = n - k # Number of statement rows available as of row k
+
+    # (as-of row k) x (statement row i) layout. Statement row i is in the frame of k if i >= k, and is the (i-k)th row of it
+    i = np.arange(n)
+    in_frame = i[None, :] >= k[:, None]
+    row = i[None, :] - k[:, None]
+    iter_len = np.where(num_rows > 5, 5, num_rows - 1) # We don't want to consider anything older than 5 years
+    in_iter = in_frame & (row < iter_len[:, None])
+
+    # Capitalize R&D (with 5 year straight line depreciation) using the average R&D of the frame, see value_company
+    rnd_negative = np.logical_or.accumulate((RnD < 0)[::-1])[::-1]
+    average_RnD = np.cumsum(RnD[::-1])[::-1]/num_rows
+    opinc_c = opinc[None, :] + RnD[None, :] - 0.8*average_RnD[:, None]
+    netcapex_c = column('netcapex')[None, :] + RnD[None, :] - 0.8*average_RnD[:, None]
+    invested_capitals = (column('equity') + column('debt') - column('cash'))[None, :] + 3*average_RnD[:, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # ROIC of a year uses invested capital at the end of the year before
+        previous_capitals = np.full((n, n), np.nan)
+        previous_capitals[:, :-1] = invested_capitals[:, 1:]
+        roics = opinc_c*(1-tax/100)/previous_capitals
+        positive = in_iter & (roics > 0)
+        num_positive = positive.sum(axis=1)
+        roic = np.exp(np.where(positive, np.log(np.where(positive, roics, 1)), 0).sum(axis=1)/num_positive)
+
+        # Reinvestment rate. Years with negative reinvestment or operating loss are left out
+        reinvestments = netcapex_c + column('changeinwc')[None, :]
+        rir_used = in_iter & ~(reinvestments < 0) & ~(opinc_c < 0)
+        rirs = np.where(rir_used, reinvestments/(opinc_c*(1-tax/100)), 0)
+        num_rirs = rir_used.sum(axis=1)
+        if rir_method == 'last 5 years':
+            rir = np.where(num_rirs < 3, 0, rirs.sum(axis=1)/num_rirs)
+        else:
+            first = np.argmax(rir_used, axis=1)
+            rir = np.where(num_rirs > 0, rirs[k, first], np.nan)
+
+        # Interest coverage ratio. Years with operating loss are left out and zero interest expense gets a perfect rating
+        int_cov_used = in_iter & ~(opinc_c < 0)
+        int_cov_ratios = np.where(intexp[None, :] == 0, 9, opinc_c/intexp[None, :])
+        num_int_cov = int_cov_used.sum(axis=1)
+        int_cov_ratio = np.where(int_cov_used, int_cov_ratios, 0).sum(axis=1)/num_int_cov
+
+    reason = np.select([(rir_method == 'last 5 years') & (num_rows < 5),
+                        rnd_negative,
+                        np.any(in_frame & (invested_capitals < 0), axis=1),
+                        num_positive < 3,
+                        np.isnan(rir),
+                        rir > 1,
+                        np.any(int_cov_used & (intexp[None, :] < 0), axis=1),
+                        num_int_cov < 3],
+                       ['We do not have enough historic data to go about',
+                        'R&D expense cannot be negative',
+                        'Invested capital is negative sometimes. Something wrong with the data',
+                        'This company has too many negative ROICs',
+                        'No year usable for the reinvestment rate',
+                        'Reinvestment rate more than 100%',
+                        'Interest expense cannot be negative',
+                        'Bad interest coverage ratios'], default=None)
+
+    return(pd.DataFrame({'date': fundamentals['date'].to_numpy(), 'roic': roic, 'rir': rir, 'int_cov_ratio': int_cov_ratio,
+                         'bv_debt': column('debt'), 'cash': column('cash'), 'post_tax_opinc': opinc_c[k, k]*(1-tax/100),
+                         'reinvestment': reinvestments[k, k], 'reason for failure': reason}))
+
+
+# load_prices --------------------------------------------------------------------------------------------------------------------
+#   Reads the daily closing prices of a symbol. Returns a pandas series sorted by date, or None if there are no prices
+# --------------------------------------------------------------------------------------------------------------------------------
+def load_prices(symbol):
+    filename = consolidated_prices_folder + '/' + symbol + '.csv'
+    try:
+        stock_price = pd.read_csv(filename, index_col=0, parse_dates=True)
+    except Exception as e:
+        return(None)
+    if stock_price.empty or 'Close' not in stock_price.columns:
+        return(None)
+    return(stock_price['Close'].dropna().sort_index())
+
+
+# Last price on or before each date (NaN if there is none), found with a binary search over the sorted price dates
+def _prices_as_of(prices, dates):
+    if prices is None or prices.shape[0] == 0:
+        return(np.full(len(dates), np.nan))
+    positions = np.searchsorted(prices.index.to_numpy(), np.asarray(dates, dtype='datetime64[ns]'), side='right') - 1
+    return(np.where(positions >= 0, prices.to_numpy(dtype=np.float64)[np.maximum(positions, 0)], np.nan))
+
+
+# value_history ------------------------------------------------------------------------------------------------------------------
+#   Values one company as of every row of its fundamentals history
+#
+# Inputs:
+#   fundamentals: Fundamentals history of the company, most recent first
+#   shares: Array with the number of shares outstanding as of every row of fundamentals
+#   prices: Daily closing prices (see load_prices), or None
+#   unlevered_beta: Of the company's industry
+#   rfr: Optional risk free rate (%). By default the rfr stored as of each valuation date is used (see market_rates)
+#   refdata: Reference data snapshot (erp, tax, rating table). Defaults to the current one
+#   rir_method, ssbetas, gslopes, steady_state_roic: As in value_company
+#   report_lag_days: See REPORT_LAG_DAYS
+#   groups: Optional array with one label per row, for several histories stacked on top of each other (see
+#           dcf_valuation.compute_fundamentals). Each group is treated as a separate history
+#
+# Outputs:
+#   A pandas dataframe indexed by 'as_of' (the fiscal date of the statements) with 'valuation date', 'price', 'outstanding_shares',
+#   'mv_equity', 'roic', 'rir', 'int_cov_ratio', 'rfr', 'erp', 'wacc', 'Debt rating', one column per scenario (see dcf_engine.scenario_frame),
+#   'result' and 'reason for failure'
+# --------------------------------------------------------------------------------------------------------------------------------
+def value_history(fundamentals, shares, prices, unlevered_beta, rfr=None, refdata=None, rir_method='last 5 years',
+                  ssbetas=(0.8, 1, 1.2), gslopes=(3, 5, 7), steady_state_roic=0.1, report_lag_days=REPORT_LAG_DAYS, groups=None):
+    refdata = get_reference_data() if refdata is None else refdata
+    erp, tax = refdata['erp'], refdata['tax']
+
+    if groups is None:
+        states = history_states(fundamentals, tax, rir_method)
+    else:
+        boundaries = np.flatnonzero(np.asarray(groups)[1:] != np.asarray(groups)[:-1]) + 1
+        starts, ends = np.r_[0, boundaries], np.r_[boundaries, fundamentals.shape[0]]
+        states = pd.concat([history_states(fundamentals.iloc[start:end].reset_index(drop=True), tax, rir_method)
+                            for start, end in zip(starts, ends)], ignore_index=True)
+    as_of = pd.to_datetime(states['date'])
+    valuation_dates = as_of + pd.Timedelta(days=report_lag_days)
+    price = _prices_as_of(prices, valuation_dates)
+    rates = rates_as_of(valuation_dates)
+    erp = np.where(np.isnan(rates['erp']), erp, rates['erp'])
+    rfr = rates['rfr'] if rfr is None else np.full(as_of.shape[0], rfr, dtype=np.float64)
+    shares = np.where(np.asarray(shares, dtype=np.float64) > 0, shares, np.nan)
+    mv_equity = price*shares/1E6
+
+    coc = cost_of_capital(states['int_cov_ratio'].to_numpy(), states['bv_debt'].to_numpy(), mv_equity, unlevered_beta, rfr,
+                          erp, tax, refdata['rating_table'])
+
+    column = lambda values: np.asarray(values, dtype=np.float64)[:, None, None]
+    values = fade_value(column(states['post_tax_opinc']), column(states['reinvestment']), column(states['roic']),
+                        column(states['rir']), column(coc['wacc']), column(rfr), column(erp), column(states['cash']), column(states['bv_debt']),
+                        column(shares), ssbeta=np.asarray(ssbetas, dtype=np.float64)[None, :, None],
+                        gslope=np.asarray(gslopes, dtype=np.float64)[None, None, :], steady_state_roic=steady_state_roic)
+
+    fcff = (states['post_tax_opinc'] - states['reinvestment']).to_numpy()
+    reason = states['reason for failure'].to_numpy(dtype=object)
+    reason = np.where(pd.isna(reason) & np.isnan(price), 'No share price as of the valuation date', reason)
+    reason = np.where(pd.isna(reason) & np.isnan(rfr), 'No risk free rate as of the valuation date', reason)
+    reason = np.where(pd.isna(reason) & np.isnan(shares), 'Number of shares not available in balance sheet', reason)
+    reason = np.where(pd.isna(reason) & (states['roic']*states['rir'] < rfr/100).to_numpy() & (fcff < 0),
+                      'Negative FCFF for base year', reason)
+    failed = pd.notna(reason)
+    vps = np.where(failed[:, None, None], np.nan, values['vps'])
+
+    index = pd.Index(as_of.dt.date, name='as_of')
+    history_df = pd.DataFrame({'valuation date': valuation_dates.dt.date.to_numpy(), 'price': price,
+                               'outstanding_shares': shares, 'mv_equity': mv_equity, 'roic': states['roic'].to_numpy(),
+                               'rir': states['rir'].to_numpy(), 'int_cov_ratio': states['int_cov_ratio'].to_numpy(),
+                               'rfr': rfr, 'erp': erp, 'wacc': coc['wacc'], 'Debt rating': coc['rating']}, index=index)
+    history_df = history_df.join(scenario_frame(vps, index, ssbetas, gslopes))
+    history_df['result'] = np.where(failed, 'failure', 'success')
+    history_df['reason for failure'] = np.where(failed, reason, None)
+    return(history_df)
+
+
+# backfill -----------------------------------------------------------------------------------------------------------------------
+#   Builds a (symbol, as-of date) valuation table over the statement history of many companies. Statements and prices of every
+#   symbol are read exactly once
+#
+# Inputs:
+#   symbols: List of ticker symbols
+#   industries: List of industries (prof. Damodaran's names), one per symbol
+#   base: 'latest quarterly' (a valuation per quarter) or 'latest annual' (a valuation per year)
+#   debtmethod, changeinwcmethod: See dcf_valuation.get_fundamentals
+#   beta_to_use: 'global' or 'usa'
+#   rfr, rir_method, ssbetas, gslopes, steady_state_roic, report_lag_days: See value_history
+#   progress: Shows a progress bar if True
+#
+# Outputs:
+#   A dict with 'failures' (symbol -> reason, for symbols that couldn't be valued at any date) and 'valuations', a pandas dataframe
+#   indexed by (symbol, as_of) with the value_history columns plus 'Industry'
+# --------------------------------------------------------------------------------------------------------------------------------
+def backfill(symbols, industries, base='latest quarterly', debtmethod='method1', changeinwcmethod='usingcf', beta_to_use='global',
+             rfr=None, rir_method='last 5 years', ssbetas=(0.8, 1, 1.2), gslopes=(3, 5, 7), steady_state_roic=0.1,
+             report_lag_days=REPORT_LAG_DAYS, progress=False):
+    refdata = get_reference_data()
+    failures = {}
+    histories = []
+    for symbol, industry in tqdm(list(zip(symbols, industries)), desc='Progress', disable=not progress):
+        unlevered_beta = refdata['betas'][beta_to_use].get(industry)
+        if unlevered_beta is None:
+            failures[symbol] = 'Industry not found in beta table'
+            continue
+
+        sresponse = load_statements(symbol, base)
+        if sresponse['result'] == 'success':
+            sresponse = align_statements(sresponse['bsheet'], sresponse['incstmt'], sresponse['cashflow'], MAX_GAP_DAYS[base])
+        if sresponse['result'] == 'failure':
+            failures[symbol] = sresponse['reason for failure']
+            continue
+
+        # Statements as they looked as of each quarter: the ones from that quarter on. Each offset gives every fourth quarter.
+        # The synthetic annual statements of all the offsets are stacked, so fundamentals are computed in one pass per symbol
+        offsets = range(4) if base == 'latest quarterly' else range(1)
+        bsheets, incstmts, cashflows, groups = [], [], [], []
+        for offset in offsets:
+            bsheet, incstmt, cashflow = [sresponse[key].iloc[offset:].reset_index(drop=True)
+                                         for key in ['bsheet', 'incstmt', 'cashflow']]
+            if base == 'latest quarterly':
+                bsheet, incstmt, cashflow = synthetic_annual_statements(bsheet, incstmt, cashflow)
+            aresponse = annual_check({'result': 'success', 'bsheet': bsheet, 'incstmt': incstmt, 'cashflow': cashflow})
+            if aresponse['result'] == 'failure':
+                if offset == 0:
+                    failures[symbol] = aresponse['reason for failure']
+                continue
+            bsheets.append(aresponse['bsheet'])
+            incstmts.append(aresponse['incstmt'])
+            cashflows.append(aresponse['cashflow'])
+            groups.append(np.full(aresponse['bsheet'].shape[0], offset))
+        if len(groups) == 0:
+            continue
+
+        groups = np.concatenate(groups)
+        bsheet = pd.concat(bsheets, ignore_index=True)
+        fundamentals = compute_fundamentals(bsheet, pd.concat(incstmts, ignore_index=True), pd.concat(cashflows, ignore_index=True),
+                                            debtmethod, changeinwcmethod, groups=groups)
+        shares = pd.to_numeric(bsheet.get('commonStockSharesOutstanding', pd.Series(np.nan, index=bsheet.index)),
+                               errors='coerce').to_numpy(dtype=np.float64)
+        history_df = value_history(fundamentals, shares, load_prices(symbol), unlevered_beta, rfr, refdata, rir_method, ssbetas,
+                                   gslopes, steady_state_roic, report_lag_days, groups)
+        history_df.insert(0, 'Industry', industry)
+        history_df.insert(0, 'symbol', symbol)
+        histories.append(history_df.reset_index())
+
+    if len(histories) == 0:
+        return({'failures': failures, 'valuations': pd.DataFrame()})
+    valuations = pd.concat(histories, ignore_index=True).sort_values(['symbol', 'as_of'], ascending=[True, False])
+    return({'failures': failures, 'valuations': valuations.set_index(['symbol', 'as_of'])})
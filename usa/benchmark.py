@@ -0,0 +1,462 @@
+# benchmark.py -------------------------------------------------------------------------------------------------------------------
+#   Reproducible benchmark of get_fundamentals and value_company that needs no API keys and no downloaded data. Statements of N
+# synthetic symbols are generated in Alpha Vantage's column layout (annual and quarterly balance sheet, income statement and
+# cashflow statement csv files, most recent period first, missing items as empty cells) into a folder of their own, and the
+# OVERVIEW request and the reference data (beta table) are replaced by deterministic stand-ins for the duration of a run.
+#
+#   Every synthetic company is generated from its own seed, so a symbol always gets the same statements no matter how many
+# symbols are generated. A few percent of the companies are deliberately broken (loss making years, a missing quarter in one
+# statement, too short a history) so the failure paths are exercised too.
+#
+#   For each size (Ex. 10, 1000 and 10000 symbols) the benchmark reports per company latency (mean, median, p95), companies per
+# second and peak memory (tracemalloc, measured in a separate pass so that tracing doesn't slow down the timed pass). The
+# outputs of a run (fundamentals, values per share and failure reasons) can be saved as a golden reference and later runs
+# checked against it, so faster code paths can be verified to give the same numbers
+#
+# Usage: python benchmark.py --sizes 10 1000 10000 [--golden write|check]
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+import time
+import tracemalloc
+import argparse
+from contextlib import contextmanager
+from datetime import date
+
+import dcf_valuation
+import reference_data
+import market_rates
+import market_snapshot
+from dcf_valuation import get_fundamentals, get_fundamentals_batch, value_company
+
+# Parameters
+benchmark_folder = '/home/dinesh/Documents/Valuations/benchmark'
+SIZES = [10, 1000, 10000]
+SEED = 0
+INDUSTRY = 'Synthetic industry'
+UNLEVERED_BETA = 1.0
+RFR = 3.49 # Risk free rate of the synthetic rate store (%)
+BROKEN_SHARE = 0.05 # Share of companies whose statements are deliberately broken
+
+BS_COLUMNS = ['totalAssets', 'totalCurrentAssets', 'cashAndCashEquivalentsAtCarryingValue', 'cashAndShortTermInvestments',
+              'inventory', 'currentNetReceivables', 'totalNonCurrentAssets', 'propertyPlantEquipment',
+              'accumulatedDepreciationAmortizationPPE', 'intangibleAssets', 'intangibleAssetsExcludingGoodwill', 'goodwill',
+              'investments', 'longTermInvestments', 'shortTermInvestments', 'otherCurrentAssets', 'otherNonCurrentAssets',
+              'totalLiabilities', 'totalCurrentLiabilities', 'currentAccountsPayable', 'deferredRevenue', 'currentDebt',
+              'shortTermDebt', 'totalNonCurrentLiabilities', 'capitalLeaseObligations', 'longTermDebt', 'currentLongTermDebt',
+              'longTermDebtNoncurrent', 'shortLongTermDebtTotal', 'otherCurrentLiabilities', 'otherNonCurrentLiabilities',
+              'totalShareholderEquity', 'treasuryStock', 'retainedEarnings', 'commonStock', 'commonStockSharesOutstanding']
+IS_COLUMNS = ['grossProfit', 'totalRevenue', 'costOfRevenue', 'costofGoodsAndServicesSold', 'operatingIncome',
+              'sellingGeneralAndAdministrative', 'researchAndDevelopment', 'operatingExpenses', 'investmentIncomeNet',
+              'netInterestIncome', 'interestIncome', 'interestExpense', 'nonInterestIncome', 'otherNonOperatingIncome',
+              'depreciation', 'depreciationAndAmortization', 'incomeBeforeTax', 'incomeTaxExpense', 'interestAndDebtExpense',
+              'netIncomeFromContinuingOperations', 'comprehensiveIncomeNetOfTax', 'ebit', 'ebitda', 'netIncome']
+CF_COLUMNS = ['operatingCashflow', 'paymentsForOperatingActivities', 'proceedsFromOperatingActivities',
+              'changeInOperatingLiabilities', 'changeInOperatingAssets', 'depreciationDepletionAndAmortization',
+              'capitalExpenditures', 'changeInReceivables', 'changeInInventory', 'profitLoss', 'cashflowFromInvestment',
+              'cashflowFromFinancing', 'proceedsFromRepaymentsOfShortTermDebt', 'paymentsForRepurchaseOfCommonStock',
+              'paymentsForRepurchaseOfEquity', 'paymentsForRepurchaseOfPreferredStock', 'dividendPayout',
+              'dividendPayoutCommonStock', 'dividendPayoutPreferredStock', 'proceedsFromIssuanceOfCommonStock',
+              'proceedsFromIssuanceOfLongTermDebtAndCapitalSecuritiesNet', 'proceedsFromIssuanceOfPreferredStock',
+              'proceedsFromRepurchaseOfEquity', 'proceedsFromSaleOfTreasuryStock', 'changeInCashAndCashEquivalents',
+              'changeInExchangeRate', 'netIncome']
+
+
+def synthetic_symbols(n):
+    return(['SYN%05d' % i for i in range(n)])
+
+
+def _statements_folder(folder):
+    return((benchmark_folder if folder is None else folder) + '/statements')
+
+
+# synthetic_statements -----------------------------------------------------------------------------------------------------------
+#   Generates the quarterly statements of one synthetic company. Revenue follows a random walk around a growth trend with a
+#   seasonal component, and everything else is derived from revenue through company specific margins and ratios
+#
+# Outputs:
+#   Balance sheet, income statement and cashflow statement dataframes in Alpha Vantage's column layout, most recent quarter
+#   first, amounts in $
+# --------------------------------------------------------------------------------------------------------------------------------
+def synthetic_statements(symbol_index, seed=SEED):
+    rng = np.random.default_rng([seed, symbol_index])
+    num_quarters = int(rng.integers(21, 61))
+    dates = pd.date_range(end='2024-12-31', periods=num_quarters, freq='QE')[::-1].strftime('%Y-%m-%d')
+    oldest_first = lambda x: x[::-1]
+
+    # Income statement (flows per quarter)
+    growth = rng.normal(0.015, 0.01)
+    log_revenue = np.log(rng.lognormal(np.log(250e6), 1.5)) + np.cumsum(rng.normal(growth, 0.04, num_quarters))
+    revenue = oldest_first(np.exp(log_revenue)*(1 + 0.05*np.sin(np.arange(num_quarters)*np.pi/2)))
+    op_margin = np.clip(rng.normal(0.15, 0.08) + rng.normal(0, 0.02, num_quarters), -0.3, 0.6)
+    rnd = revenue*max(rng.normal(0.05, 0.05), 0)
+    cogs = revenue*np.clip(rng.normal(0.55, 0.1), 0.1, 0.9)
+    opinc = revenue*op_margin
+    sga = revenue - cogs - rnd - opinc
+    debt = revenue.mean()*4*max(rng.normal(0.4, 0.3), 0.01)
+    intexp = debt*rng.uniform(0.008, 0.02)*np.ones(num_quarters)
+    dna = revenue*rng.uniform(0.02, 0.08)
+    pretax = opinc - intexp
+    taxes = np.maximum(pretax, 0)*0.21
+    netinc = pretax - taxes
+
+    incstmt = pd.DataFrame(index=range(num_quarters), columns=IS_COLUMNS, dtype=np.float64)
+    incstmt['totalRevenue'] = revenue
+    incstmt['costOfRevenue'] = cogs
+    incstmt['costofGoodsAndServicesSold'] = cogs
+    incstmt['grossProfit'] = revenue - cogs
+    incstmt['researchAndDevelopment'] = rnd
+    incstmt['sellingGeneralAndAdministrative'] = sga
+    incstmt['operatingExpenses'] = sga + rnd
+    incstmt['operatingIncome'] = opinc
+    incstmt['interestExpense'] = intexp
+    incstmt['interestAndDebtExpense'] = intexp
+    incstmt['depreciation'] = dna*0.8
+    incstmt['depreciationAndAmortization'] = dna
+    incstmt['incomeBeforeTax'] = pretax
+    incstmt['incomeTaxExpense'] = taxes
+    incstmt['netIncomeFromContinuingOperations'] = netinc
+    incstmt['comprehensiveIncomeNetOfTax'] = netinc
+    incstmt['ebit'] = opinc
+    incstmt['ebitda'] = opinc + dna
+    incstmt['netIncome'] = netinc
+    if rng.random() < 0.1: # A few companies (Ex. banks) report non interest income
+        incstmt['nonInterestIncome'] = revenue*0.2
+
+    # Balance sheet (levels at quarter end)
+    annual_revenue = revenue*4
+    cash = annual_revenue*rng.uniform(0.05, 0.4)*rng.uniform(0.9, 1.1, num_quarters)
+    inventory = annual_revenue*rng.uniform(0, 0.15)*rng.uniform(0.95, 1.05, num_quarters)
+    receivables = annual_revenue*rng.uniform(0.05, 0.2)*rng.uniform(0.95, 1.05, num_quarters)
+    payables = annual_revenue*rng.uniform(0.03, 0.12)*rng.uniform(0.95, 1.05, num_quarters)
+    short_term_debt = debt*rng.uniform(0, 0.1)*np.ones(num_quarters)
+    current_lt_debt = short_term_debt if rng.random() < 0.5 else debt*rng.uniform(0, 0.05)*np.ones(num_quarters)
+    long_term_debt = debt - short_term_debt
+    leases = debt*rng.uniform(0, 0.1)*np.ones(num_quarters)
+    ppe = annual_revenue*rng.uniform(0.2, 1.5)
+    equity = np.maximum(annual_revenue*rng.uniform(0.3, 1.2) + np.cumsum(netinc[::-1])[::-1]*0.1, 1e6)
+    current_assets = cash + inventory + receivables
+    total_assets = current_assets + ppe + annual_revenue*0.1
+    shares = np.round(rng.lognormal(np.log(100e6), 1)*np.ones(num_quarters), -3)
+
+    bsheet = pd.DataFrame(index=range(num_quarters), columns=BS_COLUMNS, dtype=np.float64)
+    bsheet['totalAssets'] = total_assets
+    bsheet['totalCurrentAssets'] = current_assets
+    bsheet['cashAndCashEquivalentsAtCarryingValue'] = cash*0.8
+    bsheet['cashAndShortTermInvestments'] = cash
+    bsheet['shortTermInvestments'] = cash*0.2
+    bsheet['longTermInvestments'] = annual_revenue*rng.uniform(0, 0.05)
+    bsheet['investments'] = bsheet['longTermInvestments'] + cash*0.2
+    bsheet['inventory'] = inventory
+    bsheet['currentNetReceivables'] = receivables
+    bsheet['totalNonCurrentAssets'] = total_assets - current_assets
+    bsheet['propertyPlantEquipment'] = ppe
+    bsheet['goodwill'] = annual_revenue*0.05
+    bsheet['intangibleAssets'] = annual_revenue*0.08
+    bsheet['intangibleAssetsExcludingGoodwill'] = annual_revenue*0.03
+    bsheet['currentAccountsPayable'] = payables
+    bsheet['shortTermDebt'] = short_term_debt
+    bsheet['currentDebt'] = short_term_debt
+    bsheet['currentLongTermDebt'] = current_lt_debt
+    bsheet['longTermDebtNoncurrent'] = long_term_debt
+    bsheet['longTermDebt'] = long_term_debt + current_lt_debt
+    bsheet['shortLongTermDebtTotal'] = debt
+    bsheet['capitalLeaseObligations'] = leases
+    bsheet['totalCurrentLiabilities'] = payables + short_term_debt + current_lt_debt
+    bsheet['totalLiabilities'] = np.maximum(total_assets - equity, bsheet['totalCurrentLiabilities'] + long_term_debt)
+    bsheet['totalNonCurrentLiabilities'] = bsheet['totalLiabilities'] - bsheet['totalCurrentLiabilities']
+    bsheet['totalShareholderEquity'] = equity
+    bsheet['commonStockSharesOutstanding'] = shares
+
+    # Cashflow statement (flows per quarter)
+    change_in_inventory = inventory - np.append(inventory[1:], inventory[-1])
+    change_in_receivables = receivables - np.append(receivables[1:], receivables[-1])
+    capex = dna*rng.uniform(0.8, 2.5)*rng.uniform(0.8, 1.2, num_quarters)
+    cashflow = pd.DataFrame(index=range(num_quarters), columns=CF_COLUMNS, dtype=np.float64)
+    cashflow['depreciationDepletionAndAmortization'] = dna
+    cashflow['capitalExpenditures'] = capex
+    cashflow['changeInInventory'] = change_in_inventory
+    cashflow['changeInReceivables'] = change_in_receivables
+    cashflow['netIncome'] = netinc
+    cashflow['profitLoss'] = netinc
+    cashflow['operatingCashflow'] = netinc + dna - change_in_inventory - change_in_receivables
+    cashflow['cashflowFromInvestment'] = -capex
+    cashflow['dividendPayout'] = np.maximum(netinc, 0)*rng.uniform(0, 0.5)
+    cashflow['dividendPayoutCommonStock'] = cashflow['dividendPayout']
+    cashflow['cashflowFromFinancing'] = -cashflow['dividendPayout']
+    cashflow['changeInCashAndCashEquivalents'] = cashflow['operatingCashflow'] - capex - cashflow['dividendPayout']
+
+    # Deliberately broken statements
+    if rng.random() < BROKEN_SHARE:
+        breakage = rng.integers(3)
+        if breakage == 0:   # Losses in most years
+            incstmt['operatingIncome'] = -np.abs(incstmt['operatingIncome'])
+        elif breakage == 1: # One quarter missing in the cashflow statement, so dates don't match
+            cashflow = cashflow.drop(index=int(rng.integers(1, num_quarters - 1)))
+        else:               # Too short a history
+            keep = int(rng.integers(2, 5))
+            bsheet, incstmt, cashflow = bsheet.iloc[:keep], incstmt.iloc[:keep], cashflow.iloc[:keep]
+
+    statements = []
+    for statement in [bsheet, incstmt, cashflow]:
+        statement = statement.round(0)
+        statement.insert(0, 'fiscalDateEnding', dates[statement.index])
+        statement.insert(1, 'reportedCurrency', 'USD')
+        statements.append(statement.reset_index(drop=True))
+    return(tuple(statements))
+
+
+# Annual statements in the same layout: balance sheets of every fourth quarter, sums of four quarters for the flows
+def _annual(statement, flows):
+    statement = statement.iloc[:statement.shape[0]//4*4]
+    if not flows:
+        return(statement.iloc[::4].reset_index(drop=True))
+    annual = statement.drop(columns=['fiscalDateEnding', 'reportedCurrency']).groupby(np.arange(statement.shape[0])//4).sum(min_count=1)
+    annual.insert(0, 'fiscalDateEnding', statement['fiscalDateEnding'].iloc[::4].to_numpy())
+    annual.insert(1, 'reportedCurrency', 'USD')
+    return(annual)
+
+
+# generate_statements ------------------------------------------------------------------------------------------------------------
+#   Writes the annual and quarterly statements of n synthetic symbols into <folder>/statements, laid out like
+#   consolidated_prices_folder. Symbols whose files already exist are skipped, as their content depends only on symbol and seed
+#
+# Outputs:
+#   List of symbols
+# --------------------------------------------------------------------------------------------------------------------------------
+def generate_statements(n, folder=None, seed=SEED):
+    statements_folder = _statements_folder(folder)
+    subfolders = [('balance_sheets', 'BS', False), ('income_statements', 'IS', True), ('cashflow_statements', 'CF', True)]
+    for subfolder, suffix, flows in subfolders:
+        os.makedirs(statements_folder + '/' + subfolder, exist_ok=True)
+
+    symbols = synthetic_symbols(n)
+    for i, symbol in enumerate(symbols):
+        if os.path.exists(statements_folder + '/cashflow_statements/' + symbol + '_annual_CF.csv'):
+            continue
+        for statement, (subfolder, suffix, flows) in zip(synthetic_statements(i, seed), subfolders):
+            prefix = statements_folder + '/' + subfolder + '/' + symbol
+            statement.to_csv(prefix + '_quarterly_' + suffix + '.csv', index=False)
+            _annual(statement, flows).to_csv(prefix + '_annual_' + suffix + '.csv', index=False)
+    return(symbols)
+
+
+# synthetic_overview -------------------------------------------------------------------------------------------------------------
+#   Deterministic stand-in for Alpha Vantage's OVERVIEW response of a synthetic symbol (all values as strings, like Alpha Vantage)
+# --------------------------------------------------------------------------------------------------------------------------------
+def synthetic_overview(query_params, seed=SEED):
+    symbol = query_params['symbol']
+    rng = np.random.default_rng([seed, int(symbol[3:]), 1])
+    price = round(float(rng.lognormal(np.log(50), 0.8)), 2)
+    shares = int(np.round(rng.lognormal(np.log(100e6), 1), -3))
+    return({'Symbol': symbol, 'Name': symbol + ' Inc', 'MarketCapitalization': str(int(price*shares)),
+            'SharesOutstanding': str(shares), '50DayMovingAverage': str(price),
+            'AnalystTargetPrice': str(round(price*rng.uniform(0.8, 1.3), 2)), 'PERatio': str(round(rng.uniform(5, 40), 2))})
+
+
+# synthetic_environment ----------------------------------------------------------------------------------------------------------
+#   Context manager under which get_fundamentals reads the synthetic statements, value_company gets its OVERVIEW from
+#   synthetic_overview, the reference data has a beta for INDUSTRY and the rate store (RFR) and market snapshot (empty) are
+#   the benchmark's own. Everything is restored on exit
+# --------------------------------------------------------------------------------------------------------------------------------
+@contextmanager
+def synthetic_environment(folder=None):
+    saved = {'folder': dcf_valuation.consolidated_prices_folder, 'av_get': dcf_valuation.av_get,
+             'snapshots': dict(reference_data._snapshots), 'states': dict(dcf_valuation._statement_states),
+             'rates folder': market_rates.rates_folder, 'market folder': market_snapshot.snapshot_folder}
+    snapshot = {'version': date.today(), 'sources': {}, 'erp': reference_data.DEFAULT_ERP, 'tax': reference_data.DEFAULT_TAX,
+                'betas': {'global': {INDUSTRY: UNLEVERED_BETA}, 'usa': {INDUSTRY: UNLEVERED_BETA}},
+                'rating_table': pd.DataFrame(reference_data.DEFAULT_RATING_TABLE)}
+    try:
+        dcf_valuation.consolidated_prices_folder = _statements_folder(folder)
+        dcf_valuation.av_get = synthetic_overview
+        reference_data._snapshots.clear()
+        reference_data._snapshots[None] = snapshot
+        dcf_valuation._statement_states.clear()
+        market_rates.rates_folder = (benchmark_folder if folder is None else folder) + '/rates'
+        market_rates._rates.clear()
+        market_rates.store_rates(pd.DataFrame({'rfr': [RFR]}, index=pd.DatetimeIndex(['2000-01-01'])))
+        market_snapshot.snapshot_folder = (benchmark_folder if folder is None else folder) + '/market'
+        market_snapshot._cache.clear()
+        yield
+    finally:
+        dcf_valuation.consolidated_prices_folder = saved['folder']
+        dcf_valuation.av_get = saved['av_get']
+        reference_data._snapshots.clear()
+        reference_data._snapshots.update(saved['snapshots'])
+        dcf_valuation._statement_states.clear()
+        dcf_valuation._statement_states.update(saved['states'])
+        market_rates.rates_folder = saved['rates folder']
+        market_rates._rates.clear()
+        market_snapshot.snapshot_folder = saved['market folder']
+        market_snapshot._cache.clear()
+
+
+# Runs function on every symbol and returns the outputs and the latency (seconds) of every call
+def _timed(function, symbols):
+    outputs, latencies = {}, np.empty(len(symbols))
+    for i, symbol in enumerate(symbols):
+        start = time.perf_counter()
+        outputs[symbol] = function(symbol)
+        latencies[i] = time.perf_counter() - start
+    return(outputs, latencies)
+
+
+# Runs function once under tracemalloc and returns the peak memory (MB)
+def _peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return(tracemalloc.get_traced_memory()[1]/1E6)
+    finally:
+        tracemalloc.stop()
+
+
+def _row(benchmark, n, latencies, seconds, peak_mb):
+    return({'benchmark': benchmark, 'symbols': n, 'seconds': seconds, 'companies/s': n/seconds,
+            'mean ms': 1000*latencies.mean(), 'median ms': 1000*np.median(latencies),
+            'p95 ms': 1000*np.percentile(latencies, 95), 'peak MB': peak_mb})
+
+
+# run_benchmark ------------------------------------------------------------------------------------------------------------------
+#   Benchmarks get_fundamentals (one symbol at a time and as one batch) and value_company on n synthetic symbols
+#
+# Inputs:
+#   n: Number of symbols
+#   folder: Benchmark folder. Defaults to benchmark_folder
+#   memory: If True, every benchmark is run a second time under tracemalloc for peak memory
+#
+# Outputs:
+#   A dict with 'table' (one row per benchmark with latency, throughput and peak memory) and 'outputs' (see golden_outputs)
+# --------------------------------------------------------------------------------------------------------------------------------
+def run_benchmark(n, folder=None, memory=True):
+    symbols = generate_statements(n, folder)
+    rows = []
+    with synthetic_environment(folder):
+        start = time.perf_counter()
+        fresponses, latencies = _timed(get_fundamentals, symbols)
+        rows.append(_row('get_fundamentals', n, latencies, time.perf_counter() - start,
+                         _peak_memory(lambda: _timed(get_fundamentals, symbols)) if memory else np.nan))
+
+        start = time.perf_counter()
+        get_fundamentals_batch(symbols)
+        seconds = time.perf_counter() - start
+        rows.append(_row('get_fundamentals_batch', n, np.array([seconds/n]), seconds,
+                         _peak_memory(lambda: get_fundamentals_batch(symbols)) if memory else np.nan))
+
+        valued = [symbol for symbol in symbols if fresponses[symbol]['result'] == 'success']
+        value = lambda symbol: value_company(symbol, INDUSTRY, fresponses[symbol]['fundamentals'], report=None, verbose=False)
+        dcf_valuation._statement_states.clear() # Cold statement state memo, as in a crawl
+        start = time.perf_counter()
+        vresponses, latencies = _timed(value, valued)
+        rows.append(_row('value_company', len(valued), latencies, time.perf_counter() - start, np.nan))
+        if memory:
+            dcf_valuation._statement_states.clear()
+            rows[-1]['peak MB'] = _peak_memory(lambda: _timed(value, valued))
+
+    return({'table': pd.DataFrame(rows).set_index(['benchmark', 'symbols']),
+            'outputs': _outputs(symbols, fresponses, vresponses)})
+
+
+# The outputs that are compared against the golden reference
+def _outputs(symbols, fresponses, vresponses):
+    panel = pd.concat(dict([(symbol, fresponses[symbol]['fundamentals']) for symbol in symbols
+                            if fresponses[symbol]['result'] == 'success']))
+    rows = {}
+    for symbol in symbols:
+        response = vresponses.get(symbol, fresponses[symbol])
+        row = {'result': response['result'], 'reason for failure': response['reason for failure']}
+        if response.get('value_df') is not None:
+            row.update(dict(zip(['vps_' + str(i) for i in range(response['value_df'].size)], response['value_df'].to_numpy().ravel())))
+        rows[symbol] = row
+    return({'fundamentals': panel, 'valuations': pd.DataFrame.from_dict(rows, orient='index')})
+
+
+# golden_outputs -----------------------------------------------------------------------------------------------------------------
+#   Fundamentals and valuations of n synthetic symbols, computed with the current code
+#
+# Outputs:
+#   A dict with 'fundamentals' (panel indexed by (symbol, row)) and 'valuations' (dataframe indexed by symbol with 'result',
+#   'reason for failure' and the 9 values per share of the ssbeta x gslope grid as vps_0..vps_8)
+# --------------------------------------------------------------------------------------------------------------------------------
+def golden_outputs(n, folder=None):
+    symbols = generate_statements(n, folder)
+    with synthetic_environment(folder):
+        fresponses = dict([(symbol, get_fundamentals(symbol)) for symbol in symbols])
+        vresponses = dict([(symbol, value_company(symbol, INDUSTRY, fresponses[symbol]['fundamentals'], report=None,
+                                                  verbose=False))
+                           for symbol in symbols if fresponses[symbol]['result'] == 'success'])
+    return(_outputs(symbols, fresponses, vresponses))
+
+
+def _golden_filename(n, folder):
+    return((benchmark_folder if folder is None else folder) + '/golden_' + str(n) + '.pkl')
+
+
+def save_golden(n, folder=None, outputs=None):
+    outputs = golden_outputs(n, folder) if outputs is None else outputs
+    filename = _golden_filename(n, folder)
+    pd.to_pickle(outputs, filename)
+    return(filename)
+
+
+# check_golden -------------------------------------------------------------------------------------------------------------------
+#   Compares the outputs of the current code with the golden reference saved by save_golden
+#
+# Inputs:
+#   n, folder: As used for save_golden
+#   outputs: Optional outputs to check (Ex. from run_benchmark). Computed if not given
+#   rtol, atol: Tolerances of the numerical comparison
+#
+# Outputs:
+#   A dict with 'result' ('success' if everything matches) and 'mismatches' (list of descriptions)
+# --------------------------------------------------------------------------------------------------------------------------------
+def check_golden(n, folder=None, outputs=None, rtol=1e-9, atol=1e-9):
+    golden = pd.read_pickle(_golden_filename(n, folder))
+    outputs = golden_outputs(n, folder) if outputs is None else outputs
+    mismatches = []
+
+    for name in ['fundamentals', 'valuations']:
+        expected, actual = golden[name], outputs[name]
+        if not expected.index.equals(actual.index) or list(expected.columns) != list(actual.columns):
+            mismatches.append(name + ': rows or columns differ')
+            continue
+        for column in expected.columns:
+            if pd.api.types.is_float_dtype(expected[column]):
+                close = np.isclose(actual[column].to_numpy(dtype=np.float64), expected[column].to_numpy(dtype=np.float64),
+                                   rtol=rtol, atol=atol, equal_nan=True)
+            else:
+                close = (actual[column] == expected[column]) | (pd.isna(actual[column]) & pd.isna(expected[column]))
+                close = close.to_numpy()
+            if not close.all():
+                first = expected.index[~close][0]
+                mismatches.append(name + ': ' + column + ' differs for ' + str((~close).sum()) + ' rows, first ' + str(first) +
+                                  ' (expected ' + str(expected.loc[first, column]) + ', got ' + str(actual.loc[first, column]) + ')')
+
+    return({'result': 'success' if len(mismatches) == 0 else 'failure', 'mismatches': mismatches})
+
+
+if __name__ == '__main__':
+    msg = "Benchmarks get_fundamentals and value_company on synthetic statements"
+    parser = argparse.ArgumentParser(description=msg)
+    parser.add_argument('-s', '--sizes', help='Numbers of symbols', type=int, nargs='+', default=SIZES)
+    parser.add_argument('-f', '--folder', help='Benchmark folder. Defaults to ' + benchmark_folder)
+    parser.add_argument('-g', '--golden', help='Write or check the golden reference outputs', choices=['write', 'check'])
+    parser.add_argument('--no-memory', help='Skip the peak memory passes', action='store_true')
+    args = parser.parse_args()
+
+    tables = []
+    for n in args.sizes:
+        response = run_benchmark(n, args.folder, memory=not args.no_memory)
+        tables.append(response['table'])
+        if args.golden == 'write':
+            print('Golden reference written to', save_golden(n, args.folder, response['outputs']))
+        elif args.golden == 'check':
+            check = check_golden(n, args.folder, response['outputs'])
+            print('Golden reference check for', n, 'symbols:', check['result'])
+            for mismatch in check['mismatches']:
+                print('  ', mismatch)
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(pd.concat(tables))
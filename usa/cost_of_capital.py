@@ -0,0 +1,95 @@
+# cost_of_capital.py -------------------------------------------------------------------------------------------------------------
+#   Vectorized synthetic rating, cost of debt, levered beta, cost of equity and WACC. Takes arrays with one entry per company,
+# so the cost of capital of the whole universe can be refreshed in one pass after a rate move, without re-running valuations.
+#
+#   As in value_company, we use prof. Damodaran's synthetic bond rating (based on interest coverage ratio) to find cost of debt,
+# and use BV of debt in place of MV of debt. rfr, erp, tax, spreads and the results are percentages
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from reference_data import get_reference_data
+
+
+# synthetic_rating ---------------------------------------------------------------------------------------------------------------
+#   Looks up the synthetic rating of many interest coverage ratios at once with a binary search over the sorted breakpoints.
+#   A company gets the row of the largest breakpoint that is strictly less than its interest coverage ratio
+#
+# Inputs:
+#   int_cov_ratio: Array of interest coverage ratios
+#   rating_table: Optional. Dataframe with int_cov_ratio (sorted ascending), rating, spread. Defaults to the reference data
+#
+# Outputs:
+#   A dict of arrays: 'rating_index' (-1 where no rating could be found), 'rating' and 'spread' (NaN where not found)
+# --------------------------------------------------------------------------------------------------------------------------------
+def synthetic_rating(int_cov_ratio, rating_table=None):
+    if rating_table is None:
+        rating_table = get_reference_data()['rating_table']
+    int_cov_ratio = np.asarray(int_cov_ratio, dtype=np.float64)
+    breakpoints = rating_table['int_cov_ratio'].to_numpy(dtype=np.float64)
+
+    rating_index = np.searchsorted(breakpoints, int_cov_ratio, side='left') - 1   # Number of breakpoints below the ratio, minus 1
+    rating_index = np.where(np.isnan(int_cov_ratio), -1, rating_index)
+    found = rating_index >= 0
+
+    ratings = rating_table['rating'].to_numpy(dtype=object)
+    spreads = rating_table['spread'].to_numpy(dtype=np.float64)
+    return({'rating_index': rating_index,
+            'rating': np.where(found, ratings[np.maximum(rating_index, 0)], None),
+            'spread': np.where(found, spreads[np.maximum(rating_index, 0)], np.nan)})
+
+
+# cost_of_capital ----------------------------------------------------------------------------------------------------------------
+#   Computes cost of debt, levered beta, cost of equity and WACC. All the inputs are broadcast against each other
+#
+# Inputs:
+#   int_cov_ratio: Interest coverage ratios
+#   bv_debt, mv_equity: Book value of debt and market value of equity (same units)
+#   unlevered_beta: Unlevered betas (corrected for cash)
+#   rfr, erp, tax: Percentages
+#   rating_table: Optional, see synthetic_rating
+#
+# Outputs:
+#   A dict of arrays: 'rating', 'spread', 'cost_of_debt', 'levered_beta', 'cost_of_equity', 'wacc'
+# --------------------------------------------------------------------------------------------------------------------------------
+def cost_of_capital(int_cov_ratio, bv_debt, mv_equity, unlevered_beta, rfr, erp, tax, rating_table=None):
+    rating = synthetic_rating(int_cov_ratio, rating_table)
+    bv_debt, mv_equity, unlevered_beta, rfr, erp, tax = [np.asarray(x, dtype=np.float64) for x in
+                                                          (bv_debt, mv_equity, unlevered_beta, rfr, erp, tax)]
+
+    ## Find cost of debt
+    cost_of_debt = rfr + rating['spread']
+
+    ## Find cost of equity
+    levered_beta = unlevered_beta*(1 + (1-tax/100)*bv_debt/mv_equity)
+    cost_of_equity = rfr + levered_beta*erp
+
+    ## Find WACC
+    wacc = (mv_equity/(mv_equity + bv_debt))*cost_of_equity + (bv_debt/(mv_equity + bv_debt))*(1-tax/100)*cost_of_debt
+
+    return({'rating': rating['rating'], 'spread': rating['spread'], 'cost_of_debt': cost_of_debt, 'levered_beta': levered_beta,
+            'cost_of_equity': cost_of_equity, 'wacc': wacc})
+
+
+# refresh_universe ---------------------------------------------------------------------------------------------------------------
+#   Recomputes the cost of capital of every company of a universe for new rates
+#
+# Inputs:
+#   universe_df: Dataframe (one row per company) with columns int_cov_ratio, bv_debt, mv_equity and unlevered_beta
+#   rfr, erp, tax: Percentages. erp and tax default to the reference data
+#
+# Outputs:
+#   A copy of universe_df with columns rating, spread, cost_of_debt, levered_beta, cost_of_equity and wacc added
+# --------------------------------------------------------------------------------------------------------------------------------
+def refresh_universe(universe_df, rfr, erp=None, tax=None):
+    refdata = get_reference_data()
+    erp = refdata['erp'] if erp is None else erp
+    tax = refdata['tax'] if tax is None else tax
+
+    coc = cost_of_capital(universe_df['int_cov_ratio'].to_numpy(), universe_df['bv_debt'].to_numpy(),
+                          universe_df['mv_equity'].to_numpy(), universe_df['unlevered_beta'].to_numpy(), rfr, erp, tax,
+                          refdata['rating_table'])
+    refreshed_df = universe_df.copy()
+    for name, values in coc.items():
+        refreshed_df[name] = values
+    return(refreshed_df)
@@ -0,0 +1,152 @@
+# cyclicality.py -----------------------------------------------------------------------------------------------------------------
+#   Batch detection of cyclical companies. The DCF in value_company projects growth that fades linearly, which overvalues
+# companies whose earnings go up and down with the business cycle (see valuing_cyclic.py). This module scores how periodic the
+# revenue and operating income histories of every company are, so that cyclicals can be set aside for a normalized earnings
+# valuation instead of a full DCF.
+#
+#   Each history is made scale free (log if it is always positive, divided by its mean absolute value otherwise) and detrended
+# with a least squares line. A least squares spectral (Lomb-Scargle) periodogram is then computed over a grid of candidate
+# periods: for every company and period, a sinusoid is fitted to the detrended history, and the share of its variance that the
+# sinusoid explains is the cycle strength (0 to 1) at that period. Unlike an FFT, this handles histories of different lengths
+# (missing years are simply masked out), and it is done for the whole universe at once with a few (companies x years) by
+# (years x periods) matrix products. Only periods that fit at least MIN_CYCLES times into a history are considered. As short
+# noisy histories can fit a sinusoid quite well by chance, a company is considered cyclical only if the cycles of both its
+# revenue and operating income are strong enough to be unlikely to come from noise (see false_alarm)
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+# Parameters
+PERIODS = np.arange(2.5, 12.01, 0.25) # Candidate cycle periods (years)
+MIN_CYCLES = 1.5        # A period is considered only if the history covers at least this many cycles
+MIN_YEARS = 8           # Companies with shorter histories are not scored
+TREND_DEGREE = 1        # Degree of the polynomial trend removed before looking for cycles
+CYCLICAL_STRENGTH = 0.5 # Cycle strength from which a company is considered cyclical
+FALSE_ALARM = 0.05      # ... provided that noise would give such a strength in both series with less than this probability
+SERIES = ['revenue', 'opinc']
+
+
+# history_matrix -----------------------------------------------------------------------------------------------------------------
+#   Lays out one column of a fundamentals panel as a (symbols x years) array, oldest year first, NaN where a symbol has fewer years
+#
+# Inputs:
+#   panel: Fundamentals panel indexed by (symbol, fyear), most recent year first within a symbol (see
+#          dcf_valuation.get_fundamentals_batch)
+#   column: Column name
+#
+# Outputs:
+#   Tuple of the symbols (index) and the array
+# --------------------------------------------------------------------------------------------------------------------------------
+def history_matrix(panel, column):
+    symbols = panel.index.get_level_values(0)
+    row = panel.groupby(level=0, sort=False).cumcount().to_numpy() # 0 for the most recent year
+    index = pd.Index(symbols.unique())
+    years = row.max() + 1 if row.shape[0] > 0 else 0
+    matrix = np.full((index.shape[0], years), np.nan)
+    matrix[index.get_indexer(symbols), years - 1 - row] = panel[column].to_numpy(dtype=np.float64)
+    return(index, matrix)
+
+
+# Scale free, detrended version of every row of a (companies x years) array. Returns the residuals (0 where missing) and the mask
+def _detrend(matrix):
+    mask = np.isfinite(matrix)
+    positive = np.where(mask, matrix > 0, True).all(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.nanmean(np.abs(matrix), axis=1, keepdims=True)
+        values = np.where(positive, np.log(np.where(positive & mask, matrix, 1)), matrix/scale)
+    values = np.where(mask, values, 0)
+
+    weight = mask.astype(np.float64)
+    t = np.arange(matrix.shape[1], dtype=np.float64)
+    t = (t - t.mean())/max(t.std(), 1)
+    basis = np.vander(t, TREND_DEGREE + 1, increasing=True) # years x (degree+1)
+    normal = np.einsum('cy,yi,yj->cij', weight, basis, basis) + 1e-12*np.eye(TREND_DEGREE + 1)
+    coefficients = np.linalg.solve(normal, np.einsum('cy,yi->ci', weight*values, basis)[:, :, None])[:, :, 0]
+    residuals = np.where(mask, values - coefficients @ basis.T, 0)
+    return(np.nan_to_num(residuals), weight)
+
+
+# periodogram --------------------------------------------------------------------------------------------------------------------
+#   Least squares spectral periodogram of many histories at once
+#
+# Inputs:
+#   matrix: (companies x years) array, oldest year first, NaN where missing
+#   periods: Candidate periods (years)
+#
+# Outputs:
+#   (companies x periods) array of the share of the detrended variance explained by a sinusoid of each period, NaN where the
+#   period doesn't fit MIN_CYCLES times into the history
+# --------------------------------------------------------------------------------------------------------------------------------
+def periodogram(matrix, periods=PERIODS):
+    x, w = _detrend(matrix)
+    t = np.arange(matrix.shape[1], dtype=np.float64)
+    angle = 2*np.pi*t[None, :]/np.asarray(periods, dtype=np.float64)[:, None] # periods x years
+    cos, sin = np.cos(angle), np.sin(angle)
+
+    s_cc, s_ss, s_cs = w @ (cos*cos).T, w @ (sin*sin).T, w @ (cos*sin).T # companies x periods
+    s_xc, s_xs = (w*x) @ cos.T, (w*x) @ sin.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = s_cc*s_ss - s_cs**2
+        a = (s_xc*s_ss - s_xs*s_cs)/det
+        b = (s_xs*s_cc - s_xc*s_cs)/det
+        power = (a*s_xc + b*s_xs)/(w*x*x).sum(axis=1, keepdims=True)
+
+    span = w.sum(axis=1, keepdims=True)
+    fits = np.asarray(periods, dtype=np.float64)[None, :]*MIN_CYCLES <= span
+    return(np.where(fits & np.isfinite(power), np.clip(power, 0, 1), np.nan))
+
+
+# false_alarm --------------------------------------------------------------------------------------------------------------------
+#   Probability that a history of pure noise would show a cycle at least as strong as the given one at some candidate period.
+#   At one period, the share of the variance (left after removing the trend) that a sinusoid explains in n years of noise has a
+#   Beta(1, (n - trend terms - 2)/2) distribution, and the candidate periods give about as many independent chances as there are
+#   Fourier frequencies in their range
+# --------------------------------------------------------------------------------------------------------------------------------
+def false_alarm(strength, years, periods=PERIODS):
+    years = np.asarray(years, dtype=np.float64)
+    dof = np.maximum(years - TREND_DEGREE - 3, 1)
+    longest = np.minimum(np.max(periods), years/MIN_CYCLES)
+    chances = np.maximum(years*(1/np.min(periods) - 1/longest), 1)
+    with np.errstate(invalid='ignore'):
+        return(1 - (1 - (1 - np.asarray(strength))**(dof/2))**chances)
+
+
+# cyclicality --------------------------------------------------------------------------------------------------------------------
+#   Scores the cyclicality of every company of a fundamentals panel
+#
+# Inputs:
+#   panel: Fundamentals panel indexed by (symbol, fyear), see history_matrix. A single company's fundamentals (as returned by
+#          get_fundamentals) can be given too, with symbol
+#   periods: Candidate periods (years)
+#
+# Outputs:
+#   A pandas dataframe indexed by symbol with 'years', '<series> strength', '<series> period' and '<series> false alarm' for
+#   revenue and operating income, 'cycle strength' (mean of the two), 'cycle period' (of the stronger one), 'false alarm' (the
+#   larger of the two) and 'cyclical' (True if cycle strength >= CYCLICAL_STRENGTH and false alarm < FALSE_ALARM). Companies
+#   with fewer than MIN_YEARS years have NaN scores and are not cyclical
+# --------------------------------------------------------------------------------------------------------------------------------
+def cyclicality(panel, periods=PERIODS, symbol=None):
+    if symbol is not None:
+        panel = pd.concat({symbol: panel})
+    periods = np.asarray(periods, dtype=np.float64)
+
+    scores = {}
+    for series in SERIES:
+        index, matrix = history_matrix(panel, series)
+        power = periodogram(matrix, periods)
+        scored = np.isfinite(power).any(axis=1) & (np.isfinite(matrix).sum(axis=1) >= MIN_YEARS)
+        best = np.argmax(np.nan_to_num(power, nan=-1), axis=1)
+        scores[series + ' strength'] = np.where(scored, power[np.arange(power.shape[0]), best], np.nan)
+        scores[series + ' period'] = np.where(scored, periods[best], np.nan)
+        scores[series + ' false alarm'] = false_alarm(scores[series + ' strength'], np.isfinite(matrix).sum(axis=1), periods)
+        scores['years'] = np.isfinite(matrix).sum(axis=1)
+
+    cycle_df = pd.DataFrame(scores, index=index)
+    cycle_df = cycle_df[['years'] + [series + ' ' + name for series in SERIES for name in ['strength', 'period', 'false alarm']]]
+    cycle_df['cycle strength'] = cycle_df[[series + ' strength' for series in SERIES]].mean(axis=1, skipna=False)
+    stronger = cycle_df['opinc strength'] >= cycle_df['revenue strength']
+    cycle_df['cycle period'] = np.where(stronger, cycle_df['opinc period'], cycle_df['revenue period'])
+    cycle_df['false alarm'] = cycle_df[[series + ' false alarm' for series in SERIES]].max(axis=1, skipna=False)
+    cycle_df['cyclical'] = ((cycle_df['cycle strength'] >= CYCLICAL_STRENGTH) & (cycle_df['false alarm'] < FALSE_ALARM)).to_numpy()
+    cycle_df.index.name = 'symbol'
+    return(cycle_df)
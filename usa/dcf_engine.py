@@ -0,0 +1,184 @@
+# dcf_engine.py ------------------------------------------------------------------------------------------------------------------
+#   Array implementation of the growth ramp down (fade) model used by dcf_valuation.value_company. Every input can be a scalar
+# or a numpy array, and all of them are broadcast against each other. So the same code values one scenario, a 50x50 sensitivity
+# surface of one company or one scenario for thousands of companies, in a single pass without python loops over years.
+#
+# Units follow value_company: rfr, erp and wacc are percentages, roic, rir and steady state roic are fractions and cashflows are
+# in Millions of $
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+
+# fade_value ---------------------------------------------------------------------------------------------------------------------
+#   Values the operating assets of a company by ramping ROIC and reinvestment rate down (or up) linearly from their current
+#   values to steady state values over num_extord_years, and then applying a terminal value. This reproduces the three cases of
+#   value_company:
+#     0. Growth (roic*rir) already slower than rfr: Valued as a going concern growing at roic*rir, discounted at wacc
+#     1. ROIC less than steady state ROIC: Valued as a perpetuity growing at roic*rir, discounted at rfr
+#     2. Otherwise: Fade model with num_extord_years = int((growth - rfr)/gslope) + extord_intercept
+#
+# Inputs:
+#   post_tax_opinc: Post tax operating income of the base year
+#   reinvestment: Reinvestment (netcapex + changeinwc) of the base year
+#   roic, rir: Current return on invested capital and reinvestment rate (fractions)
+#   wacc, rfr, erp: Percentages
+#   cash, debt: Of the base year, used to go from operating asset value to equity value
+#   outstanding_shares: Number of shares (not Millions)
+#   ssbeta: Steady state beta, used for the terminal value
+#   gslope: Percentage points by which growth drops every year during the extraordinary growth period
+#   steady_state_roic: ROIC at the end of the fade period (fraction)
+#   extord_intercept: y-intercept of the num_extord_years line. NOTE: The value of 3 is chosen arbitrarily for now
+#   wacc_term: Optional maturity matched WACC (%), an array broadcastable to broadcast shape + (M,) whose last axis is the
+#              maturity in years 0..M-1 (see yield_curve.term_wacc). If given, the cashflow of year t is discounted at the WACC of
+#              maturity t instead of the flat wacc (years beyond M-1 use maturity M-1). Going concern and perpetuity valuations
+#              (cases 0 and 1) always use the flat rates
+#   return_paths: If True, year by year figures are returned as well (last axis is the year)
+#
+# Outputs:
+#   A dict with 'vps', 'op_asset_value', 'case' and 'num_extord_years' arrays of the broadcast shape. If return_paths is True,
+#   'paths' holds arrays of shape broadcast shape + (T+1,) for 'post_tax_opinc', 'roic', 'rir', 'growth', 'fcff' and 'pv'
+#   (roic, rir and growth in percentage like pv_df in value_company), and 'num_rows' tells how many of the T+1 rows are valid
+# --------------------------------------------------------------------------------------------------------------------------------
+def fade_value(post_tax_opinc, reinvestment, roic, rir, wacc, rfr, erp, cash, debt, outstanding_shares,
+               ssbeta=1, gslope=5, steady_state_roic=0.1, extord_intercept=3, wacc_term=None, return_paths=False):
+    (post_tax_opinc, reinvestment, roic, rir, wacc, rfr, erp, cash, debt, outstanding_shares, ssbeta, gslope,
+     steady_state_roic, extord_intercept) = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in
+        (post_tax_opinc, reinvestment, roic, rir, wacc, rfr, erp, cash, debt, outstanding_shares, ssbeta, gslope,
+         steady_state_roic, extord_intercept)])
+
+    growth = roic*rir
+    fcff = post_tax_opinc - reinvestment
+    steady_state_rir = (rfr/100)/steady_state_roic
+
+    case = np.where(growth < rfr/100, 0, np.where(roic < steady_state_roic, 1, 2))
+    fading = case == 2
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        num_extord_years = np.where(fading, np.trunc((growth*100 - rfr)/gslope) + extord_intercept, 0).astype(np.int64)
+        num_extord_years = np.maximum(num_extord_years, 0)
+        T = int(num_extord_years[fading].max()) + 1 if fading.any() else 0
+
+        # Year 0 is the base year, years 1..N are the extraordinary growth years and year N+1 gives the terminal value
+        years = np.arange(0, T+1)
+        N = num_extord_years[..., None]
+        frac = years/(N+1)
+        iroic = roic[..., None] + (steady_state_roic - roic)[..., None]*frac  # Linear interpolation from current to steady state
+        irir = rir[..., None] + (steady_state_rir - rir)[..., None]*frac
+        igrowth = iroic*irir
+
+        # Operating income of year i grows at the growth rate of year i-1
+        growth_factors = np.ones(iroic.shape)
+        growth_factors[..., 1:] = 1 + igrowth[..., :-1]
+        opinc_path = post_tax_opinc[..., None]*np.cumprod(growth_factors, axis=-1)
+        fcff_path = opinc_path*(1 - irir)
+        fcff_path[..., 0] = fcff
+
+        if wacc_term is None:
+            discount = lambda maturities: (1 + wacc[..., None]/100)**maturities
+        else:
+            wacc_term = np.asarray(wacc_term, dtype=np.float64)
+            discount = lambda maturities: (1 + wacc_term[..., np.clip(maturities, 0, wacc_term.shape[-1]-1)]/100)**maturities
+        pv_path = fcff_path/discount(years)
+        terminal = years == (N+1)
+        pv_path = np.where(terminal, (fcff_path/(ssbeta*erp/100)[..., None])/discount(years-1), pv_path)
+        valid = (years >= 1) & (years <= N+1) & fading[..., None]
+        pv_path = np.where(valid, pv_path, np.nan)
+
+        op_asset_value = np.where(case == 0, fcff*(1+growth)/(wacc/100 - growth),
+                         np.where(case == 1, fcff*(1+growth)/(rfr/100 - growth),
+                                  np.nansum(pv_path, axis=-1)))
+
+        vps = ((op_asset_value + cash - debt)*1E6)/outstanding_shares
+
+    result = {'vps': vps, 'op_asset_value': op_asset_value, 'case': case, 'num_extord_years': num_extord_years}
+    if return_paths:
+        result['paths'] = {'post_tax_opinc': opinc_path, 'roic': iroic*100, 'rir': irir*100, 'growth': iroic*irir*100,
+                           'fcff': fcff_path, 'pv': pv_path}
+        result['num_rows'] = np.where(fading, num_extord_years + 2, 1)
+    return(result)
+
+
+# value_grid ---------------------------------------------------------------------------------------------------------------------
+#   Evaluates fade_value over every combination of ssbeta, gslope and steady state ROIC values
+#
+# Inputs:
+#   inputs: dict with 'post_tax_opinc', 'reinvestment', 'roic', 'rir', 'wacc', 'rfr', 'erp', 'cash', 'debt' and
+#           'outstanding_shares' of one company (keys as in fade_value), and optionally 'wacc_term'
+#   ssbetas, gslopes, steady_state_roics: 1-D sequences of values to combine
+#   return_paths: Passed on to fade_value
+#
+# Outputs:
+#   fade_value's result dict, where 'vps' (and every other array) has the shape (len(ssbetas), len(gslopes),
+#   len(steady_state_roics)), i.e. a dense value per share surface
+# --------------------------------------------------------------------------------------------------------------------------------
+def value_grid(inputs, ssbetas=(0.8, 1, 1.2), gslopes=(3, 5, 7), steady_state_roics=(0.1,), return_paths=False):
+    ssbeta, gslope, steady_state_roic = np.meshgrid(np.asarray(ssbetas, dtype=np.float64),
+                                                    np.asarray(gslopes, dtype=np.float64),
+                                                    np.asarray(steady_state_roics, dtype=np.float64), indexing='ij')
+    return(fade_value(inputs['post_tax_opinc'], inputs['reinvestment'], inputs['roic'], inputs['rir'], inputs['wacc'],
+                      inputs['rfr'], inputs['erp'], inputs['cash'], inputs['debt'], inputs['outstanding_shares'],
+                      ssbeta=ssbeta, gslope=gslope, steady_state_roic=steady_state_roic, wacc_term=inputs.get('wacc_term'),
+                      return_paths=return_paths))
+
+
+# path_frame ---------------------------------------------------------------------------------------------------------------------
+#   Converts the year by year figures of one scenario of a fade_value result into a dataframe laid out like pv_df
+#
+# Inputs:
+#   result: fade_value (or value_grid) result computed with return_paths=True
+#   index: Tuple that selects the scenario (Ex. (0, 2, 0) for the first ssbeta, third gslope, first steady state roic)
+#   base_year: Fiscal year of the base year
+#
+# Outputs:
+#   A pandas dataframe with columns year, post_tax_opinc, roic, rir, growth, fcff, pv
+# --------------------------------------------------------------------------------------------------------------------------------
+def path_frame(result, index, base_year):
+    num_rows = int(result['num_rows'][index])
+    paths = result['paths']
+    pv_df = pd.DataFrame({'year': base_year + np.arange(num_rows)})
+    for name in ['post_tax_opinc', 'roic', 'rir', 'growth', 'fcff', 'pv']:
+        pv_df[name] = paths[name][index][:num_rows]
+    return(pv_df)
+
+
+# Scalar inputs of a value_company result that fade_value (and cost_of_capital) need
+ENGINE_INPUTS = ['post_tax_opinc', 'reinvestment', 'roic', 'rir', 'wacc', 'rfr', 'erp', 'tax', 'cash', 'bv_debt', 
+                 'outstanding_shares', 'price', 'mv_equity', 'int_cov_ratio', 'unlevered_beta', 'steady_state_roic']
+
+
+# inputs_table -------------------------------------------------------------------------------------------------------------------
+#   Collects the scalar DCF inputs of many successful value_company results into one frame, so that many companies can be 
+#   evaluated with one fade_value call
+#
+# Inputs:
+#   results: Iterable of value_company results. Failed ones are skipped
+#
+# Outputs:
+#   A pandas dataframe indexed by symbol with the ENGINE_INPUTS columns
+# --------------------------------------------------------------------------------------------------------------------------------
+def inputs_table(results):
+    rows = dict([(result['Symbol'], [result['inputs'][name] for name in ENGINE_INPUTS]) 
+                 for result in results if result['result'] == 'success'])
+    return(pd.DataFrame.from_dict(rows, orient='index', columns=ENGINE_INPUTS, dtype=np.float64))
+
+
+# scenario_frame -----------------------------------------------------------------------------------------------------------------
+#   Lays out values per share of many companies (or dates) under every ssbeta x gslope scenario as one row each
+#
+# Inputs:
+#   vps: Array of shape (rows, len(ssbetas), len(gslopes))
+#   index: Row labels
+#   ssbetas, gslopes: Scenario values
+#
+# Outputs:
+#   A pandas dataframe with one column per scenario (Ex. 'ssBeta=1|gslope=5', as in valuation_report.valuations_table) and 
+#   'Min VPS', 'Avg VPS' and 'Max VPS'
+# --------------------------------------------------------------------------------------------------------------------------------
+def scenario_frame(vps, index, ssbetas, gslopes):
+    columns = ['ssBeta=' + str(ssbeta) + '|gslope=' + str(gslope) for ssbeta in ssbetas for gslope in gslopes]
+    vps_df = pd.DataFrame(np.asarray(vps).reshape(len(index), -1), index=index, columns=columns)
+    vps_df['Min VPS'] = vps_df[columns].min(axis=1)
+    vps_df['Avg VPS'] = vps_df[columns].mean(axis=1)
+    vps_df['Max VPS'] = vps_df[columns].max(axis=1)
+    return(vps_df)
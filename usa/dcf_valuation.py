@@ -22,8 +22,9 @@
 # WARNING: Some explicit assumptions have been made about AlphaVantage data such as:
 # 1. The data fields are uniform across stocks. This is known to be not true! So for some stocks
 #    an error will be thrown while accessing some items
-# 2. It is assumed that, in all statements, the most recent data appears at the top, followed, 
-#    by older data sequentially. TODO: Add a sanity check for this and get rid of this assumption
+# 2. Statements are aligned on their fiscalDateEnding (see align_statements), so they may come in
+#    any order and one of them may have periods the others don't. Periods missing from any of
+#    them end the usable history at the first gap
 # ------------------------------------------------------------------------------------------------
 
 import requests
@@ -32,247 +33,513 @@ import numpy as np
 import pandas as pd
 from scipy import stats
 
+import io
 import os
 import sys
-import subprocess
 import errno
 import time
+import hashlib
 from datetime import datetime
 from datetime import date
 from tqdm import tqdm, trange
 import argparse
 import quandl
-from openpyxl import load_workbook
+from dcf_engine import value_grid
+from download_statements import fetch_all, av_get
+from reference_data import get_reference_data
+from cost_of_capital import cost_of_capital
+from yield_curve import get_curve, term_wacc
+from market_rates import get_rates
+from market_snapshot import market_data, cached_overview, store_overview
+from valuation_report import write_valuation_report, print_summary
+from profiling import stage, profiled, count, count_file
 
+# Parameters
+consolidated_prices_folder = '/home/dinesh/Documents/security_prices/usa'
+MAX_GAP_DAYS = {'latest quarterly': 120, 'latest annual': 400} # Longer gaps between consecutive statements end the history
+
+_statement_states = {} # In-process memo. symbol -> ((fingerprint, tax, rir_method), statement_state), see get_statement_state
 
 # get_statements -----------------------------------------------------------------------------------------------------------------
-#   Downloads most updated financial statements from Alpha Vantage
+#   Downloads most updated financial statements from Alpha Vantage. Returns a dict (symbol, statement) -> fetch_statement response
 # --------------------------------------------------------------------------------------------------------------------------------
+@profiled()
 def get_statements(symbol):
-    AV_URL = "https://www.alphavantage.co/query"
-    AV_KEY = os.environ.get('ALPHAVANTAGE_API_KEY')
-
     # NOTE: Alpha vantage always seems to give consolidated statements and not standalone. Net income figure seems to be net income attributable -
     # to controlling interest, which is the right thing to do
     statements = ['balance_sheet', 'income_statement', 'cashflow']
 
-    for statement in statements:
-        subp_resp = subprocess.run(['python3', 'download_statements.py', '-t', symbol, statement], capture_output=True)
-        if 'Note' in str(subp_resp.stdout): # Alpha Vantage limit (5 req per min) reached. download_statements already waits of 60s.- 
-                                              # So just try one more time
-            print('AV limit reached. Trying one more time')
-            subp_resp = subprocess.run(['python3', 'download_statements.py', '-t', symbol, statement], capture_output=True)
-        
+    # If Alpha Vantage limit (5 req per min) is reached, fetch_statement waits and tries one more time
+    return(fetch_all([symbol], statements))
 
 
-# get_fundamentals ---------------------------------------------------------------------------------------------------------------
-#   Gets financial statements and if the 'base' parameter is 'laterst_quarterly' creates synthetic annual statements from 10Q
-#   financials and then calculates fundamentals using them. If the 'base' parameter is 'latest_annual', uses 10K financials to 
-#   calculate fundamentals  
+
+# load_statements ----------------------------------------------------------------------------------------------------------------
+#   Reads the locally stored balance sheet, income statement and cashflow statement of a symbol as they are, quarterly ones if the
+#   'base' parameter is 'latest quarterly' and annual ones if it is 'latest annual'
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure' and the three statements as 'bsheet', 'incstmt' and 'cashflow' dataframes 
 # --------------------------------------------------------------------------------------------------------------------------------
-def get_fundamentals(symbol, base='latest quarterly', debtmethod='method1', changeinwcmethod='usingcf'):
-    consolidated_prices_folder = '/home/dinesh/Documents/security_prices/usa'
-    response = dict.fromkeys({'result', 'reason for failure', 'fundamentals'}) 
-    response['result'] = 'failure' # Init this to failure so that if error occurs during execution, we can simply -
+@profiled()
+def load_statements(symbol, base='latest quarterly'):
+    response = dict.fromkeys({'result', 'reason for failure', 'bsheet', 'incstmt', 'cashflow'}) 
+    response['result'] = 'failure' # Init this to failure so that if error occurs during execution, we can simply return response
 
     if base == 'latest quarterly':
-        # Process balance sheet
-        filename = consolidated_prices_folder + '/balance_sheets/' + symbol + '_quarterly_BS.csv'
-        try:
-            bsheetq = pd.read_csv(filename, parse_dates=['fiscalDateEnding']).fillna(0)
-        except Exception as e:
-            response['reason for failure'] = "Unexpected error while trying to open" + filename 
-            return(response)  # Return an empty dataframe 
-                     
-        bsheet = (bsheetq.iloc[:bsheetq.shape[0]//4*4+1,:]).iloc[::4, :]    # We need only every fourth quarterly as we are trying to get
-                                                                            # synthetic annual balance sheets. However, if the number of 
-                                                                            # quarterly statements is not a multiple of 4, we should discard 
-                                                                            # some rows so that, later, when we creatw synthtic income and 
-                                                                            # cashflow statements, it would make no sense to add less than 
-                                                                            # 4 quarterlies to create synthetic annual income and cashflow 
-                                                                            # statements 
-        bsheet.reset_index(drop=True, inplace=True) 
- 
-        # Process income statements
-        filename = consolidated_prices_folder + '/income_statements/' + symbol + '_quarterly_IS.csv'
-        try:
-            incstmtq = pd.read_csv(filename, parse_dates=['fiscalDateEnding']).fillna(0)
-        except Exception as e:
-            response['reason for failure'] = "Unexpected error while trying to open" + filename 
-            return(response)  # Return an empty dataframe 
-    
-        temp_df = incstmtq.iloc[:incstmtq.shape[0]//4*4+1,:]
-        incstmt = temp_df.groupby(temp_df.index // 4).sum(numeric_only=True)
-        temp_df = (incstmtq.iloc[:incstmtq.shape[0]//4*4+1,:]).iloc[0::4, :]
-        temp_df.reset_index(drop=True, inplace=True)
-        incstmt['fiscalDateEnding'] = temp_df['fiscalDateEnding']
-        incstmt['reportedCurrency'] = temp_df['reportedCurrency']
-        
-        # Process cashflow statement
-        filename = consolidated_prices_folder + '/cashflow_statements/' + symbol + '_quarterly_CF.csv'
-        try:
-            cashflowq = pd.read_csv(filename, parse_dates=['fiscalDateEnding']).fillna(0)
-        except Exception as e:
-            response['reason for failure'] = "Unexpected error while trying to open" + filename 
-            return(response)  # Return an empty dataframe
-        
-        temp_df = cashflowq.iloc[:cashflowq.shape[0]//4*4+1,:]
-        cashflow = temp_df.groupby(temp_df.index // 4).sum(numeric_only=True)
-        temp_df = (cashflowq.iloc[:cashflowq.shape[0]//4*4+1,:]).iloc[0::4, :]
-        temp_df.reset_index(drop=True, inplace=True)
-        cashflow['fiscalDateEnding'] = temp_df['fiscalDateEnding']
-        cashflow['reportedCurrency'] = temp_df['reportedCurrency']
-    
+        period = 'quarterly'
     elif(base == 'latest annual'):
-        # Bring in annual statments so we can extract historical data
-        filename = consolidated_prices_folder + '/balance_sheets/' + symbol + '_annual_BS.csv'
-        try:
-            bsheet = pd.read_csv(filename, parse_dates=['fiscalDateEnding']).fillna(0)
-        except Exception as e:
-            response['reason for failure'] = "Unexpected error while trying to open" + filename 
-            return(response)  # Return an empty dataframe 
-        
-        filename = consolidated_prices_folder + '/income_statements/' + symbol + '_annual_IS.csv'
-        try:
-            incstmt = pd.read_csv(filename, parse_dates=['fiscalDateEnding']).fillna(0)
-        except Exception as e:
-            response['reason for failure'] = "Unexpected error while trying to open" + filename 
-            return(response)  # Return an empty dataframe 
-        
-        filename = consolidated_prices_folder + '/cashflow_statements/' + symbol + '_annual_CF.csv'
-        try:
-            cashflow = pd.read_csv(filename, parse_dates=['fiscalDateEnding']).fillna(0)
-        except Exception as e:
-            response['reason for failure'] = "Unexpected error while trying to open" + filename 
-            return(response)  # Return an empty dataframe
-   
+        period = 'annual'
     else:
         response['reason for failure'] = 'Invalid base parameter. It should be either latest quarterly or latest annual'
         return(response) 
-         
-    # Do sanity check
-    statement_years = min(bsheet.shape[0],incstmt.shape[0], cashflow.shape[0])  # Sometimes one statment has more historical data than others  
-    if (statement_years < 2):
+
+    for key, subfolder, suffix in [('bsheet', 'balance_sheets', 'BS'), ('incstmt', 'income_statements', 'IS'), 
+                                   ('cashflow', 'cashflow_statements', 'CF')]:
+        filename = consolidated_prices_folder + '/' + subfolder + '/' + symbol + '_' + period + '_' + suffix + '.csv'
+        try:
+            count_file('load_statements', filename)
+            response[key] = pd.read_csv(filename, parse_dates=['fiscalDateEnding']).fillna(0)
+        except Exception as e:
+            response['reason for failure'] = "Unexpected error while trying to open" + filename 
+            return(response)  
+
+    response['result'] = 'success'
+    return(response)
+
+
+# synthetic_annual_statements ----------------------------------------------------------------------------------------------------
+#   Creates synthetic annual statements from quarterly ones (most recent quarter first). Balance sheets are taken every fourth
+#   quarter and income and cashflow statements are summed over four quarters
+#
+# Outputs:
+#   Synthetic annual balance sheet, income statement and cashflow statement
+# --------------------------------------------------------------------------------------------------------------------------------
+def synthetic_annual_statements(bsheetq, incstmtq, cashflowq):
+    bsheet = (bsheetq.iloc[:bsheetq.shape[0]//4*4+1,:]).iloc[::4, :]    # We need only every fourth quarterly as we are trying to get
+                                                                        # synthetic annual balance sheets. However, if the number of 
+                                                                        # quarterly statements is not a multiple of 4, we should discard 
+                                                                        # some rows so that, later, when we creatw synthtic income and 
+                                                                        # cashflow statements, it would make no sense to add less than 
+                                                                        # 4 quarterlies to create synthetic annual income and cashflow 
+                                                                        # statements 
+    bsheet = bsheet.reset_index(drop=True)
+
+    # Process income statements
+    temp_df = incstmtq.iloc[:incstmtq.shape[0]//4*4+1,:]
+    incstmt = temp_df.groupby(temp_df.index // 4).sum(numeric_only=True)
+    temp_df = (incstmtq.iloc[:incstmtq.shape[0]//4*4+1,:]).iloc[0::4, :]
+    temp_df.reset_index(drop=True, inplace=True)
+    incstmt['fiscalDateEnding'] = temp_df['fiscalDateEnding']
+    incstmt['reportedCurrency'] = temp_df['reportedCurrency']
+    
+    # Process cashflow statement
+    temp_df = cashflowq.iloc[:cashflowq.shape[0]//4*4+1,:]
+    cashflow = temp_df.groupby(temp_df.index // 4).sum(numeric_only=True)
+    temp_df = (cashflowq.iloc[:cashflowq.shape[0]//4*4+1,:]).iloc[0::4, :]
+    temp_df.reset_index(drop=True, inplace=True)
+    cashflow['fiscalDateEnding'] = temp_df['fiscalDateEnding']
+    cashflow['reportedCurrency'] = temp_df['reportedCurrency']
+    return(bsheet, incstmt, cashflow)
+
+
+# align_statements ---------------------------------------------------------------------------------------------------------------
+#   Aligns the three statements on their fiscalDateEnding instead of their row positions, so that a statement with an extra or a
+#   missing period doesn't throw the whole company away. Statements that aren't sorted most recent first are sorted (repeated
+#   dates keep their first row), the dates common to the three statements are kept (an inner join done with one intersection of
+#   the date arrays) and the history is cut at the first gap between consecutive common dates longer than max_gap_days, as
+#   synthetic annual statements and changes in working capital need consecutive periods. Works on the statements as they are
+#   read (quarterly or annual), before any synthetic annual statements are built
+#
+# Inputs:
+#   bsheet, incstmt, cashflow: Statements as returned by load_statements
+#   max_gap_days: Longest gap between two consecutive periods (Days). Ex. MAX_GAP_DAYS['latest quarterly']
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure' and the three aligned statements (same dates on every row, most recent first) as 
+#   'bsheet', 'incstmt' and 'cashflow' dataframes 
+# --------------------------------------------------------------------------------------------------------------------------------
+def align_statements(bsheet, incstmt, cashflow, max_gap_days=None):
+    response = dict.fromkeys({'result', 'reason for failure', 'bsheet', 'incstmt', 'cashflow'}) 
+    response['result'] = 'failure'
+
+    statements = []
+    for statement in [bsheet, incstmt, cashflow]:
+        dates = pd.to_datetime(statement['fiscalDateEnding'], errors='coerce').to_numpy(dtype='datetime64[ns]')
+        if not (np.diff(dates) < np.timedelta64(0)).all() or np.isnat(dates).any(): # Not strictly most recent first
+            order = np.argsort(-dates.view(np.int64), kind='stable') # NaT (the smallest int64) stays first and is dropped below
+            statement, dates = statement.iloc[order], dates[order]
+            unique = ~np.isnat(dates) & np.concatenate([[True], dates[1:] != dates[:-1]])
+            statement, dates = statement.iloc[unique], dates[unique]
+        statements.append((statement, dates))
+
+    common = np.intersect1d(np.intersect1d(statements[0][1], statements[1][1]), statements[2][1])[::-1] # Most recent first
+    if max_gap_days is not None and common.shape[0] > 1:
+        gaps = np.flatnonzero(-np.diff(common) > np.timedelta64(max_gap_days, 'D'))
+        if gaps.shape[0] > 0:
+            common = common[:gaps[0]+1]
+    if common.shape[0] == 0:
+        response['reason for failure'] = "Dates on financial statements aren't matching"
+        return(response)
+
+    for key, (statement, dates) in zip(['bsheet', 'incstmt', 'cashflow'], statements):
+        response[key] = statement.iloc[np.isin(dates, common)].reset_index(drop=True)
+    response['result'] = 'success'
+    return(response)
+
+
+# read_statements ----------------------------------------------------------------------------------------------------------------
+#   Reads the locally stored balance sheet, income statement and cashflow statement of a symbol and aligns them on their dates. 
+#   If the 'base' parameter is 'latest quarterly', synthetic annual statements are created from 10Q financials. If the 'base' 
+#   parameter is 'latest annual', 10K financials are used as is
+#
+# Inputs:
+#   symbol: Ticker symbol of the company
+#   base: 'latest quarterly' or 'latest annual'
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure' and the three statements as 'bsheet', 'incstmt' and 'cashflow' dataframes 
+# --------------------------------------------------------------------------------------------------------------------------------
+def read_statements(symbol, base='latest quarterly'):
+    response = load_statements(symbol, base)
+    if response['result'] == 'failure':
+        return(response)
+
+    response = align_statements(response['bsheet'], response['incstmt'], response['cashflow'], MAX_GAP_DAYS[base])
+    if response['result'] == 'failure':
+        return(response)
+    if base == 'latest quarterly':
+        response['bsheet'], response['incstmt'], response['cashflow'] = synthetic_annual_statements(response['bsheet'], 
+                                                                                                    response['incstmt'], 
+                                                                                                    response['cashflow'])
+    return(annual_check(response))
+
+
+# annual_check -------------------------------------------------------------------------------------------------------------------
+#   Checks that aligned (annual or synthetic annual) statements have enough years to compute fundamentals from
+# --------------------------------------------------------------------------------------------------------------------------------
+def annual_check(response):
+    if response['bsheet'].shape[0] < 2:
+        response['result'] = 'failure'
         response['reason for failure'] = "Too few years for computing changeinwc"
+    return(response)
+
+
+# load_statements_batch ----------------------------------------------------------------------------------------------------------
+#   Same as load_statements, but for a list of symbols. The rows of each kind of statement of all the symbols are concatenated as
+#   text, each prefixed by its symbol, and parsed with one read_csv into one dataframe with a 'symbol' column (one per kind of
+#   header, if the files don't all have the same columns), instead of one dataframe per file
+#
+# Outputs:
+#   A dict with 'failures' (symbol -> reason for failure) and the three stacked statements as 'bsheet', 'incstmt' and 'cashflow'
+#   dataframes (None if no symbol could be loaded)
+# --------------------------------------------------------------------------------------------------------------------------------
+@profiled()
+def load_statements_batch(symbols, base='latest quarterly'):
+    response = {'failures': {}, 'bsheet': None, 'incstmt': None, 'cashflow': None}
+    period = {'latest quarterly': 'quarterly', 'latest annual': 'annual'}.get(base)
+    if period is None:
+        response['failures'] = dict.fromkeys(symbols, 'Invalid base parameter. It should be either latest quarterly or latest annual')
         return(response)
-        
-    if not (all(bsheet.loc[0:statement_years-1, 'fiscalDateEnding'] == incstmt.loc[0:statement_years-1, 'fiscalDateEnding']) and    # NOTE: loc and iloc work differently while fetching
-            all(incstmt.loc[0:statement_years-1, 'fiscalDateEnding'] == cashflow.loc[0:statement_years-1, 'fiscalDateEnding'])):    # rows. loc[0:3] returns 4 rows, iloc[0:3] returns 3
-        response['reason for failure'] = "Dates on financial statements aren't matching"
+
+    kinds = [('bsheet', 'balance_sheets', 'BS'), ('incstmt', 'income_statements', 'IS'), ('cashflow', 'cashflow_statements', 'CF')]
+    texts = dict([(key, {}) for key, subfolder, suffix in kinds]) # key -> {header: rows of every symbol, prefixed by the symbol}
+    for symbol in symbols:
+        statements = []
+        for key, subfolder, suffix in kinds:
+            filename = consolidated_prices_folder + '/' + subfolder + '/' + symbol + '_' + period + '_' + suffix + '.csv'
+            try:
+                count_file('load_statements_batch', filename)
+                with open(filename) as f:
+                    header, newline, rows = f.read().partition('\n')
+                if len(header.strip()) == 0:
+                    raise ValueError('No columns in ' + filename)
+            except Exception as e:
+                response['failures'][symbol] = "Unexpected error while trying to open" + filename 
+                break
+            statements.append((header.rstrip('\r'), rows.rstrip('\r\n')))
+        if symbol in response['failures']:
+            continue
+        for (key, subfolder, suffix), (header, rows) in zip(kinds, statements):
+            if len(rows) > 0:
+                texts[key].setdefault(header, []).append(symbol + ',' + rows.replace('\n', '\n' + symbol + ','))
+
+    loaded = [symbol for symbol in symbols if symbol not in response['failures']]
+    if min([len(texts[key]) for key in texts]) == 0: # No rows at all in one of the statements
+        response['failures'].update(dict.fromkeys(loaded, "Dates on financial statements aren't matching"))
         return(response)
-        
+    order = dict(zip(loaded, range(len(loaded))))
+    for key in texts:
+        statement = pd.concat([pd.read_csv(io.StringIO('symbol,' + header + '\n' + '\n'.join(chunks)))
+                               for header, chunks in texts[key].items()], ignore_index=True) # One parse per kind of header
+        statement = statement.iloc[np.argsort(statement['symbol'].map(order).to_numpy(), kind='stable')].reset_index(drop=True)
+        statement['fiscalDateEnding'] = pd.to_datetime(statement['fiscalDateEnding'], errors='coerce')
+        labels = statement.columns.intersection(['symbol', 'fiscalDateEnding', 'reportedCurrency'])
+        figures = statement.columns.difference(labels)
+        text = [column for column in figures if not pd.api.types.is_numeric_dtype(statement[column])] # A column with text in one
+        if len(text) > 0:                                                                              # file stays a number in
+            statement[text] = statement[text].apply(pd.to_numeric, errors='coerce')                    # the others
+        values = statement[figures].to_numpy(dtype=np.float64)
+        response[key] = pd.concat([statement[labels], pd.DataFrame(np.where(np.isnan(values), 0, values), columns=figures)], axis=1)
+    return(response)
+
+
+# align_statements_batch ---------------------------------------------------------------------------------------------------------
+#   Same as align_statements, for statements stacked by load_statements_batch. Symbols and dates are packed into one int64 key per
+#   row, so that sorting every statement most recent first within its symbol (in the order the symbols come in) is one argsort,
+#   the dates common to the three statements are one intersection of the key arrays and the rows of each statement are taken
+#   in one go, for all the symbols
+#
+# Outputs:
+#   A dict with 'failures' (symbol -> reason for failure) and the three aligned statements (same symbols and dates on every row)
+#   as 'bsheet', 'incstmt' and 'cashflow' dataframes 
+# --------------------------------------------------------------------------------------------------------------------------------
+def align_statements_batch(bsheet, incstmt, cashflow, max_gap_days=None):
+    response = {'failures': {}, 'bsheet': None, 'incstmt': None, 'cashflow': None}
+    symbols = pd.unique(np.concatenate([bsheet['symbol'].to_numpy(), incstmt['symbol'].to_numpy(), cashflow['symbol'].to_numpy()]))
+    order = dict(zip(symbols, range(len(symbols))))
+
+    statements = [] # (rows, keys) of every statement. A key packs the symbol and the date, and keys go up as symbols go on (in
+                    # the order they come in) and dates go back
+    for statement in [bsheet, incstmt, cashflow]:
+        days = statement['fiscalDateEnding'].to_numpy(dtype='datetime64[D]')
+        rows = np.flatnonzero(~np.isnat(days))
+        keys = statement['symbol'].iloc[rows].map(order).to_numpy(dtype=np.int64)*2**32 + 2**31 - days[rows].astype(np.int64)
+        ranks = np.argsort(keys, kind='stable')
+        rows, keys = rows[ranks], keys[ranks]
+        unique = np.concatenate([[True], keys[1:] != keys[:-1]]) # Repeated dates keep their first row
+        statements.append((rows[unique], keys[unique]))
+
+    common = np.intersect1d(np.intersect1d(statements[0][1], statements[1][1]), statements[2][1])
+    codes = common >> 32
+    if max_gap_days is not None and common.shape[0] > 1:
+        days = 2**31 - (common & (2**32 - 1))
+        gaps = np.cumsum(np.concatenate([[False], (codes[1:] == codes[:-1]) & (days[:-1] - days[1:] > max_gap_days)]))
+        starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+        common = common[gaps == np.repeat(gaps[starts], np.diff(np.append(starts, common.shape[0])))] # The history ends at
+        codes = common >> 32                                                                           # the first gap
+    for symbol in symbols[~np.isin(np.arange(len(symbols)), codes)]:
+        response['failures'][symbol] = "Dates on financial statements aren't matching"
+
+    for key, statement, (rows, keys) in zip(['bsheet', 'incstmt', 'cashflow'], [bsheet, incstmt, cashflow], statements):
+        response[key] = statement.iloc[rows[np.isin(keys, common)]].reset_index(drop=True)
+    return(response)
+
+
+# synthetic_annual_statements_batch ----------------------------------------------------------------------------------------------
+#   Same as synthetic_annual_statements, for aligned statements stacked by symbol (see align_statements_batch). The four quarter
+#   sums of every symbol are one grouped sum
+# --------------------------------------------------------------------------------------------------------------------------------
+def synthetic_annual_statements_batch(bsheetq, incstmtq, cashflowq):
+    grouped = bsheetq.groupby('symbol', sort=False)
+    quarter = grouped.cumcount().to_numpy() # 0 for the most recent quarter. Aligned statements have the same rows
+    used = quarter < grouped['symbol'].transform('size').to_numpy()//4*4+1
+    first = used & (quarter % 4 == 0)
+
+    bsheet = bsheetq[first].reset_index(drop=True)
+    annuals = [bsheet]
+    for statement in [incstmtq, cashflowq]:
+        temp_df = statement[used]
+        annual = temp_df.groupby([temp_df['symbol'], quarter[used]//4], sort=False).sum(numeric_only=True).reset_index(drop=True)
+        for column in ['symbol', 'fiscalDateEnding', 'reportedCurrency']:
+            annual[column] = statement.loc[first, column].to_numpy()
+        annuals.append(annual)
+    return(tuple(annuals))
+
+
+# read_statements_batch ----------------------------------------------------------------------------------------------------------
+#   Same as read_statements, but for a list of symbols, with every step done once for all of them (see load_statements_batch,
+#   align_statements_batch and synthetic_annual_statements_batch)
+#
+# Inputs:
+#   symbols: List of ticker symbols
+#   base: 'latest quarterly' or 'latest annual'
+#
+# Outputs:
+#   A dict with 'failures' (symbol -> reason for failure) and the three statements of the other symbols, stacked in the order of
+#   symbols with a 'symbol' column, as 'bsheet', 'incstmt' and 'cashflow' dataframes (None if every symbol failed)
+# --------------------------------------------------------------------------------------------------------------------------------
+def read_statements_batch(symbols, base='latest quarterly'):
+    response = load_statements_batch(list(dict.fromkeys(symbols)), base)
+    failures = response['failures']
+    if response['bsheet'] is None:
+        return(response)
+
+    response = align_statements_batch(response['bsheet'], response['incstmt'], response['cashflow'], MAX_GAP_DAYS[base])
+    failures.update(response['failures'])
+    statements = [response['bsheet'], response['incstmt'], response['cashflow']]
+    if base == 'latest quarterly':
+        statements = synthetic_annual_statements_batch(*statements)
+
+    years = statements[0].groupby('symbol', sort=False)['symbol'].transform('size')
+    for symbol in pd.unique(statements[0]['symbol'][years < 2]): # Same check as annual_check
+        failures[symbol] = "Too few years for computing changeinwc"
+    keep = (years >= 2).to_numpy()
+    response = {'failures': failures, 'bsheet': None, 'incstmt': None, 'cashflow': None}
+    if keep.any():
+        for key, statement in zip(['bsheet', 'incstmt', 'cashflow'], statements):
+            response[key] = statement[keep].reset_index(drop=True)
+    return(response)
+
+
+# compute_fundamentals -----------------------------------------------------------------------------------------------------------
+#   Creates a dataframe of selected financial data from already aligned statements. Every figure is computed as a whole float64 
+#   column instead of cell by cell. Statements of several companies can be stacked on top of each other, in which case 'groups'
+#   tells which rows belong to which company so that year-over-year differences never cross from one company to another
+#
+# Inputs:
+#   bsheet, incstmt, cashflow: Statements with matching rows, most recent year first (within a group)
+#   debtmethod: 'method1' or anything else (see below)
+#   changeinwcmethod: 'usingbs' or anything else (uses cashflow statement)
+#   groups: Optional array with one label per row. Rows with the same label must be contiguous
+#
+# Outputs:
+#   A pandas dataframe of fundamentals (Millions of $) with the same row order as the statements
+# --------------------------------------------------------------------------------------------------------------------------------
+@profiled()
+def compute_fundamentals(bsheet, incstmt, cashflow, debtmethod='method1', changeinwcmethod='usingcf', groups=None):
     # ---------------------------------- Create a dataframe of selected financial data -----------------------------------------------
     # This is the starting point of actually valuing the company
     # NOTE: From this point on, we deal with Millions of $ 
     # --------------------------------------------------------------------------------------------------------------------------------
-    fundamentals = pd.DataFrame(columns=['date', 'cash', 'equity', 'debt', 'revenue', 'RnD', 'opinc', 'intexp', 'netinc', 'netcapex', 'changeinwc'])
-    
-    for i in range(0,statement_years): 
-        fundamentals.loc[i, 'date'] = bsheet.loc[i, 'fiscalDateEnding'].date() 
-        fundamentals.loc[i, 'cash'] = bsheet.loc[i, 'cashAndShortTermInvestments']/1E6 + bsheet.loc[i, 'longTermInvestments']/1E6
-        fundamentals.loc[i, 'equity'] = bsheet.loc[i, 'totalShareholderEquity']/1E6
-        fundamentals.loc[i, 'debt'] = bsheet.loc[i, 'currentDebt']/1E6 + bsheet.loc[i, 'longTermDebtNoncurrent']/1E6
-        if (debtmethod == 'method1'): # This is because alpha vantage isn't consistent about how it classifies various debt items
-            if(bsheet.loc[i, 'shortTermDebt'] == bsheet.loc[i, 'currentLongTermDebt']):
-                fundamentals.loc[i, 'debt'] = bsheet.loc[i, 'shortTermDebt']/1E6 + \
-                                                bsheet.loc[i, 'longTermDebtNoncurrent']/1E6 + \
-                                                bsheet.loc[i, 'capitalLeaseObligations']/1E6 
-            else:
-                fundamentals.loc[i, 'debt'] = bsheet.loc[i, 'shortTermDebt']/1E6 + \
-                                                bsheet.loc[i, 'currentLongTermDebt']/1E6 + \
-                                                bsheet.loc[i, 'longTermDebtNoncurrent']/1E6 + \
-                                                bsheet.loc[i, 'capitalLeaseObligations']/1E6 
-        else: # For any other method
-            fundamentals.loc[i, 'debt'] = bsheet.loc[i, 'shortLongTermDebtTotal']/1E6 + \
-                                            bsheet.loc[i, 'capitalLeaseObligations']/1E6 
-
-        if incstmt.loc[i, 'nonInterestIncome'] <= 0:
-            fundamentals.loc[i, 'revenue'] = incstmt.loc[i, 'totalRevenue']/1E6
-        else:    
-            fundamentals.loc[i, 'revenue'] = incstmt.loc[i, 'nonInterestIncome']/1E6
-        fundamentals.loc[i, 'RnD'] = incstmt.loc[i, 'researchAndDevelopment']/1E6
-        fundamentals.loc[i, 'opinc'] = incstmt.loc[i, 'operatingIncome']/1E6
-        fundamentals.loc[i, 'intexp'] = incstmt.loc[i, 'interestExpense']/1E6
-        fundamentals.loc[i, 'netinc'] = incstmt.loc[i, 'netIncome']/1E6
-        
-        if i != statement_years-1: # For the last year there is no point in calculating the following
-            fundamentals.loc[i, 'netcapex'] = cashflow.loc[i, 'capitalExpenditures']/1E6 - cashflow.loc[i, 'depreciationDepletionAndAmortization']/1E6
-            if (changeinwcmethod == 'usingbs'):
-                fundamentals.loc[i, 'changeinwc'] = (bsheet.loc[i,'inventory'] - bsheet.loc[i+1,'inventory'])/1E6 \
-                                                    + (bsheet.loc[i, 'currentNetReceivables'] - bsheet.loc[i+1, 'currentNetReceivables'])/1E6 \
-                                                    - (bsheet.loc[i, 'currentAccountsPayable'] - bsheet.loc[i+1, 'currentAccountsPayable'])/1E6
-            else: # If no method is specified
-                fundamentals.loc[i, 'changeinwc'] = cashflow.loc[i,'changeInInventory']/1E6 + cashflow.loc[i, 'changeInReceivables']/1E6 \
-                                                    - (bsheet.loc[i, 'currentAccountsPayable'] - bsheet.loc[i+1, 'currentAccountsPayable'])/1E6
-                
+    def col(statement, name):
+        return(pd.to_numeric(statement[name], errors='coerce').fillna(0).to_numpy(dtype=np.float64)/1E6)
+
+    def next_year(values): # Value of the same item one year before (i.e. next row), NaN for the oldest year of each group
+        shifted = np.full(values.shape[0], np.nan)
+        shifted[:-1] = values[1:]
+        if groups is not None:
+            labels = np.asarray(groups)
+            shifted[:-1][labels[:-1] != labels[1:]] = np.nan
+        return(shifted)
+
+    fundamentals = pd.DataFrame({'date': bsheet['fiscalDateEnding'].dt.date.to_numpy()})
+    fundamentals['cash'] = col(bsheet, 'cashAndShortTermInvestments') + col(bsheet, 'longTermInvestments')
+    fundamentals['equity'] = col(bsheet, 'totalShareholderEquity')
+    if (debtmethod == 'method1'): # This is because alpha vantage isn't consistent about how it classifies various debt items
+        short_term_debt = col(bsheet, 'shortTermDebt')
+        current_lt_debt = col(bsheet, 'currentLongTermDebt')
+        fundamentals['debt'] = short_term_debt + \
+                               np.where(short_term_debt == current_lt_debt, 0, current_lt_debt) + \
+                               col(bsheet, 'longTermDebtNoncurrent') + \
+                               col(bsheet, 'capitalLeaseObligations')
+    else: # For any other method
+        fundamentals['debt'] = col(bsheet, 'shortLongTermDebtTotal') + col(bsheet, 'capitalLeaseObligations')
+
+    non_interest_income = col(incstmt, 'nonInterestIncome')
+    fundamentals['revenue'] = np.where(non_interest_income <= 0, col(incstmt, 'totalRevenue'), non_interest_income)
+    fundamentals['RnD'] = col(incstmt, 'researchAndDevelopment')
+    fundamentals['opinc'] = col(incstmt, 'operatingIncome')
+    fundamentals['intexp'] = col(incstmt, 'interestExpense')
+    fundamentals['netinc'] = col(incstmt, 'netIncome')
+
+    # For the oldest year (of each group) there is no point in calculating the following. So they are left as NaN
+    has_prior_year = ~np.isnan(next_year(np.zeros(bsheet.shape[0])))
+    payables = col(bsheet, 'currentAccountsPayable')
+    change_in_payables = payables - next_year(payables)
+    fundamentals['netcapex'] = np.where(has_prior_year, 
+                                        col(cashflow, 'capitalExpenditures') - col(cashflow, 'depreciationDepletionAndAmortization'), 
+                                        np.nan)
+    if (changeinwcmethod == 'usingbs'):
+        inventory = col(bsheet, 'inventory')
+        receivables = col(bsheet, 'currentNetReceivables')
+        fundamentals['changeinwc'] = (inventory - next_year(inventory)) + (receivables - next_year(receivables)) - change_in_payables
+    else: # If no method is specified
+        fundamentals['changeinwc'] = col(cashflow, 'changeInInventory') + col(cashflow, 'changeInReceivables') - change_in_payables
+
+    return(fundamentals)
+
+
+# get_fundamentals ---------------------------------------------------------------------------------------------------------------
+#   Gets financial statements and if the 'base' parameter is 'laterst_quarterly' creates synthetic annual statements from 10Q
+#   financials and then calculates fundamentals using them. If the 'base' parameter is 'latest_annual', uses 10K financials to 
+#   calculate fundamentals  
+# --------------------------------------------------------------------------------------------------------------------------------
+@profiled()
+def get_fundamentals(symbol, base='latest quarterly', debtmethod='method1', changeinwcmethod='usingcf'):
+    response = dict.fromkeys({'result', 'reason for failure', 'fundamentals'}) 
+    response['result'] = 'failure' # Init this to failure so that if error occurs during execution, we can simply -
+
+    sresponse = read_statements(symbol, base)
+    if sresponse['result'] == 'failure':
+        response['reason for failure'] = sresponse['reason for failure']
+        return(response)
     
     response['result'] = 'success'
-    response['fundamentals'] = fundamentals
+    response['fundamentals'] = compute_fundamentals(sresponse['bsheet'], sresponse['incstmt'], sresponse['cashflow'], 
+                                                    debtmethod, changeinwcmethod)
     return(response)        
 
-def value_company(symbol, industry, fundamentals, beta_to_use = 'global', rir_method = 'last 5 years'):
-    super_response = dict.fromkeys({'result', 'reason for failure', 'Company name', 'Share price', 'Analyst target', 'PE', 'Debt rating', 'fundamentals', 'value_df'}) 
-    super_response['result'] = 'failure' # Init this to failure so that if error occurs during execution, we can simply -
-                                         # return super_response     
-        
-    # Parameters
-    AV_URL = "https://www.alphavantage.co/query"
-    AV_KEY = os.environ.get('ALPHAVANTAGE_API_KEY')
-    
-    # Get latest information related to risk free rate
-    rfr = 3.49#quandl.get('USTREASURY/YIELD').iloc[-1]['10 YR']  # %. Risk free rate for USA. We use the latest 10 year treasury yield.
-                                                            # NOTE: Sometimes quandl is super slow. Plus, in the future, we want to
-                                                            # be able to value a company at a past date. So we should write a function
-                                                            # to update an excel sheet or something with historical rfr values and use
-                                                            # that excel sheet here instead
-    
-    # In-code input parameters
-    erp = 4.78 # %. Equity risk premium for USA
-    tax = 27 # %. Tax rate. We use marginal tax rate which might be too conservative. .-
-    
-    # Get beta to use from adamodaran's xls. 
-    if beta_to_use == 'global':
-        tempdf = pd.read_excel('/home/dinesh/Documents/Valuations/adamodaran/betaGlobal.xls', 'Industry Averages', skiprows=9, index_col=0)
-    elif beta_to_use == 'usa':
-        tempdf = pd.read_excel('/home/dinesh/Documents/Valuations/adamodaran/betas.xls', 'Industry Averages', skiprows=9, index_col=0)
-    else:
-        super_response['reason for failure'] = 'Invalid input for beta_to_use. Valid inputs are <global> or <usa>'
-        return(super_response)
-        
-    
-    unlevered_beta = tempdf.loc[industry]['Unlevered beta corrected for cash']
-    
-    # Get market cap, outstanding shares and stock price
-    query_params = { "function": 'OVERVIEW', "symbol": symbol, "apikey": AV_KEY}
-    response = pd.Series((requests.get(AV_URL, params=query_params)).json())
 
-    if response.empty: 
-        super_response['reason for failure'] = 'Empty response while trying to get overview of the stock'
-        return(super_response)
-    
-    if 'Note' in response or 'Alpha Vantage' in str(response):
-        super_response['reason for failure'] = 'Alpha Vantage limit reached. Abandoning this company'
-        return(super_response)
-    
-    response.replace('None',np.nan,inplace=True) # Otherwise trying to convert 'None' string to int or float (below) will throw an error
-    company_name = response['Name']
-    mv_equity = int(response['MarketCapitalization'])/1E6
-    price = float(response['50DayMovingAverage'])
-    outstanding_shares = int(mv_equity*1E6/price)   # int(response['SharesOutstanding']) # NOTE: In one instance, response had the wrong number
-                                                    # of shares outstanding. This is the single most important figure and you can afford to get
-                                                    # this wrong. So one should always take the actual value directly from 10K/Q. For now, we are
-                                                    # using market cap dividied by 50 day moving average as a proxy for actual number of shares
-    analyst_target_price = float(response['AnalystTargetPrice'])
-    pe_ratio = float(response['PERatio'])
-    
-    super_response['Company name'] = company_name
-    super_response['Share price'] = price
-    super_response['Analyst target'] = analyst_target_price
-    super_response['PE'] = pe_ratio
-    
+# get_fundamentals_batch ---------------------------------------------------------------------------------------------------------
+#   Same as get_fundamentals, but for a list of symbols. Statements of all the symbols are read, aligned and stacked in one pass
+#   (see read_statements_batch) and the fundamentals are computed in one columnar pass, so that a crawl over thousands of tickers
+#   doesn't pay pandas overhead per symbol
+#
+# Inputs:
+#   symbols: List of ticker symbols
+#   base, debtmethod, changeinwcmethod: Same as get_fundamentals
+#
+# Outputs:
+#   A dict with 'result', 'failures' (symbol -> reason for failure) and 'fundamentals', a (symbol, fyear) indexed panel 
+# --------------------------------------------------------------------------------------------------------------------------------
+@profiled()
+def get_fundamentals_batch(symbols, base='latest quarterly', debtmethod='method1', changeinwcmethod='usingcf'):
+    response = dict.fromkeys({'result', 'failures', 'fundamentals'}) 
+    response['result'] = 'failure'
+
+    sresponse = read_statements_batch(symbols, base)
+    response['failures'] = sresponse['failures']
+    if sresponse['bsheet'] is None:
+        return(response)
+
+    groups = sresponse['bsheet']['symbol'].to_numpy()
+    panel = compute_fundamentals(sresponse['bsheet'], sresponse['incstmt'], sresponse['cashflow'], 
+                                 debtmethod, changeinwcmethod, groups=groups)
+    panel.insert(0, 'symbol', groups)
+    panel.insert(1, 'fyear', [d.year for d in panel['date']])
+    panel.set_index(['symbol', 'fyear'], inplace=True)
+
+    response['result'] = 'success'
+    response['fundamentals'] = panel
+    return(response)
+
+
+# statement_fingerprint ----------------------------------------------------------------------------------------------------------
+#   Returns a SHA1 of the fundamentals of a company. Fundamentals are computed from the statements alone, so the fingerprint
+#   changes only when new (or restated) statements come in
+# --------------------------------------------------------------------------------------------------------------------------------
+def statement_fingerprint(fundamentals):
+    hashes = pd.util.hash_pandas_object(fundamentals, index=True).to_numpy()
+    return(hashlib.sha1(hashes.tobytes() + ','.join(fundamentals.columns).encode()).hexdigest())
+
+
+# statement_state ----------------------------------------------------------------------------------------------------------------
+#   Computes the part of a valuation that depends only on the statements: capitalized R&D, ROIC, reinvestment rate and interest
+#   coverage ratio. Nothing here depends on the share price or on rfr/erp, so it doesn't need to be recomputed when only market
+#   data changes (see get_statement_state)
+#
+# Inputs:
+#   fundamentals: As returned by get_fundamentals. It is not modified, R&D is capitalized on a copy
+#   tax: Tax rate (%)
+#   rir_method: 'last 5 years' or 'latest year only', see value_company
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure', 'fundamentals' (with R&D capitalized), 'roic', 'rir', 'roics' (positive yearly
+#   ROICs), 'rirs', 'int_cov_ratio', 'bv_debt', 'cash', 'post_tax_opinc', 'reinvestment' (of the base year), 'base_year', 'tax'
+#   and 'rir_method'
+# --------------------------------------------------------------------------------------------------------------------------------
+def statement_state(fundamentals, tax, rir_method='last 5 years'):
+    state = dict.fromkeys({'result', 'reason for failure', 'fundamentals', 'roic', 'rir', 'roics', 'rirs', 'int_cov_ratio', 
+                           'bv_debt', 'cash', 'post_tax_opinc', 'reinvestment', 'base_year', 'tax', 'rir_method'})
+    state['result'] = 'failure'
+    state['tax'] = tax
+    state['rir_method'] = rir_method
+    fundamentals = fundamentals.copy() # So that valuing a company twice with the same frame doesn't capitalize R&D twice
+
     if rir_method == 'last 5 years' and fundamentals.shape[0] < 5: # At a min, we are expecting 4 historical years, plus the latest year/TTM
-        super_response['reason for failure'] = 'We do not have enough historic data to go about'
-        return(super_response)
+        state['reason for failure'] = 'We do not have enough historic data to go about'
+        return(state)
     
     # Capitalize R&D (with 5 year straight line depreciation)
     # We find the average R&D expense and depreciate them as operating expense. The reason we do this is that we are going to find 
@@ -282,8 +549,8 @@ def value_company(symbol, industry, fundamentals, beta_to_use = 'global', rir_me
     # rate, because for oldest 4 years, we cannot get accurate depreciated R&D values simply because we don't have R&D data from 
     # the past before the 5-years data we have
     if any(fundamentals['RnD'] < 0): # Sanity check
-        super_response['reason for failure'] = 'R&D expense cannot be negative'
-        return(super_response)
+        state['reason for failure'] = 'R&D expense cannot be negative'
+        return(state)
     
     average_RnD = fundamentals['RnD'].mean()
 
@@ -295,13 +562,12 @@ def value_company(symbol, industry, fundamentals, beta_to_use = 'global', rir_me
         fundamentals['opinc'] = fundamentals['opinc'] + fundamentals['RnD'] - RnD_depreciation
         fundamentals['netcapex'] = fundamentals['netcapex'] + fundamentals['RnD'] - RnD_depreciation 
         
-    super_response['fundamentals'] = fundamentals
     
     # Calculate ROIC
     invested_capitals = fundamentals['equity']+fundamentals['debt']-fundamentals['cash']
     if any(invested_capitals < 0): # Sanity check
-        super_response['reason for failure'] = 'Invested capital is negative sometimes. Something wrong with the data'
-        return(super_response)
+        state['reason for failure'] = 'Invested capital is negative sometimes. Something wrong with the data'
+        return(state)
     roics = pd.Series(dtype=float)
     
     iter_len = 5 if len(fundamentals) > 5 else len(fundamentals)-1 # We don't want to consider anything older than 5 years
@@ -310,8 +576,8 @@ def value_company(symbol, industry, fundamentals, beta_to_use = 'global', rir_me
     
     roics_pos = pd.Series([x for x in roics if x>0], dtype = float) # Extract only positive ROIC values
     if len(roics_pos) < 3: # We are overall examining 5 historic years and one ttm
-        super_response['reason for failure'] = 'This company has too many negative ROICs'
-        return(super_response)
+        state['reason for failure'] = 'This company has too many negative ROICs'
+        return(state)
     
     roic = stats.gmean(roics_pos.values)    # Geometric mean of positive ROIC values
     
@@ -333,40 +599,28 @@ def value_company(symbol, industry, fundamentals, beta_to_use = 'global', rir_me
         else:
             rir = rirs.mean()
     elif rir_method == 'latest year only':
+        if len(rirs) == 0: # Every year had a negative reinvestment or an operating loss
+            state['reason for failure'] = 'No year usable for the reinvestment rate'
+            return(state)
         rir = rirs[0]
     else:
-        super_response['reason for failure'] = 'Invalid rir_method parameter. It should be either <last 5 years> or <latest year only>'
-        return(super_response) 
+        state['reason for failure'] = 'Invalid rir_method parameter. It should be either <last 5 years> or <latest year only>'
+        return(state) 
          
     if rir > 1: # If there is a more than 100% reinvestment (presumably because the company raised money through equity or debt financing
                 # then such companies must be revalued manually
-        super_response['reason for failure'] = 'Reinvestment rate more than 100%'
-        return(super_response)
+        state['reason for failure'] = 'Reinvestment rate more than 100%'
+        return(state)
          
-    
-    # -------------------------------------------- Calculate Weighted Average Cost of Capital ---------------------------------------
-    # We use synthetic bond rating (based on interest coverage ratio) to find cost of debt, and use BV of debt in place of MV of debt
-    # -------------------------------------------------------------------------------------------------------------------------------
-    ## Find cost of debt
-    synthetic_rating = pd.DataFrame({'int_cov_ratio': pd.Series([], dtype=float), 
-                                     'rating': pd.Series([], dtype=str), 
-                                     'spread': pd.Series([], dtype=float)})
-    
-    # NOTE: The following three arrays realted to interest coverage ratios and corresponding ratings and spread change from time to time.-
-    # So this is a bad idea. Try to automate this. For now, these need to be updated from https://pages.stern.nyu.edu/~adamodar/New_Home_Page/datafile/ratings.html
-    t_int_cov_ratio = [-np.inf, 0.2, 0.65, 0.8, 1.25, 1.5, 1.75, 2, 2.25, 2.5, 3, 4.25, 5.5, 6.5, 8.5] # 't' prefix for 'table'
-    t_rating = ['D2/D', 'C2/C', 'Ca2/CC', 'Caa/CCC', 'B3/B-', 'B2/B', 'B1/B+', 'Ba2/BB', 'Ba1/BB+', 'Baa2/BBB', 'A3/A-', 'A2/A', 'A1/A+', 'Aa2/AA', 'Aaa/AAA']
-    t_spread = [20, 17.5, 15.78, 11.57, 7.37, 5.26, 4.55, 3.13, 2.42, 2.00, 1.62, 1.42, 1.23, 0.85, 0.69] # percentage
-    synthetic_rating = pd.DataFrame({'int_cov_ratio':t_int_cov_ratio, 'rating':t_rating, 'spread':t_spread})
-    
+
     int_cov_ratios = pd.Series(dtype=float)
     free_index = 0
     for i in range(0, iter_len):
         if fundamentals.loc[i,'opinc'] < 0: # We don't want to consider years where they incurred a loss
             continue
         if fundamentals.loc[i, 'intexp'] < 0: # So we can avoid divide-by-zero error
-            super_response['reason for failure'] = 'Interest expense cannot be negative'
-            return(super_response)
+            state['reason for failure'] = 'Interest expense cannot be negative'
+            return(state)
             
         if fundamentals.loc[i, 'intexp'] == 0: # So we can avoid divide-by-zero error
             int_cov_ratios.loc[free_index] = 9 # Give it perfect rating
@@ -376,180 +630,222 @@ def value_company(symbol, industry, fundamentals, beta_to_use = 'global', rir_me
         free_index = free_index+1
     
     if len(int_cov_ratios) < 3:
-        super_response['reason for failure'] = 'Bad interest coverage ratios'
-        return(super_response)
+        state['reason for failure'] = 'Bad interest coverage ratios'
+        return(state)
     
     int_cov_ratio = int_cov_ratios.mean()
-    temp = synthetic_rating['int_cov_ratio'] < int_cov_ratio # Results in a logical series
-    rating_index = len(temp[temp])-1
-    spread = synthetic_rating.loc[rating_index, 'spread']
-    cost_of_debt = rfr + spread # percentage
-    debt_rating = synthetic_rating.loc[rating_index, 'rating']
- 
-    super_response['Debt rating'] = debt_rating 
-    
-    ## Find cost of equity
     bv_debt = fundamentals.loc[0, 'debt']
-    levered_beta = unlevered_beta*(1 + (1-tax/100)*bv_debt/mv_equity)
-    cost_of_equity = rfr + levered_beta*erp # percentage
+
+    state['fundamentals'] = fundamentals
+    state['roic'] = roic
+    state['rir'] = rir
+    state['roics'] = roics_pos.to_numpy()
+    state['rirs'] = rirs.to_numpy()
+    state['int_cov_ratio'] = int_cov_ratio
+    state['bv_debt'] = bv_debt
+    state['cash'] = fundamentals.loc[0, 'cash']
+    state['post_tax_opinc'] = fundamentals.loc[0, 'opinc']*(1-tax/100)
+    state['reinvestment'] = reinvestments[0]
+    state['base_year'] = fundamentals.loc[0,'date'].year
+    state['result'] = 'success'
+    return(state)
+
+
+# get_statement_state ------------------------------------------------------------------------------------------------------------
+#   Memoized statement_state. One state is kept per symbol along with the fingerprint of the fundamentals it was computed from,
+#   and it is recomputed only when the statements (or tax, rir_method) change. So re-valuing a company after a price or rate
+#   move only redoes WACC, discounting and value per share
+# --------------------------------------------------------------------------------------------------------------------------------
+def get_statement_state(symbol, fundamentals, tax, rir_method='last 5 years'):
+    fingerprint = statement_fingerprint(fundamentals)
+    key = (fingerprint, tax, rir_method)
+    if symbol in _statement_states and _statement_states[symbol][0] == key:
+        count('statement_state', 'cache hits')
+        return(_statement_states[symbol][1])
+    count('statement_state', 'cache misses')
+    with stage('statement_state'):
+        state = statement_state(fundamentals, tax, rir_method)
+    _statement_states[symbol] = (key, state)
+    return(state)
+
+
+@profiled()
+def value_company(symbol, industry, fundamentals, beta_to_use = 'global', rir_method = 'last 5 years', report = 'xlsx', verbose = True,
+                  discounting = 'flat', steady_state_roic = 0.1, market_source = 'local', overview = None):
+    super_response = dict.fromkeys({'result', 'reason for failure', 'Company name', 'Symbol', 'Industry', 'Date', 'Currency', 'Share price', 
+                                    'Analyst target', 'PE', 'Debt rating', 'fundamentals', 'value_df', 'grid', 'inputs'}) 
+    super_response['result'] = 'failure' # Init this to failure so that if error occurs during execution, we can simply -
+                                         # return super_response     
+    super_response['Symbol'] = symbol
+    super_response['Industry'] = industry
+    super_response['Date'] = date.today()
+    super_response['Currency'] = 'USD'
+        
+    # Parameters
+    AV_KEY = os.environ.get('ALPHAVANTAGE_API_KEY')
+    
+    # Equity risk premium, tax rate (%) and beta come from adamodaran's data, parsed once and cached (see reference_data)
+    refdata = get_reference_data()
+    erp = refdata['erp'] # %. Equity risk premium for USA
+    tax = refdata['tax'] # %. Tax rate. We use marginal tax rate which might be too conservative. .-
+    
+    if beta_to_use not in ['global', 'usa']:
+        super_response['reason for failure'] = 'Invalid input for beta_to_use. Valid inputs are <global> or <usa>'
+        return(super_response)
+    
+    if discounting not in ['flat', 'term']:
+        super_response['reason for failure'] = 'Invalid discounting parameter. It should be either <flat> or <term>'
+        return(super_response)
+    
+    if market_source not in ['local', 'overview']:
+        super_response['reason for failure'] = 'Invalid market_source parameter. It should be either <local> or <overview>'
+        return(super_response)
+    
+    # Risk free rate (latest 10 year treasury yield) and ERP come from the local rate store, which is kept up to date by 
+    # market_rates.update_market_rates. Quandl is too slow to be asked for every company
+    try:
+        rates = get_rates()
+    except ValueError as e:
+        super_response['reason for failure'] = str(e)
+        return(super_response)
+    rfr = rates['rfr'] # %. Risk free rate for USA
+    if rates['erp'] is not None:
+        erp = rates['erp']
+    
+    unlevered_beta = refdata['betas'][beta_to_use].get(industry)
+    if unlevered_beta is None:
+        super_response['reason for failure'] = 'Industry not found in beta table'
+        return(super_response)
+    
+    # Get market cap, outstanding shares and stock price. With market_source 'local', they come from the local market snapshot
+    # (see market_snapshot) and OVERVIEW is requested only if the snapshot has no fresh data for the symbol or the cached name,
+    # analyst target and PE are too old. A caller that has already requested OVERVIEW (Ex. the fetch stage of valuation_crawler,
+    # as worker processes don't share the rate limiter) passes it as overview, and it is then used instead of a new request
+    market = market_data(symbol) if market_source == 'local' else None
+    response = cached_overview(symbol) if market is not None else None
+    if response is None:
+        if overview is None:
+            query_params = { "function": 'OVERVIEW', "symbol": symbol, "apikey": AV_KEY}
+            with stage('overview'):
+                response = pd.Series(av_get(query_params)) # Shares the pooled session and rate limiter with statement downloads
+        else:
+            response = pd.Series(overview)
+
+        if response.empty: 
+            super_response['reason for failure'] = 'Empty response while trying to get overview of the stock'
+            return(super_response)
+        
+        if 'Note' in response or 'Alpha Vantage' in str(response):
+            super_response['reason for failure'] = 'Alpha Vantage limit reached. Abandoning this company'
+            return(super_response)
+        if overview is None:
+            store_overview(symbol, response) # The caller caches the ones it passes
+    else:
+        count('overview', 'cache hits')
+    
+    response = pd.Series(response).replace('None',np.nan) # Otherwise trying to convert 'None' string to int or float (below) will throw an error
+    company_name = response['Name']
+    if market is None:
+        mv_equity = int(response['MarketCapitalization'])/1E6
+        price = float(response['50DayMovingAverage'])
+        outstanding_shares = int(mv_equity*1E6/price)   # int(response['SharesOutstanding']) # NOTE: In one instance, response had the wrong number
+                                                        # of shares outstanding. This is the single most important figure and you can afford to get
+                                                        # this wrong. So one should always take the actual value directly from 10K/Q. For now, we are
+                                                        # using market cap dividied by 50 day moving average as a proxy for actual number of shares
+    else:
+        mv_equity = market['mv_equity']
+        price = market['price']
+        outstanding_shares = int(market['shares']) # Straight from the latest 10Q balance sheet (see market_snapshot)
+    analyst_target_price = float(response['AnalystTargetPrice'])
+    pe_ratio = float(response['PERatio'])
+    
+    super_response['Company name'] = company_name
+    super_response['Share price'] = price
+    super_response['Analyst target'] = analyst_target_price
+    super_response['PE'] = pe_ratio
     
-    ## Find WACC
-    wacc = (mv_equity/(mv_equity + bv_debt))*cost_of_equity + (bv_debt/(mv_equity + bv_debt))*(1-tax/100)*cost_of_debt
+    state = get_statement_state(symbol, fundamentals, tax, rir_method) # Everything that depends only on the statements
+    if state['result'] == 'failure':
+        super_response['reason for failure'] = state['reason for failure']
+        return(super_response)
+    
+    fundamentals = state['fundamentals']
+    super_response['fundamentals'] = fundamentals
+    roic, rir, int_cov_ratio, bv_debt = state['roic'], state['rir'], state['int_cov_ratio'], state['bv_debt']
+    
+    # -------------------------------------------- Calculate Weighted Average Cost of Capital ---------------------------------------
+    # We use synthetic bond rating (based on interest coverage ratio) to find cost of debt, and use BV of debt in place of MV of debt
+    # -------------------------------------------------------------------------------------------------------------------------------
+    # NOTE: The interest coverage ratio -> rating -> spread table changes from time to time. See reference_data for updating it
+    synthetic_rating = refdata['rating_table']
+    
+    ## Find cost of debt, cost of equity and WACC (percentages). See cost_of_capital for the batch version used for whole universes
+    with stage('cost_of_capital'):
+        coc = cost_of_capital(int_cov_ratio, bv_debt, mv_equity, unlevered_beta, rfr, erp, tax, synthetic_rating)
+    debt_rating = coc['rating'].item()
+    cost_of_debt = coc['cost_of_debt'].item()
+    levered_beta = coc['levered_beta'].item()
+    cost_of_equity = coc['cost_of_equity'].item()
+    wacc = coc['wacc'].item()
+ 
+    super_response['Debt rating'] = debt_rating 
     
     
     # -------------------------------------------- DCF calculation -------------------------------------------------------------------
     # We use a growth ramp down model where we get from current growth to growth rate of economy (as decided by risk free rate, and 
     # then settle for growth at the rate of risk free rate
     # --------------------------------------------------------------------------------------------------------------------------------
-    output_filename = '/home/dinesh/Documents/Valuations/usa/' + symbol + '.xlsx'
-    writer = pd.ExcelWriter(output_filename, engine = 'openpyxl')
+    # steady_state_roic defaults to 0.1. NOTE: This is an assumption that may need to change from time to time. So keep reevaluating
+    # or pass the median ROIC of the industry (see industry_aggregates.industry_target)
+    ssbetas = [0.8, 1, 1.2]
+    gslopes = [3, 5, 7]
+    
+    post_tax_opinc = state['post_tax_opinc']
+    fcff = post_tax_opinc - state['reinvestment']
+    if roic*rir < rfr/100 and fcff < 0: # If free cash flow for current year is negative and growth is below rfr, quit automatic valuation and settle for manual valuation
+                                        # NOTE: There are a lot of issues in this if condition. Firstly the two conditions combined
+                                        # here should be dealt with separately. For SWX, wacc seems to be less than rfr. This needs to be investigated 
+        super_response['reason for failure'] = 'Negative FCFF for base year'
+        return(super_response)
     
-    steady_state_roic = 0.1 # NOTE: This is an assumption that may need to change from time to time. So keep reevaluating 
+    # Steady state ROIC is set at a fixed level for all industries, which is not ideal. If current ROIC is less that steady state ROIC,
+    # then we cannot ramp down to steady state. You may want to rerun this code with the specific industry's steady state ROIC when this happens.    
+    dcf_inputs = {'post_tax_opinc': post_tax_opinc, 'reinvestment': state['reinvestment'], 'roic': roic, 'rir': rir, 'wacc': wacc,
+                  'rfr': rfr, 'erp': erp, 'cash': state['cash'], 'debt': bv_debt, 
+                  'outstanding_shares': outstanding_shares}
+    if discounting == 'term': # Discount every year at the WACC of the matching Treasury maturity (see yield_curve)
+        try:
+            curve = get_curve()
+        except ValueError as e:
+            super_response['reason for failure'] = str(e)
+            return(super_response)
+        dcf_inputs['wacc_term'] = term_wacc(curve, wacc, rfr, tax, mv_equity, bv_debt)
+    with stage('dcf'):
+        grid = value_grid(dcf_inputs, ssbetas, gslopes, [steady_state_roic], return_paths=True)
     
-    value_df = pd.DataFrame(columns=['gslope=3', 'gslope=5', 'gslope=7'], index=['ssBeta=0.8','ssBeta=1', 'ssBeta=1.2'])
+    value_df = pd.DataFrame(grid['vps'][:, :, 0], columns=['gslope=' + str(g) for g in gslopes], index=['ssBeta=' + str(b) for b in ssbetas])
    
-    sheetmaxrow = 1
-    index_num = 0
-    for ssbeta in [0.8, 1, 1.2]:
-        col_num = 0
-        for gslope in [3, 5, 7]:
-            pv_df = pd.DataFrame({  'year': pd.Series([], dtype=int),
-                                    'post_tax_opinc': pd.Series([], dtype=float), 
-                                    'roic': pd.Series([], dtype=float), 
-                                    'rir': pd.Series([], dtype=float), 
-                                    'growth': pd.Series([], dtype=float), 
-                                    'fcff': pd.Series([], dtype=float), 
-                                    'pv': pd.Series([], dtype=float) })
-            
-            fyear = fundamentals.loc[0,'date'].year
-            post_tax_opinc = fundamentals.loc[0, 'opinc']*(1-tax/100)
-            fcff = post_tax_opinc - reinvestments[0]
-            pv = np.nan
-            iroic = roic
-            irir = rir
-            steady_state_rir = (rfr/100)/steady_state_roic
-                
-            pv_df.loc[0, 'year'] = fyear
-            pv_df.loc[0, 'post_tax_opinc'] = post_tax_opinc
-            pv_df.loc[0, 'roic'] = iroic*100
-            pv_df.loc[0, 'rir'] = irir*100
-            pv_df.loc[0, 'growth'] = iroic*irir*100
-            pv_df.loc[0, 'fcff'] = fcff
-            pv_df.loc[0, 'pv'] = pv
-            
-            if roic*rir < rfr/100: # If growth is already slower than risk free rate. Then treat this as a going concern
-                                                                # NOTE: There are a lot of issues in this if condition. Firstly the two conditions combined
-                                                                # here should be dealt with separately. For SWX, wacc seems to be less than rfr. This needs to be investigated 
-                if fcff < 0: # If free cash flow for current year is negative and growth is below rfr, quit automatic valuation and settle for manual valuation
-                    super_response['reason for failure'] = 'Negative FCFF for base year'
-                    return(super_response)
-                op_asset_value = fcff*(1+roic*rir)/(wacc/100 - roic*rir)
-
-            elif roic < steady_state_roic:  # Steady state ROIC is set at a fixed level for all industries, which is not ideal. If current ROIC is less that steady
-                                            # state ROIC, then we cannot ramp down to steady state. You may want to rerun this code with the specific industry's
-                                            # steady state ROIC when this happens.    
-                op_asset_value = fcff*(1+roic*rir)/(rfr/100 - roic*rir)
-
-            else: 
-                num_extord_years = int((roic*rir*100-rfr)/gslope)+3 # NOTE: The y-intercept value of 3 is chosen arbitrarily for now. One should 
-                                                                    # however look at hisotric figures what should be the y-intercept
-                for i in range(1, num_extord_years+2):
-                    fyear = fyear+1
-                    post_tax_opinc = post_tax_opinc*(1+iroic*irir)
-                    iroic = (steady_state_roic - iroic)/(num_extord_years+1 - (i-1)) + iroic # (y2-y1)/(x2-x1)  * (x-x1) + y1, except, x-x1 is always 1 (year)    
-                    irir = (steady_state_rir - irir)/(num_extord_years+1 - (i-1)) + irir # (y2-y1)/(x2-x1)  * (x-x1) + y1, except, x-x1 is always 1 (year)    
-                    fcff = post_tax_opinc*(1-irir)
-                    if i != num_extord_years+1:
-                        pv = fcff/(1+wacc/100)**i
-                    else:
-                        pv = (fcff/(ssbeta*erp/100))/(1+wacc/100)**(i-1)
-                
-                    pv_df.loc[i, 'year'] = fyear
-                    pv_df.loc[i, 'post_tax_opinc'] = post_tax_opinc
-                    pv_df.loc[i, 'roic'] = iroic*100
-                    pv_df.loc[i, 'rir'] = irir*100
-                    pv_df.loc[i, 'growth'] = iroic*irir*100
-                    pv_df.loc[i, 'fcff'] = fcff
-                    pv_df.loc[i, 'pv'] = pv
-                 
-                op_asset_value = pv_df.pv.sum()
-            
-            firm_value = op_asset_value + fundamentals.loc[0, 'cash']
-            equity_value = firm_value - fundamentals.loc[0, 'debt']
-            vps = (equity_value*1E6)/outstanding_shares   
-            
-            value_df.iloc[[index_num],[col_num]] = vps
-            col_num = col_num+1
-            
-            dummy_df = pd.DataFrame([],columns=['ssBeta = ' + str(ssbeta) + ', gslope = ' + str(gslope)]) # Just to write a heading text to the excel sheet
-            dummy_df.to_excel(writer, 'Details', index=False, startrow = sheetmaxrow+2)
-            sheetmaxrow = sheetmaxrow+dummy_df.shape[0]
-            pv_df.to_excel(writer, 'Details', index=False, startrow = sheetmaxrow+2)
-            sheetmaxrow = sheetmaxrow+pv_df.shape[0]
-    
-        index_num = index_num+1
-    
-    writer.close()
     super_response['value_df'] = value_df
-    
+    super_response['grid'] = grid
+    super_response['inputs'] = {'rfr': rfr, 'erp': erp, 'tax': tax, 'mv_equity': mv_equity, 'price': price, 
+                                'outstanding_shares': outstanding_shares, 'unlevered_beta': unlevered_beta, 'bv_debt': bv_debt, 
+                                'cash': state['cash'], 'post_tax_opinc': post_tax_opinc, 'reinvestment': state['reinvestment'], 
+                                'roic': roic, 'rir': rir, 'roics': state['roics'], 'rirs': state['rirs'], 
+                                'rir_method': rir_method, 'int_cov_ratio': int_cov_ratio, 'levered_beta': levered_beta, 
+                                'cost_of_equity': cost_of_equity, 'cost_of_debt': cost_of_debt, 'wacc': wacc, 
+                                'steady_state_roic': steady_state_roic, 'ssbetas': ssbetas, 'gslopes': gslopes, 
+                                'discounting': discounting, 'curve date': curve['date'] if discounting == 'term' else None, 
+                                'rfr date': rates['rfr date'], 'market date': None if market is None else market['date'], 
+                                'base_year': state['base_year']}
+    super_response['result'] = 'success'
     
     # ------------------------------------------------- Write data to a spreadsheet ---------------------------------------------------------------
-    output_filename = '/home/dinesh/Documents/Valuations/usa/' + symbol + '.xlsx'
-    writer = pd.ExcelWriter(output_filename, mode='a', if_sheet_exists='overlay', engine = 'openpyxl')
-    
-    top_df = pd.DataFrame([[company_name], [symbol], [date.today()], ['USD'], [industry]],
-                          index = ['Company name', 'Symbol', 'Date', 'Currency', 'Industry'])  
-    lastrow = 0
-
-    top_df.to_excel(writer,'Summary', header=False)
-    lastrow = lastrow+ top_df.shape[0]+2
-    
-    rates_df = pd.DataFrame([['risk-free rate',rfr], ['equity risk premium',erp], ['tax',tax]], columns=['RATES','percentage'])
-    rates_df.to_excel(writer, 'Summary', index=False, startrow = lastrow)
-    lastrow = lastrow+ rates_df.shape[0]+2
-    
-    market_df = pd.DataFrame([['market cap',mv_equity], ['stock price',price], ['outstanding shares',outstanding_shares], 
-                              ['unlevered beta', unlevered_beta], ['debt rating', synthetic_rating.loc[rating_index,'rating']]], columns=['MARKET FIGURES',''])
-    market_df.to_excel(writer, 'Summary', index=False, startrow = lastrow)
-    lastrow = lastrow+market_df.shape[0]+2
-    
-    dummy_df = pd.DataFrame([],columns=['FUNDAMENTALS']) # Just to write a heading text to the excel sheet
-    dummy_df.to_excel(writer, 'Summary', index=False, startrow = lastrow)
-    lastrow = lastrow+ dummy_df.shape[0]+1
-    fundamentals.to_excel(writer, 'Summary', index=False, startrow = lastrow)
-    lastrow = lastrow+fundamentals.shape[0]+2
-    
-    derived_df = pd.DataFrame([ ['levered beta', levered_beta], ['cost of equity',cost_of_equity], ['cost of debt', cost_of_debt], ['wacc',wacc],
-                                ['return on capital',pv_df.loc[0, 'roic']], ['reinv rate',pv_df.loc[0,'rir']], ['growth rate',pv_df.loc[0,'growth']] ],
-                                columns=['DERIVED FIGURES','percentage']) 
-    derived_df.to_excel(writer, 'Summary', index=False, startrow = lastrow)
-    lastrow = lastrow+ derived_df.shape[0]+2
-    
-    dummy_df = pd.DataFrame([],columns=['VPS MATRIX']) # Just to write a heading text to the excel sheet
-    dummy_df.to_excel(writer, 'Summary', index=False, startrow = lastrow)
-    lastrow = lastrow+dummy_df.shape[0]+1
-    value_df.to_excel(writer, 'Summary', startrow = lastrow)
-    
-    writer.close()
-
-
-    # ---------------------------------------------------- Print out a summary ---------------------------------------------------------------------
-    print('\n')
-    print('------------------ VALUATION SUMMARY ----------------------')
-    print('\n')
-    print(company_name, '\n')
-    print('Latest statement date:', super_response['fundamentals'].loc[0,'date'])
-    print('Industry: ', industry)
-    print('Share price: ', price, '\n')
-    print('Analyst target: ',analyst_target_price, '\n')
-    print('PE: ', pe_ratio, '\n')
-    print('Debt rating: ', debt_rating, '\n')
-    print('VPS Matrix')
-    print(value_df.to_markdown())
-    print('\n Derived Figures')
-    print(derived_df.to_markdown())
-    print('-----------------------------------------------------------')
+    # Crawls can pass report=None and write all the results in one go later on (see valuation_report) 
+    if report == 'xlsx':
+        write_valuation_report(super_response)
+    
+    if verbose:
+        print_summary(super_response)
 
-    super_response['result'] = 'success'
     return(super_response)
     
@@ -1,9 +1,12 @@
 # download_statements.py -------------------------------------------------------------------------------
 #   Downloads financial statements, flags errors, converts data to convenient formats and store in files
 #
+#   Can be imported (see fetch_statement and fetch_all) or run from the command line. All the requests
+# of a process go through one pooled requests.Session and share one Alpha Vantage rate limiter
 # ------------------------------------------------------------------------------------------------------
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import numpy as np
 import pandas as pd
@@ -12,103 +15,197 @@ import os
 import sys
 import errno
 import time
+import threading
+from collections import deque
 from datetime import datetime
 from tqdm import tqdm, trange
 import argparse
+from profiling import stage, profiled, count, count_file
 
 # Parameters
 AV_URL = "https://www.alphavantage.co/query"
 AV_KEY = os.environ.get('ALPHAVANTAGE_API_KEY')
+AV_REQ_PER_MIN = 5  # Alpha vantage limit is 5 req per min
 consolidated_prices_folder = '/home/dinesh/Documents/security_prices/usa'
 
-# Parse command line arguments
-msg = "Downloads financial statements"
-parser = argparse.ArgumentParser(description=msg)
-parser.add_argument('-t', '--ticker', help="ticker symbol")
-parser.add_argument('-s', '--sector', help="GICS sector exactly as given in Wikipedia - List_of S&P 500 companies")
-parser.add_argument('-r', '--sample_size', help='Sample size. If not supplied, all pertinent stocks will be taken into consideration', type=int)
-help_text = """Forcefully update non-price data (Ex. net income). If not supplied, preexising (possibly outdated)
-               data will be used when available """ 
-parser.add_argument('-f', '--update_data', help=help_text)
-parser.add_argument('statement', help="income_statement or balance_sheet or cashflow", choices=['income_statement', 'balance_sheet', 'cashflow'])
-
-args = parser.parse_args()
-if args.ticker:                 # If the user explicityly gives ticker symbol, then sector, update_data, sample_size are irrelevant 
-    symbols = list()
-    symbols.append(args.ticker)
-    args.update_data = True
-else:
-    sp500_list = pd.read_csv(consolidated_prices_folder + '/download_log.csv')
-    
-    if args.sector: 
-        sublist = sp500_list[sp500_list['GICS Sector']==args.sector]
-    else:   # all sectors
-        sublist = sp500_list
-        
-    if args.sample_size:
-        sublist = sublist.sample(args.sample_size)
-
-    symbols = list(sublist['Symbol'].values)
-
-if args.statement == 'income_statement':
-    subfolder = 'income_statements'
-    av_function = 'INCOME_STATEMENT'
-    file_suffix = 'IS'
-elif args.statement == 'balance_sheet':
-    subfolder = 'balance_sheets'
-    av_function = 'BALANCE_SHEET'
-    file_suffix = 'BS'
-else:   # This is the only other possibility because argparser already restritics the -
-        # choices and produces error if user gives something outside that
-    subfolder = 'cashflow_statements'
-    av_function = 'CASH_FLOW' 
-    file_suffix = 'CF'
-    
-# Main code
-count = 0 
-curr_t = datetime.now()
-for symbol in tqdm(symbols, desc='Progress'):
+# statement -> (subfolder, Alpha Vantage function, file suffix)
+STATEMENTS = {'income_statement': ('income_statements', 'INCOME_STATEMENT', 'IS'),
+              'balance_sheet': ('balance_sheets', 'BALANCE_SHEET', 'BS'),
+              'cashflow': ('cashflow_statements', 'CASH_FLOW', 'CF')}
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_request_times = deque(maxlen=AV_REQ_PER_MIN) # Times of the most recent requests, for rate limiting
+_rate_lock = threading.Lock() # Fetch stages of a pipeline (see valuation_crawler) may run in several threads
+
+
+# av_get -------------------------------------------------------------------------------------------------
+#   Sends a query to Alpha Vantage through the shared session, after waiting as long as needed to stay
+#   within Alpha Vantage's per minute limit (shared by all the threads of the process). Returns the decoded json
+# ------------------------------------------------------------------------------------------------------
+def av_get(query_params):
+    with _rate_lock:
+        if len(_request_times) == AV_REQ_PER_MIN:
+            wait = 60 - (time.monotonic() - _request_times[0])
+            if wait > 0:
+                with stage('rate limit wait'):
+                    time.sleep(wait)
+        _request_times.append(time.monotonic())
+    count('av_get', 'api calls')
+    with stage('av_get'):
+        return(session.get(AV_URL, params=query_params).json())
+
+
+# statement_filenames ------------------------------------------------------------------------------------
+#   Returns the names of the files in which annual and quarterly statements of a symbol are stored
+# ------------------------------------------------------------------------------------------------------
+def statement_filenames(symbol, kind):
+    subfolder, av_function, file_suffix = STATEMENTS[kind]
     annual_stmt_filename = consolidated_prices_folder + '/' + subfolder + '/' + symbol + '_annual' + '_' + file_suffix + '.csv'
     quart_stmt_filename = consolidated_prices_folder + '/' + subfolder + '/' + symbol + '_quarterly' + '_' + file_suffix + '.csv'
+    return(annual_stmt_filename, quart_stmt_filename)
+
+
+# Converts the numbers (which Alpha Vantage sends as strings) in a statement to numbers
+def _to_numeric(statement):
+    numeric_columns = statement.columns.drop('reportedCurrency', errors='ignore')
+    statement[numeric_columns] = statement[numeric_columns].apply(pd.to_numeric, errors='coerce')
+    return(statement)
+
+
+# fetch_statement ----------------------------------------------------------------------------------------
+#   Downloads annual and quarterly versions of one statement of a symbol, stores them in files and returns
+#   them
+#
+# Inputs:
+#   symbol: Ticker symbol
+#   kind: 'income_statement', 'balance_sheet' or 'cashflow'
+#   update_data: If False and the statement was downloaded before, the stored files are returned instead
+#   retries: Number of times to try again when Alpha Vantage's limit is reached
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure', and 'annual' and 'quarterly' dataframes indexed by fiscalDateEnding
+# ------------------------------------------------------------------------------------------------------
+@profiled()
+def fetch_statement(symbol, kind, update_data=True, retries=1):
+    response = dict.fromkeys({'result', 'reason for failure', 'annual', 'quarterly'})
+    response['result'] = 'failure'
+
+    if kind not in STATEMENTS:
+        response['reason for failure'] = 'Invalid statement. Valid inputs are <income_statement>, <balance_sheet> or <cashflow>'
+        return(response)
+
+    annual_stmt_filename, quart_stmt_filename = statement_filenames(symbol, kind)
+    if (not update_data) and os.path.exists(annual_stmt_filename): # if file already exists and forceful update is not enabled,
+                                                                   # use the stored files. It is enough to check if annual
+                                                                   # statement exists - quarterly can be safely assumed to exist if annual does
+        response['annual'] = pd.read_csv(annual_stmt_filename, index_col='fiscalDateEnding')
+        response['quarterly'] = pd.read_csv(quart_stmt_filename, index_col='fiscalDateEnding')
+        count('fetch_statement', 'cache hits')
+        count_file('fetch_statement', annual_stmt_filename)
+        count_file('fetch_statement', quart_stmt_filename)
+        response['result'] = 'success'
+        return(response)
+
+    count('fetch_statement', 'cache misses')
+    query_params = { "function": STATEMENTS[kind][1], "symbol": symbol, "apikey": AV_KEY}
+    for attempt in range(retries+1):
+        try:
+            av_response = av_get(query_params)
+        except Exception as e:
+            time.sleep(60)
+            response['reason for failure'] = 'Error while downloading ' + kind + ' of ' + symbol + ': ' + str(e)
+            return(response)    # We will lose the current symbol, but that is fine
+
+        # Error checks
+        if not av_response: #If there is no response
+            response['reason for failure'] = 'Empty response received for ' + symbol
+            return(response)
+
+        if 'Note' in av_response or 'Information' in av_response: # Alpha Vantage limit reached. Wait and try again
+            print(av_response)
+            response['reason for failure'] = 'Alpha Vantage limit reached'
+            time.sleep(60)
+            continue
+        break
+    else:
+        return(response)
+
+    if 'annualReports' not in av_response:
+        response['reason for failure'] = 'Unexpected response received for ' + symbol + ': ' + str(av_response)[:200]
+        return(response)
+
+    statement_annual = pd.DataFrame(av_response['annualReports'])
+    statement_quart = pd.DataFrame(av_response['quarterlyReports'])
 
-    if (not args.update_data) and os.path.exists(annual_stmt_filename): # if file already exists and 
-                                                                        # forceful update is not enabled, skip to next symbol 
-        continue        # It is enough to check if annual statement exists - quarterly can be safely assumed to exist if annual does
-
-    query_params = { "function": av_function, "symbol": symbol, "apikey": AV_KEY}
-    
-    try:
-        response = (requests.get(AV_URL, params=query_params)).json()
-    except Exception as e:
-        time.sleep(60)
-        continue    # We will lose the current symbol, but that is fine
-        
-    # Error checks
-    if not response: #If there is no response 
-        print('Empty response received for ', symbol)
-        continue
-
-    if 'Note' in response: # This shouldn't happen. But we double check
-        print(response)
-        time.sleep(60)
-        continue    # We will lose the current symbol, but that is fine 
-        
-    statement_annual = pd.DataFrame(response['annualReports'])
-    statement_quart = pd.DataFrame(response['quarterlyReports'])
-    
-    #statement_annual['fiscalDateEnding'] = pd.to_datetime(bl_sheet_annual['fiscalDateEnding'])
     statement_annual.set_index('fiscalDateEnding', inplace=True)
     statement_quart.set_index('fiscalDateEnding', inplace=True)
 
     statement_annual.replace({'None':None}, inplace=True) # This will ensure that 'None' is stored as an empty cell
     statement_quart.replace({'None':None}, inplace=True)
-    
+
     statement_annual.to_csv(annual_stmt_filename)
     statement_quart.to_csv(quart_stmt_filename)
-    
-    count = count+1
-    if (datetime.now()-curr_t).total_seconds() < 60 and count%5 == 0: # Alpha vantage limit is 5 req per min
-        time.sleep(60 - (datetime.now()-curr_t).total_seconds())
-        curr_t = datetime.now()
 
-    
+    response['annual'] = _to_numeric(statement_annual)
+    response['quarterly'] = _to_numeric(statement_quart)
+    response['reason for failure'] = None
+    response['result'] = 'success'
+    return(response)
+
+
+# fetch_all ----------------------------------------------------------------------------------------------
+#   Downloads several statements of several symbols
+#
+# Inputs:
+#   symbols: List of ticker symbols
+#   kinds: List of statements (see fetch_statement)
+#   update_data: See fetch_statement
+#   progress: Shows a progress bar if True
+#
+# Outputs:
+#   A dict (symbol, kind) -> fetch_statement response
+# ------------------------------------------------------------------------------------------------------
+def fetch_all(symbols, kinds=('balance_sheet', 'income_statement', 'cashflow'), update_data=True, progress=False):
+    responses = {}
+    for symbol in tqdm(symbols, desc='Progress', disable=not progress):
+        for kind in kinds:
+            responses[(symbol, kind)] = fetch_statement(symbol, kind, update_data)
+    return(responses)
+
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    msg = "Downloads financial statements"
+    parser = argparse.ArgumentParser(description=msg)
+    parser.add_argument('-t', '--ticker', help="ticker symbol")
+    parser.add_argument('-s', '--sector', help="GICS sector exactly as given in Wikipedia - List_of S&P 500 companies")
+    parser.add_argument('-r', '--sample_size', help='Sample size. If not supplied, all pertinent stocks will be taken into consideration', type=int)
+    help_text = """Forcefully update non-price data (Ex. net income). If not supplied, preexising (possibly outdated)
+                   data will be used when available """
+    parser.add_argument('-f', '--update_data', help=help_text)
+    parser.add_argument('statement', help="income_statement or balance_sheet or cashflow", choices=['income_statement', 'balance_sheet', 'cashflow'])
+
+    args = parser.parse_args()
+    if args.ticker:                 # If the user explicityly gives ticker symbol, then sector, update_data, sample_size are irrelevant
+        symbols = list()
+        symbols.append(args.ticker)
+        args.update_data = True
+    else:
+        sp500_list = pd.read_csv(consolidated_prices_folder + '/download_log.csv')
+
+        if args.sector:
+            sublist = sp500_list[sp500_list['GICS Sector']==args.sector]
+        else:   # all sectors
+            sublist = sp500_list
+
+        if args.sample_size:
+            sublist = sublist.sample(args.sample_size)
+
+        symbols = list(sublist['Symbol'].values)
+
+    # Main code
+    responses = fetch_all(symbols, [args.statement], update_data=bool(args.update_data), progress=True)
+    for (symbol, kind), response in responses.items():
+        if response['result'] == 'failure':
+            print(response['reason for failure'])
@@ -0,0 +1,145 @@
+# failure_cache.py ---------------------------------------------------------------------------------------------------------------
+#   Negative cache of valuation failures, in the failure_cache table of the results database (see results_store and work_queue).
+# Many companies fail every crawl for reasons that only new statements can change (Ex. 'Too few years for computing changeinwc',
+# 'This company has too many negative ROICs'), and each retry costs three statement downloads and an OVERVIEW request. So every
+# failure is stored with a reason code (see FAILURE_CODES), the signature of the statements that produced it (see
+# work_queue.statements_info) and an expiry date, TTL days (which depend on the reason) after the failure.
+#
+#   While a failure is live (not expired and the locally stored statements are still the ones that produced it), the crawler
+# leaves the company out of the crawl, and skips it if it is crawled anyway and its downloaded statements are unchanged. Once the
+# failure expires, the company is valued again even if its statements are the same, as the reason may have gone away with new
+# rates, prices or reference data; the new outcome replaces or clears the failure. Transient failures (Ex. 'Alpha Vantage limit
+# reached') have a TTL of 0, so they are retried on the next crawl
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+import sqlite3
+from datetime import date, timedelta
+
+# Parameters
+failures_db = '/home/dinesh/Documents/Valuations/usa/valuations.db'
+
+# (reason code, start of the reason for failure, TTL days)
+FAILURE_CODES = [('too_few_years', 'Too few years for computing changeinwc', 365),
+                 ('short_history', 'We do not have enough historic data to go about', 365),
+                 ('cyclical', 'Cyclical company', 365),
+                 ('dates_mismatch', "Dates on financial statements aren't matching", 182),
+                 ('negative_rnd', 'R&D expense cannot be negative', 182),
+                 ('negative_invested_capital', 'Invested capital is negative sometimes', 182),
+                 ('negative_roics', 'This company has too many negative ROICs', 182),
+                 ('high_reinvestment', 'Reinvestment rate more than 100%', 182),
+                 ('negative_interest', 'Interest expense cannot be negative', 182),
+                 ('bad_interest_coverage', 'Bad interest coverage ratios', 182),
+                 ('negative_fcff', 'Negative FCFF for base year', 91), # Depends on the risk free rate too
+                 ('no_industry_beta', 'Industry not found in beta table', 30), # Until the reference data is updated
+                 ('no_statements', 'Unexpected error while trying to open', 1),
+                 ('empty_overview', 'Empty response while trying to get overview', 1),
+                 ('av_limit', 'Alpha Vantage limit reached', 0),
+                 ('no_rates', 'No risk free rate', 0),
+                 ('unexpected', 'Unexpected error while valuing', 0)]
+OTHER_CODE = 'other'
+OTHER_TTL_DAYS = 0
+TTL_DAYS = dict([(code, ttl) for code, prefix, ttl in FAILURE_CODES] + [(OTHER_CODE, OTHER_TTL_DAYS)])
+
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS "failure_cache" (
+                 "symbol"            TEXT,
+                 "code"              TEXT,
+                 "reason"            TEXT,
+                 "statements"        TEXT,
+                 "latest_statement"  TEXT,
+                 "failed_on"         TEXT,
+                 "expires"           TEXT,
+                 PRIMARY KEY("symbol")
+             )''',
+          'CREATE INDEX IF NOT EXISTS "failure_cache_code" ON "failure_cache"("code")']
+
+
+def _connect(filename=None):
+    filename = failures_db if filename is None else filename
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    connection = sqlite3.connect(filename, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    with connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+    return(connection)
+
+
+# failure_code -------------------------------------------------------------------------------------------------------------------
+#   Reason code of a reason for failure. Reasons that match none of FAILURE_CODES get OTHER_CODE
+# --------------------------------------------------------------------------------------------------------------------------------
+def failure_code(reason):
+    reason = '' if reason is None else str(reason)
+    for code, prefix, ttl in FAILURE_CODES:
+        if reason.startswith(prefix):
+            return(code)
+    return(OTHER_CODE)
+
+
+# record_failures ----------------------------------------------------------------------------------------------------------------
+#   Stores a batch of failures in one transaction, replacing the earlier failures of the same companies
+#
+# Inputs:
+#   rows: List of dicts with 'symbol', 'reason for failure', and optionally 'statements' and 'latest statement' (see
+#         work_queue.statements_info)
+# --------------------------------------------------------------------------------------------------------------------------------
+def record_failures(rows, filename=None):
+    if len(rows) == 0:
+        return
+    today = date.today()
+    records = []
+    for row in rows:
+        code = failure_code(row['reason for failure'])
+        records.append((row['symbol'], code, row['reason for failure'], row.get('statements'), row.get('latest statement'),
+                        str(today), str(today + timedelta(days=TTL_DAYS[code]))))
+    connection = _connect(filename)
+    try:
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO failure_cache VALUES (?, ?, ?, ?, ?, ?, ?)', records)
+    finally:
+        connection.close()
+
+
+# Forgets the failures of companies (Ex. that have been valued successfully)
+def clear_failures(symbols, filename=None):
+    if len(symbols) == 0:
+        return
+    connection = _connect(filename)
+    try:
+        with connection:
+            connection.executemany('DELETE FROM failure_cache WHERE symbol = ?', [(symbol,) for symbol in symbols])
+    finally:
+        connection.close()
+
+
+# failure_table ------------------------------------------------------------------------------------------------------------------
+#   Returns the cached failures as a dataframe indexed by symbol with 'code', 'reason', 'statements', 'latest_statement',
+#   'failed_on', 'expires' and 'expired' (True from the expiry date on) columns
+# --------------------------------------------------------------------------------------------------------------------------------
+def failure_table(filename=None):
+    connection = _connect(filename)
+    try:
+        failures_df = pd.read_sql_query('SELECT * FROM failure_cache', connection, index_col='symbol')
+    finally:
+        connection.close()
+    failures_df['expired'] = (failures_df['expires'] <= str(date.today())).to_numpy(dtype=bool)
+    return(failures_df)
+
+
+# cached_failure -----------------------------------------------------------------------------------------------------------------
+#   Returns the cached failure of a company as a dict with the columns of failure_table, or None
+# --------------------------------------------------------------------------------------------------------------------------------
+def cached_failure(symbol, filename=None):
+    connection = _connect(filename)
+    try:
+        row = connection.execute('SELECT code, reason, statements, latest_statement, failed_on, expires FROM failure_cache '
+                                 'WHERE symbol = ?', (symbol,)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return(None)
+    failure = dict(zip(['code', 'reason', 'statements', 'latest_statement', 'failed_on', 'expires'], row))
+    failure['expired'] = failure['expires'] <= str(date.today())
+    return(failure)
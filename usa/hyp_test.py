@@ -16,6 +16,7 @@ import sys
 import errno
 from tqdm import tqdm, trange
 import argparse
+from query_client import close_prices
 
 # Parse command line arguments
 msg = "Performs hypothesis testing for a number of investment related hypotheses using data of SP500 companies"
@@ -70,7 +71,9 @@ if args.hyp_num == 1 or args.hyp_num == 2:
             inc_stmt_annual = inc_stmt_annual.loc[inc_stmt_annual.index > pd.to_datetime(args.begin_year)]
         
         prices_filename = consolidated_prices_folder + '/' + symbol + '.csv'
-        prices = pd.read_csv(prices_filename, index_col=0, parse_dates=True)
+        prices = close_prices(symbol) # From the warm query service if it is running (see query_service)
+        if prices is None:
+            prices = pd.read_csv(prices_filename, index_col=0, parse_dates=True)
         prices_yearly = prices['Close'].resample('Y').mean()                    # Calculate PE ratios
 
         idx = list(map(lambda x: prices_yearly.index.get_loc(str(x), method='nearest'), inc_stmt_annual.index.values)) # Because dates don't match exactly between
@@ -0,0 +1,156 @@
+# industry_aggregates.py ---------------------------------------------------------------------------------------------------------
+#   Industry level targets for the fade model. value_company ramps every company down to the same steady state ROIC (10%), while
+# what a company can sustain in the long run really depends on its industry. This module aggregates the fundamentals panel by
+# prof. Damodaran's industry (as given in indname) into medians and percentiles of ROIC, reinvestment rate, margins and interest
+# coverage.
+#
+#   Per company metrics are computed with the same math as value_company (see dcf_valuation.statement_state) and stored along
+# with the fingerprint of the fundamentals they came from, so a refresh only recomputes companies whose statements changed and
+# only re-aggregates the industries they belong to. Both tables are persisted in aggregates_folder, and lookups are served from
+# an in-memory dict
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+
+from dcf_valuation import statement_state, statement_fingerprint
+from reference_data import get_reference_data
+
+# Parameters
+aggregates_folder = '/home/dinesh/Documents/Valuations/usa/industry_aggregates'
+company_metrics_file = 'company_metrics.pkl'
+industry_file = 'industry_aggregates.csv'
+indname_file = '/home/dinesh/Documents/Valuations/adamodaran/indname.xlsx'
+METRICS = ['roic', 'rir', 'operating_margin', 'net_margin', 'int_cov_ratio']
+PERCENTILES = {'p25': 0.25, 'median': 0.5, 'p75': 0.75}
+
+_tables = {} # In-process memo. 'company' -> company metrics dataframe, 'industry' -> aggregates, 'lookup' -> {industry: {...}}
+
+
+# industry_map -------------------------------------------------------------------------------------------------------------------
+#   Reads indname and returns a pandas series symbol -> industry for the companies listed in US exchanges
+# --------------------------------------------------------------------------------------------------------------------------------
+def industry_map():
+    indname_df = pd.read_excel(indname_file).fillna('')
+    us_stocks = indname_df[indname_df['Exchange:Ticker'].str.contains("Nasdaq|NYSE")]
+    symbols = us_stocks['Exchange:Ticker'].str.split(':').str[1]
+    return(pd.Series(us_stocks['Industry Group'].to_numpy(), index=symbols.to_numpy(), name='Industry'))
+
+
+# company_metrics ----------------------------------------------------------------------------------------------------------------
+#   Computes the metrics of one company from its fundamentals. ROIC, reinvestment rate and interest coverage ratio are the ones
+#   value_company would use (NaN if value_company would fail before getting to them). Margins are averages over the same (up to 5)
+#   years, with R&D capitalized
+# --------------------------------------------------------------------------------------------------------------------------------
+def company_metrics(fundamentals, tax):
+    state = statement_state(fundamentals, tax)
+    metrics = dict.fromkeys(METRICS, np.nan)
+    if state['result'] == 'success':
+        metrics.update({'roic': state['roic'], 'rir': state['rir'], 'int_cov_ratio': state['int_cov_ratio']})
+        fundamentals = state['fundamentals']
+    years = fundamentals.iloc[:5]
+    revenue = years['revenue'].where(years['revenue'] > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics['operating_margin'] = (years['opinc']/revenue).mean()
+        metrics['net_margin'] = (years['netinc']/revenue).mean()
+    return(metrics)
+
+
+def _load_tables():
+    if 'company' in _tables:
+        return
+    filename = aggregates_folder + '/' + company_metrics_file
+    if os.path.exists(filename):
+        _tables['company'] = pd.read_pickle(filename)
+    else:
+        _tables['company'] = pd.DataFrame(columns=['Industry', 'fingerprint'] + METRICS)
+    filename = aggregates_folder + '/' + industry_file
+    if os.path.exists(filename):
+        _tables['industry'] = pd.read_csv(filename, index_col=0)
+    else:
+        _tables['industry'] = pd.DataFrame()
+    _tables['lookup'] = _tables['industry'].to_dict(orient='index')
+
+
+# Aggregates the metrics of the companies of the given industries
+def _aggregate(company_df, industries):
+    grouped = company_df[company_df['Industry'].isin(industries)].groupby('Industry')
+    columns = {'count': grouped.size()}
+    for metric in METRICS:
+        for name, q in PERCENTILES.items():
+            columns[metric + '_' + name] = grouped[metric].quantile(q)
+    return(pd.DataFrame(columns))
+
+
+# refresh_industry_aggregates ----------------------------------------------------------------------------------------------------
+#   Brings the company metrics and industry aggregates up to date with a fundamentals panel
+#
+# Inputs:
+#   panel: Fundamentals panel indexed by (symbol, fyear), see dcf_valuation.get_fundamentals_batch
+#   industries: Optional pandas series symbol -> industry. Defaults to industry_map()
+#
+# Outputs:
+#   A dict with 'updated' (symbols whose metrics were recomputed) and 'aggregates' (dataframe indexed by industry with 'count'
+#   and <metric>_<p25|median|p75> columns)
+# --------------------------------------------------------------------------------------------------------------------------------
+def refresh_industry_aggregates(panel, industries=None):
+    _load_tables()
+    industries = industry_map() if industries is None else industries
+    tax = get_reference_data()['tax']
+    company_df = _tables['company']
+
+    updated = []
+    rows = {}
+    for symbol, fundamentals in panel.groupby(level=0, sort=False):
+        industry = industries.get(symbol)
+        if industry is None:
+            continue
+        fundamentals = fundamentals.reset_index(drop=True)
+        fingerprint = statement_fingerprint(fundamentals)
+        if symbol in company_df.index and company_df.loc[symbol, 'fingerprint'] == fingerprint \
+                                      and company_df.loc[symbol, 'Industry'] == industry:
+            continue # Statements haven't changed since the last refresh
+        metrics = company_metrics(fundamentals, tax)
+        metrics.update({'Industry': industry, 'fingerprint': fingerprint})
+        rows[symbol] = metrics
+        updated.append(symbol)
+
+    if len(rows) > 0:
+        new_df = pd.DataFrame.from_dict(rows, orient='index')[company_df.columns]
+        touched = set(new_df['Industry']) | set(company_df.loc[company_df.index.intersection(new_df.index), 'Industry'])
+        company_df = pd.concat([company_df.drop(index=company_df.index.intersection(new_df.index)), new_df])
+        company_df[METRICS] = company_df[METRICS].astype(np.float64)
+
+        industry_df = _tables['industry']
+        industry_df = pd.concat([industry_df.drop(index=industry_df.index.intersection(touched)),
+                                 _aggregate(company_df, touched)]).sort_index()
+        industry_df.index.name = 'Industry'
+
+        os.makedirs(aggregates_folder, exist_ok=True)
+        company_df.to_pickle(aggregates_folder + '/' + company_metrics_file)
+        industry_df.to_csv(aggregates_folder + '/' + industry_file)
+        _tables.update({'company': company_df, 'industry': industry_df, 'lookup': industry_df.to_dict(orient='index')})
+
+    return({'updated': updated, 'aggregates': _tables['industry']})
+
+
+# industry_target ----------------------------------------------------------------------------------------------------------------
+#   O(1) lookup of an industry aggregate
+#
+# Inputs:
+#   industry: Industry name as in indname
+#   metric: One of METRICS
+#   stat: 'median', 'p25' or 'p75'
+#   min_count: Industries with fewer companies than this are considered to have no target
+#
+# Outputs:
+#   The value, or None if there is no (reliable) target for the industry
+# --------------------------------------------------------------------------------------------------------------------------------
+def industry_target(industry, metric='roic', stat='median', min_count=5):
+    _load_tables()
+    aggregates = _tables['lookup'].get(industry)
+    if aggregates is None or aggregates['count'] < min_count:
+        return(None)
+    value = aggregates[metric + '_' + stat]
+    return(None if np.isnan(value) else value)
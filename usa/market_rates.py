@@ -0,0 +1,154 @@
+# market_rates.py ----------------------------------------------------------------------------------------------------------------
+#   Local point-in-time store of the risk free rate (10 year Treasury yield) and the equity risk premium. Asking quandl for the
+# latest yield on every valuation is slow and makes valuations as of past dates impossible, so the rates are kept in a local
+# csv file (one row per date, 'rfr' and 'erp' columns in %, a column is empty on dates it didn't change) and looked up as of a
+# date with a binary search over the sorted dates. Lookups never touch the network, so valuations work fully offline.
+#
+#   update_market_rates adds the Treasury yields published since the last stored date (and stores the whole curve for
+# yield_curve along the way) and records the ERP of the reference data whenever it changes
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+import quandl
+
+import os
+from datetime import date, timedelta
+
+from reference_data import get_reference_data
+from yield_curve import store_curve_points
+
+# Parameters
+rates_folder = '/home/dinesh/Documents/Valuations/rates'
+rates_file = 'market_rates.csv'
+RATES = ['rfr', 'erp']
+DEFAULT_RFR = 3.49              # %. Risk free rate used as of DEFAULT_RFR_DATE and later when none is stored (Ex. fresh machine
+DEFAULT_RFR_DATE = '2023-03-31' # with quandl unreachable). It is the rate value_company used to have hard-coded
+QUANDL_KEY = os.environ.get('QUANDL_API_KEY')
+
+_rates = {} # In-process memo. 'frame' -> stored dataframe, rate -> (sorted datetime64 array, values array) without empty cells
+
+
+# load_rates ---------------------------------------------------------------------------------------------------------------------
+#   Returns the stored rates as a dataframe indexed by date (sorted ascending) with RATES columns. The file is read once per
+#   process
+# --------------------------------------------------------------------------------------------------------------------------------
+def load_rates():
+    if 'frame' not in _rates:
+        filename = rates_folder + '/' + rates_file
+        if os.path.exists(filename):
+            rates_df = pd.read_csv(filename, index_col=0, parse_dates=True)
+        else:
+            rates_df = pd.DataFrame(columns=RATES, index=pd.DatetimeIndex([], name='Date'), dtype=np.float64)
+        rates_df = rates_df.reindex(columns=RATES).astype(np.float64).sort_index()
+        _rates['frame'] = rates_df
+        for rate in RATES:
+            series = rates_df[rate].dropna()
+            _rates[rate] = (series.index.to_numpy(dtype='datetime64[ns]'), series.to_numpy())
+    return(_rates['frame'])
+
+
+# store_rates --------------------------------------------------------------------------------------------------------------------
+#   Adds rates to the local store. Values given for dates that are already stored replace the stored ones, empty values don't
+#
+# Inputs:
+#   rates_df: Dataframe indexed by date with 'rfr' and/or 'erp' columns (%)
+# --------------------------------------------------------------------------------------------------------------------------------
+def store_rates(rates_df):
+    rates_df = rates_df.reindex(columns=RATES).astype(np.float64)
+    rates_df.index = pd.to_datetime(rates_df.index)
+    stored = load_rates()
+    rates_df = rates_df.combine_first(stored).sort_index()
+    rates_df.index.name = 'Date'
+
+    os.makedirs(rates_folder, exist_ok=True)
+    rates_df.to_csv(rates_folder + '/' + rates_file)
+    _rates.clear()
+    return(load_rates())
+
+
+# rates_as_of --------------------------------------------------------------------------------------------------------------------
+#   Looks up the latest stored rfr and erp on or before each of the given dates
+#
+# Inputs:
+#   dates: Array-like of dates
+#
+# Outputs:
+#   A dict with 'rfr' and 'erp' arrays (%), NaN where nothing is stored on or before the date
+# --------------------------------------------------------------------------------------------------------------------------------
+def rates_as_of(dates):
+    load_rates()
+    dates = pd.to_datetime(pd.Series(np.asarray(dates).ravel())).to_numpy(dtype='datetime64[ns]')
+    response = {}
+    for rate in RATES:
+        rate_dates, values = _rates[rate]
+        if values.shape[0] == 0:
+            response[rate] = np.full(dates.shape[0], np.nan)
+            continue
+        position = np.searchsorted(rate_dates, dates, side='right') - 1
+        response[rate] = np.where(position >= 0, values[np.maximum(position, 0)], np.nan)
+    return(response)
+
+
+# get_rates ----------------------------------------------------------------------------------------------------------------------
+#   Returns the rates to value a company with as of a date
+#
+# Inputs:
+#   as_of: Optional date. Defaults to today
+#
+# Outputs:
+#   A dict with 'rfr' and 'erp' (%, erp is None if no ERP is stored as of the date) and the dates they were stored on ('rfr date',
+#   'erp date'). If no rfr is stored as of the date, DEFAULT_RFR is returned (with DEFAULT_RFR_DATE as its date) for dates from
+#   DEFAULT_RFR_DATE on, and a ValueError is raised for older ones
+# --------------------------------------------------------------------------------------------------------------------------------
+def get_rates(as_of=None):
+    load_rates()
+    as_of = np.datetime64(pd.Timestamp(date.today() if as_of is None else as_of), 'ns')
+    response = {}
+    for rate in RATES:
+        rate_dates, values = _rates[rate]
+        position = np.searchsorted(rate_dates, as_of, side='right') - 1
+        response[rate] = values[position].item() if position >= 0 else None
+        response[rate + ' date'] = pd.Timestamp(rate_dates[position]).date() if position >= 0 else None
+    if response['rfr'] is None and as_of >= np.datetime64(pd.Timestamp(DEFAULT_RFR_DATE), 'ns'):
+        response['rfr'], response['rfr date'] = DEFAULT_RFR, pd.Timestamp(DEFAULT_RFR_DATE).date()
+    if response['rfr'] is None:
+        raise ValueError('No risk free rate stored in ' + rates_folder + '/' + rates_file + ' as of ' + str(pd.Timestamp(as_of).date()) +
+                         '. Run market_rates.update_market_rates() (needs quandl) or add rates with market_rates.store_rates()')
+    return(response)
+
+
+# update_market_rates ------------------------------------------------------------------------------------------------------------
+#   Brings the store up to date. 10 year Treasury yields are requested from quandl only for the dates after the last stored one
+#   (the full curve of those dates is added to the yield_curve store too), and the ERP of the reference data is recorded as of
+#   today if it differs from the last stored one. When quandl can't be reached, the store is left as it is
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure' and 'new dates' (number of new Treasury yield dates)
+# --------------------------------------------------------------------------------------------------------------------------------
+def update_market_rates():
+    response = {'result': 'failure', 'reason for failure': None, 'new dates': 0}
+    load_rates()
+    updates = []
+
+    rfr_dates = _rates['rfr'][0]
+    start_date = None if rfr_dates.shape[0] == 0 else (pd.Timestamp(rfr_dates[-1]) + timedelta(days=1)).date()
+    try:
+        points = quandl.get('USTREASURY/YIELD', start_date=start_date, api_key=QUANDL_KEY)
+    except Exception as e:
+        response['reason for failure'] = 'Could not download Treasury yields: ' + str(e)
+        points = None
+    if points is not None and points.shape[0] > 0:
+        store_curve_points(points)
+        updates.append(pd.DataFrame({'rfr': points['10 YR']}).dropna())
+        response['new dates'] = int(updates[-1].shape[0])
+
+    erp = get_reference_data()['erp']
+    stored_erps = _rates['erp'][1]
+    if stored_erps.shape[0] == 0 or stored_erps[-1] != erp:
+        updates.append(pd.DataFrame({'erp': [erp]}, index=pd.DatetimeIndex([pd.Timestamp(date.today())])))
+
+    if len(updates) > 0:
+        store_rates(pd.concat(updates).groupby(level=0).first()) # rfr and erp of the same date go in one row
+    if response['reason for failure'] is None:
+        response['result'] = 'success'
+    return(response)
@@ -0,0 +1,181 @@
+# market_snapshot.py -------------------------------------------------------------------------------------------------------------
+#   Local market snapshot of the valuation universe, so that value_company doesn't have to spend an Alpha Vantage OVERVIEW
+# request (5 per minute) on the share price and market cap of every company. The 50 day moving average of every symbol comes
+# from its locally downloaded daily prices (<consolidated_prices_folder>/<symbol>.csv): the last MA_DAYS closes of all the
+# symbols are packed into one (symbols x MA_DAYS) array and averaged in one pass. The number of shares comes from the latest
+# quarterly balance sheet, so market cap is latest close x shares.
+#
+#   A symbol is re-read only when its price file or balance sheet changes (size and mtime are remembered), so refreshing the
+# snapshot of the whole universe is cheap. The OVERVIEW fields that can't be derived locally (company name, analyst target, PE)
+# are cached per symbol, one row per symbol in the overview_cache table of the results database (see results_store), and
+# requested again only after OVERVIEW_TTL_DAYS. Storing one costs one row whatever the size of the cache, and processes that
+# store overviews at the same time (Ex. the crawler and value_company calls from other scripts) don't overwrite each other
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+import sqlite3
+from datetime import date, timedelta
+
+# Parameters
+consolidated_prices_folder = '/home/dinesh/Documents/security_prices/usa'
+snapshot_folder = '/home/dinesh/Documents/Valuations/usa/market'
+snapshot_file = 'market_snapshot.pkl'
+overviews_db = '/home/dinesh/Documents/Valuations/usa/valuations.db'
+MA_DAYS = 50
+MAX_STALE_DAYS = 7 # Snapshots whose latest close is older than this are not used
+OVERVIEW_TTL_DAYS = 30
+OVERVIEW_FIELDS = ['Name', 'AnalystTargetPrice', 'PERatio']
+
+_cache = {} # In-process memo. 'snapshot' -> dataframe indexed by symbol
+
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS "overview_cache" (
+                 "symbol"              TEXT,
+                 "fetched_on"          TEXT,
+                 "Name"                TEXT,
+                 "AnalystTargetPrice"  TEXT,
+                 "PERatio"             TEXT,
+                 PRIMARY KEY("symbol")
+             )''']
+
+
+def _file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return(None)
+    return((stat.st_size, stat.st_mtime_ns))
+
+
+def _source_files(symbol):
+    return(consolidated_prices_folder + '/' + symbol + '.csv',
+           consolidated_prices_folder + '/balance_sheets/' + symbol + '_quarterly_BS.csv')
+
+
+# Last MA_DAYS closes (oldest first), date of the last close and latest number of shares of a symbol
+def _read_symbol(symbol):
+    price_file, bsheet_file = _source_files(symbol)
+    closes, last_date, shares = np.array([]), pd.NaT, np.nan
+    try:
+        prices = pd.read_csv(price_file, index_col=0, parse_dates=True)['Close'].dropna().sort_index()
+        closes = prices.to_numpy(dtype=np.float64)[-MA_DAYS:]
+        last_date = prices.index[-1] if prices.shape[0] > 0 else pd.NaT
+    except Exception as e:
+        pass
+    try:
+        bsheet = pd.read_csv(bsheet_file, usecols=['fiscalDateEnding', 'commonStockSharesOutstanding'], nrows=1)
+        shares = pd.to_numeric(bsheet['commonStockSharesOutstanding'], errors='coerce').iloc[0]
+    except Exception as e:
+        pass
+    return(closes, last_date, shares)
+
+
+def load_market_snapshot():
+    if 'snapshot' not in _cache:
+        filename = snapshot_folder + '/' + snapshot_file
+        if os.path.exists(filename):
+            _cache['snapshot'] = pd.read_pickle(filename)
+        else:
+            _cache['snapshot'] = pd.DataFrame(columns=['date', 'close', 'ma', 'shares', 'mv_equity', 'signature'])
+    return(_cache['snapshot'])
+
+
+# build_market_snapshot ----------------------------------------------------------------------------------------------------------
+#   Brings the snapshot of the given symbols up to date and persists it. Symbols whose source files didn't change are not re-read
+#
+# Inputs:
+#   symbols: List of ticker symbols
+#
+# Outputs:
+#   The snapshot, a dataframe indexed by symbol with 'date' (of the latest close), 'close', 'ma' (MA_DAYS moving average, NaN if
+#   there are fewer closes), 'shares', 'mv_equity' (Millions of $) and 'signature' (of the source files)
+# --------------------------------------------------------------------------------------------------------------------------------
+def build_market_snapshot(symbols):
+    snapshot = load_market_snapshot()
+    signatures = dict([(symbol, tuple(_file_signature(f) for f in _source_files(symbol))) for symbol in symbols])
+    stale = [symbol for symbol in symbols
+             if symbol not in snapshot.index or snapshot.at[symbol, 'signature'] != signatures[symbol]]
+    if len(stale) == 0:
+        return(snapshot)
+
+    windows = np.full((len(stale), MA_DAYS), np.nan) # Last MA_DAYS closes of every symbol, right aligned
+    last_dates, shares = [], np.empty(len(stale))
+    for i, symbol in enumerate(stale):
+        closes, last_date, shares[i] = _read_symbol(symbol)
+        windows[i, MA_DAYS - closes.shape[0]:] = closes
+        last_dates.append(last_date)
+
+    with np.errstate(invalid='ignore'):
+        moving_averages = np.where(np.isnan(windows).any(axis=1), np.nan, windows.mean(axis=1))
+    closes = windows[:, -1]
+    new_df = pd.DataFrame({'date': last_dates, 'close': closes, 'ma': moving_averages, 'shares': shares,
+                           'mv_equity': closes*shares/1E6, 'signature': [signatures[symbol] for symbol in stale]}, index=stale)
+
+    snapshot = pd.concat([snapshot.drop(index=snapshot.index.intersection(stale)), new_df])
+    os.makedirs(snapshot_folder, exist_ok=True)
+    snapshot.to_pickle(snapshot_folder + '/' + snapshot_file)
+    _cache['snapshot'] = snapshot
+    return(snapshot)
+
+
+# market_data --------------------------------------------------------------------------------------------------------------------
+#   O(1) lookup of the market data of a symbol
+#
+# Outputs:
+#   A dict with 'price' (MA_DAYS moving average, as value_company uses), 'close', 'mv_equity' (Millions of $), 'shares' and
+#   'date', or None if the symbol isn't in the snapshot, its prices are stale or something is missing
+# --------------------------------------------------------------------------------------------------------------------------------
+def market_data(symbol):
+    snapshot = load_market_snapshot()
+    if symbol not in snapshot.index:
+        return(None)
+    row = snapshot.loc[symbol]
+    if pd.isna(row['date']) or row['date'] < pd.Timestamp(date.today() - timedelta(days=MAX_STALE_DAYS)):
+        return(None)
+    if not (row['ma'] > 0 and row['shares'] > 0):
+        return(None)
+    return({'price': row['ma'], 'close': row['close'], 'mv_equity': row['mv_equity'], 'shares': row['shares'],
+            'date': row['date'].date()})
+
+
+def _connect(filename=None):
+    filename = overviews_db if filename is None else filename
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    connection = sqlite3.connect(filename, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    with connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+    return(connection)
+
+
+# cached_overview ----------------------------------------------------------------------------------------------------------------
+#   Returns the cached OVERVIEW_FIELDS of a symbol (strings, as Alpha Vantage sends them) along with the 'date' they were fetched
+#   on, or None if they aren't cached or are older than OVERVIEW_TTL_DAYS
+# --------------------------------------------------------------------------------------------------------------------------------
+def cached_overview(symbol, filename=None):
+    connection = _connect(filename)
+    try:
+        oldest = str(date.today() - timedelta(days=OVERVIEW_TTL_DAYS))
+        row = connection.execute('SELECT fetched_on, ' + ', '.join(OVERVIEW_FIELDS) + ' FROM overview_cache '
+                                 'WHERE symbol = ? AND fetched_on >= ?', (symbol, oldest)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return(None)
+    return(dict([('date', date.fromisoformat(row[0]))] + list(zip(OVERVIEW_FIELDS, row[1:]))))
+
+
+# store_overview -----------------------------------------------------------------------------------------------------------------
+#   Caches the OVERVIEW_FIELDS of an OVERVIEW response, replacing the earlier ones of the symbol
+# --------------------------------------------------------------------------------------------------------------------------------
+def store_overview(symbol, overview, filename=None):
+    values = [overview.get(field) for field in OVERVIEW_FIELDS]
+    connection = _connect(filename)
+    try:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO overview_cache VALUES (?, ?' + ', ?'*len(OVERVIEW_FIELDS) + ')',
+                               [symbol, str(date.today())] + [None if value is None else str(value) for value in values])
+    finally:
+        connection.close()
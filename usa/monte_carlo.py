@@ -0,0 +1,70 @@
+# monte_carlo.py -----------------------------------------------------------------------------------------------------------------
+#   Monte Carlo mode of the DCF valuation. value_company gives a point estimate per (ssbeta, gslope) cell, but its inputs are
+# really distributions: ROIC is the geometric mean of a handful of yearly ROICs, the reinvestment rate is the average of a
+# handful of yearly rates, and erp and rfr move around. Here we sample these inputs and run the fade model for all the paths
+# at once with dcf_engine, so tens of thousands of paths per company cost a fraction of a second.
+#
+#   ROIC and reinvestment rate are bootstrapped: the yearly figures value_company averaged are resampled with replacement and
+# averaged the same way. erp and rfr are drawn from normal distributions around the values used by value_company. The cost of
+# capital is recomputed for every path as erp and rfr change
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from dcf_engine import fade_value
+from cost_of_capital import cost_of_capital
+
+
+# monte_carlo_value --------------------------------------------------------------------------------------------------------------
+#   Runs the Monte Carlo simulation for a company that has already been valued
+#
+# Inputs:
+#   result: A successful value_company result
+#   n_paths: Number of paths to simulate
+#   seed: Seed of the random number generator. Same seed, same result
+#   rfr_sd, erp_sd: Standard deviation (percentage points) of rfr and erp
+#   ssbeta, gslope, steady_state_roic: Fade model parameters. steady_state_roic defaults to the one used by value_company
+#   quantiles: Quantiles of value per share to return
+#
+# Outputs:
+#   A dict with 'quantiles' (pandas series, quantile -> value per share), 'mean', 'valid_fraction' (fraction of paths that could
+#   be valued, the rest are dropped like value_company would fail on them) and 'vps' (value per share of every path)
+# --------------------------------------------------------------------------------------------------------------------------------
+def monte_carlo_value(result, n_paths=20000, seed=0, rfr_sd=0.25, erp_sd=0.5, ssbeta=1, gslope=5, steady_state_roic=None,
+                      quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    inputs = result['inputs']
+    rng = np.random.default_rng(seed)
+    if steady_state_roic is None:
+        steady_state_roic = inputs['steady_state_roic']
+
+    # Geometric mean of bootstrapped positive ROICs
+    roics = np.asarray(inputs['roics'], dtype=np.float64)
+    roic = np.exp(np.log(rng.choice(roics, size=(n_paths, roics.shape[0]))).mean(axis=1))
+
+    # Average of bootstrapped reinvestment rates. With too few years, value_company uses 0 and so do we
+    rirs = np.asarray(inputs['rirs'], dtype=np.float64)
+    if inputs['rir_method'] == 'last 5 years' and rirs.shape[0] < 3:
+        rir = np.zeros(n_paths)
+    elif inputs['rir_method'] == 'latest year only':
+        rir = np.full(n_paths, inputs['rir'])
+    else:
+        rir = rng.choice(rirs, size=(n_paths, rirs.shape[0])).mean(axis=1)
+
+    rfr = np.maximum(rng.normal(inputs['rfr'], rfr_sd, n_paths), 0.01)
+    erp = np.maximum(rng.normal(inputs['erp'], erp_sd, n_paths), 0.01)
+    wacc = cost_of_capital(inputs['int_cov_ratio'], inputs['bv_debt'], inputs['mv_equity'], inputs['unlevered_beta'],
+                           rfr, erp, inputs['tax'])['wacc']
+
+    values = fade_value(inputs['post_tax_opinc'], inputs['reinvestment'], roic, rir, wacc, rfr, erp, inputs['cash'],
+                        inputs['bv_debt'], inputs['outstanding_shares'], ssbeta=ssbeta, gslope=gslope,
+                        steady_state_roic=steady_state_roic)
+    fcff = inputs['post_tax_opinc'] - inputs['reinvestment']
+    valid = (rir <= 1) & ~((values['case'] == 0) & (fcff < 0)) & np.isfinite(values['vps']) # Same failures as value_company
+    vps = values['vps'][valid]
+
+    mc_response = {'vps': vps, 'valid_fraction': valid.mean(), 'mean': np.nan,
+                   'quantiles': pd.Series(np.nan, index=list(quantiles), name='vps')}
+    if vps.shape[0] > 0:
+        mc_response['mean'] = vps.mean()
+        mc_response['quantiles'] = pd.Series(np.quantile(vps, quantiles), index=list(quantiles), name='vps')
+    return(mc_response)
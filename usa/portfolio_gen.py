@@ -18,11 +18,12 @@ import pandas as pd
 
 import os
 import sys
-import subprocess
 import errno
 from tqdm import tqdm, trange
 import argparse
 
+from download_statements import fetch_statement
+
 # Function definitions
 # get_bsheet ------------------------------------------------------------------------------------
 #   Checks if the file corresponding to the balance sheet in question is present and the numbers
@@ -39,7 +40,7 @@ import argparse
 def get_bsheet(security):
     filename = consolidated_prices_folder + '/balance_sheets/' + security + '_annual.csv' # the company is probably a going concern winding up   
     if not os.path.exists(filename):
-        subp_resp = subprocess.run(['python3', 'download_statements.py', '-t', security, 'balance_sheet'], capture_output=True)
+        fetch_statement(security, 'balance_sheet')
     try:
         bsheet = pd.read_csv(filename, index_col=0, parse_dates=True)
     except Exception as e:
@@ -53,7 +54,7 @@ def get_bsheet(security):
     if (isinstance(bsheet.iloc[0].retainedEarnings, str) or          
         isinstance(bsheet.iloc[0].totalCurrentAssets, str) or      
         isinstance(bsheet.iloc[0].totalCurrentLiabilities,str)) :   
-        subp_resp = subprocess.run(['python3', 'download_statements.py', '-t', security, 'balance_sheet'], capture_output=True)
+        fetch_statement(security, 'balance_sheet')
     try:
         bsheet = pd.read_csv(filename, index_col=0, parse_dates=True)
     except Exception as e:
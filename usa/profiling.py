@@ -0,0 +1,145 @@
+# profiling.py -------------------------------------------------------------------------------------------------------------------
+#   Built-in timers and counters for the stages of a crawl (statement downloads, statement parsing, OVERVIEW requests, reference
+# data reads, DCF, Excel writes). Every stage accumulates its number of calls and elapsed (wall-clock) time, and the code of a
+# stage can add to counters such as bytes read, API calls, cache hits and cache misses. Everything is kept in one in-process dict
+# and costs two perf_counter calls and a few dict updates per stage, so it can be left on in production.
+#
+#   Stages nest (Ex. 'av_get' runs within 'overview', which runs within 'value_company'), and the elapsed time of a stage includes
+# the stages within it. profile_table() returns the totals of the run so far as a dataframe and save_profile() persists them
+# next to the valuation results. Worker processes hand their totals over with take_profile and merge_profile. Updates are made
+# under a lock, as several threads (Ex. the fetch and writer threads of valuation_crawler, the threads of query_service) share
+# the totals
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from datetime import datetime
+
+# Parameters
+valuations_folder = '/home/dinesh/Documents/Valuations/usa'
+COUNTERS = ['calls', 'seconds', 'bytes read', 'api calls', 'cache hits', 'cache misses']
+enabled = True # Set to False to turn all the hooks into no-ops
+
+_profile = {} # In-process totals. stage -> {counter: value}
+_lock = threading.Lock() # Guards _profile
+
+
+def _new_lock(): # A process forked while another thread held the lock would never get it
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_new_lock)
+
+
+def _totals(name):
+    totals = _profile.get(name)
+    if totals is None:
+        totals = _profile[name] = dict.fromkeys(COUNTERS, 0)
+    return(totals)
+
+
+# stage --------------------------------------------------------------------------------------------------------------------------
+#   Context manager that times a stage. Ex. with stage('dcf'): grid = value_grid(...)
+# --------------------------------------------------------------------------------------------------------------------------------
+@contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            totals = _totals(name)
+            totals['calls'] += 1
+            totals['seconds'] += elapsed
+
+
+# profiled -----------------------------------------------------------------------------------------------------------------------
+#   Decorator version of stage. The stage name defaults to the name of the function
+# --------------------------------------------------------------------------------------------------------------------------------
+def profiled(name=None):
+    def decorator(function):
+        stage_name = function.__name__ if name is None else name
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return(function(*args, **kwargs))
+        return(wrapper)
+    return(decorator)
+
+
+# count --------------------------------------------------------------------------------------------------------------------------
+#   Adds n to a counter ('bytes read', 'api calls', 'cache hits' or 'cache misses') of a stage
+# --------------------------------------------------------------------------------------------------------------------------------
+def count(name, counter, n=1):
+    if enabled:
+        with _lock:
+            _totals(name)[counter] += n
+
+
+# Adds the size of a file that was read to the 'bytes read' counter of a stage
+def count_file(name, filename):
+    if enabled:
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        with _lock:
+            _totals(name)['bytes read'] += size
+
+
+# profile_table ------------------------------------------------------------------------------------------------------------------
+#   Returns the totals of the run so far as a dataframe indexed by stage with COUNTERS and 'ms per call' columns, slowest first
+# --------------------------------------------------------------------------------------------------------------------------------
+def profile_table():
+    with _lock:
+        totals = dict([(name, dict(counters)) for name, counters in _profile.items()])
+    profile_df = pd.DataFrame.from_dict(totals, orient='index', columns=COUNTERS)
+    profile_df.index.name = 'stage'
+    with np.errstate(divide='ignore', invalid='ignore'):
+        profile_df['ms per call'] = 1000*profile_df['seconds']/profile_df['calls'].where(profile_df['calls'] > 0)
+    return(profile_df.sort_values('seconds', ascending=False))
+
+
+def reset_profile():
+    with _lock:
+        _profile.clear()
+
+
+# take_profile -------------------------------------------------------------------------------------------------------------------
+#   Returns the totals collected so far (stage -> {counter: value}) and resets them. Used by worker processes to send their
+#   totals to the process that saves the profile (see merge_profile)
+# --------------------------------------------------------------------------------------------------------------------------------
+def take_profile():
+    with _lock:
+        totals = dict([(name, dict(counters)) for name, counters in _profile.items()])
+        _profile.clear()
+    return(totals)
+
+
+# Adds totals returned by take_profile (Ex. in another process) to the totals of this process
+def merge_profile(totals):
+    with _lock:
+        for name, counters in totals.items():
+            merged = _totals(name)
+            for counter, value in counters.items():
+                merged[counter] += value
+
+
+# save_profile -------------------------------------------------------------------------------------------------------------------
+#   Writes the profile table of the run to a csv file. filename defaults to <valuations_folder>/profile_<date>_<time>.csv
+# --------------------------------------------------------------------------------------------------------------------------------
+def save_profile(filename=None):
+    if filename is None:
+        filename = valuations_folder + '/profile_' + datetime.now().strftime('%Y%m%d_%H%M%S') + '.csv'
+    profile_table().to_csv(filename)
+    return(filename)
@@ -0,0 +1,124 @@
+# query_client.py ----------------------------------------------------------------------------------------------------------------
+#   Thin client of the warm local query service (see query_service). Only the standard library is needed to talk to the service,
+# and pandas is imported only to turn the dataframes of a response back into dataframes, so a script that asks one question
+# about one ticker doesn't pay for reading and parsing its CSVs.
+#
+#   Every function returns the response dict of the service ('result', 'reason for failure' and the figures asked for). If the
+# service isn't running, the response is a failure whose reason starts with NOT_RUNNING, so a script can fall back to reading
+# the files itself (Ex. close_prices returns None)
+# --------------------------------------------------------------------------------------------------------------------------------
+import os
+import json
+from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+
+# Parameters
+SERVICE_URL = os.environ.get('QUERY_SERVICE_URL', 'http://127.0.0.1:8765')
+TIMEOUT = 120 # Seconds. An on demand valuation may have to wait for an OVERVIEW request
+NOT_RUNNING = 'Query service not running'
+
+
+# query --------------------------------------------------------------------------------------------------------------------------
+#   Sends one query to the service
+#
+# Inputs:
+#   path: Query (Ex. '/fundamentals'), see query_service
+#   params: Query parameters. Lists are sent comma separated and None values are left out
+#
+# Outputs:
+#   The response dict, with dataframes still in 'split' orientation (see to_frame)
+# --------------------------------------------------------------------------------------------------------------------------------
+def query(path, **params):
+    params = dict([(key, ','.join(value) if isinstance(value, (list, tuple)) else value)
+                   for key, value in params.items() if value is not None])
+    url = SERVICE_URL + path + ('?' + urlencode(params) if len(params) > 0 else '')
+    try:
+        with urlopen(url, timeout=TIMEOUT) as reply:
+            return(json.loads(reply.read()))
+    except HTTPError as e: # Bad queries are answered with a failure response too
+        return(json.loads(e.read()))
+    except (URLError, ConnectionError) as e:
+        return({'result': 'failure', 'reason for failure': NOT_RUNNING + ' at ' + SERVICE_URL + ' (' + str(e) + ')'})
+
+
+def service_running():
+    return(query('/health')['result'] == 'success')
+
+
+# to_frame -----------------------------------------------------------------------------------------------------------------------
+#   Turns a dataframe (or series) of a response back into a pandas object. dates: parse the index as dates
+# --------------------------------------------------------------------------------------------------------------------------------
+def to_frame(split, dates=False):
+    import pandas as pd
+    if split is None:
+        return(None)
+    index = pd.to_datetime(split['index']) if dates else split['index']
+    if 'columns' in split:
+        return(pd.DataFrame(split['data'], index=index, columns=split['columns']))
+    return(pd.Series(split['data'], index=index, name=split.get('name')))
+
+
+# Same as dcf_valuation.get_fundamentals
+def fundamentals(symbol, base='latest quarterly'):
+    response = query('/fundamentals', symbol=symbol, base=base)
+    if response['result'] == 'success':
+        response['fundamentals'] = to_frame(response['fundamentals'])
+    return(response)
+
+
+# Daily closes of symbols, a dataframe indexed by date with one column per symbol, as 'prices'
+def prices(symbols, start=None):
+    response = query('/prices', symbols=symbols, start=start)
+    if response['result'] == 'success':
+        response['prices'] = to_frame(response['prices'], dates=True)
+    return(response)
+
+
+# close_prices -------------------------------------------------------------------------------------------------------------------
+#   Daily prices of a symbol as a dataframe laid out like its CSV file (Date index, Close column), or None if the service isn't
+#   running or has no prices for it
+# --------------------------------------------------------------------------------------------------------------------------------
+def close_prices(symbol):
+    response = prices([symbol])
+    if response['result'] == 'failure':
+        return(None)
+    prices_df = response['prices'].rename(columns={symbol.upper(): 'Close'})
+    prices_df.index.name = 'Date'
+    return(prices_df)
+
+
+def beta(symbol, industry=None, months=None):
+    return(query('/beta', symbol=symbol, industry=industry, months=months))
+
+
+# Correlation matrix of annual returns as 'correlation', with the number of samples of every pair as 'samples'
+def correlation(symbols, start=None):
+    response = query('/correlation', symbols=symbols, start=start)
+    if response['result'] == 'success':
+        response['correlation'] = to_frame(response['correlation'])
+        response['samples'] = to_frame(response['samples'])
+    return(response)
+
+
+# Latest valuation of a symbol, with its VPS matrix as 'vps'. refresh: value it again even if the service has a valuation of today
+def valuation(symbol, industry=None, refresh=False):
+    response = query('/valuation', symbol=symbol, industry=industry, refresh=1 if refresh else None)
+    response['vps'] = to_frame(response.get('vps'))
+    return(response)
+
+
+# VPS matrix of symbols (all the valuations the service has in memory if None), one row per symbol, as 'vps'
+def vps_matrix(symbols=None):
+    response = query('/vps', symbols=symbols)
+    if response['result'] == 'success':
+        response['vps'] = to_frame(response['vps'])
+    return(response)
+
+
+# Latest crawl results of symbols as 'latest'
+def latest(symbols):
+    response = query('/latest', symbols=symbols)
+    if response['result'] == 'success':
+        response['latest'] = to_frame(response['latest'])
+    return(response)
@@ -0,0 +1,440 @@
+# query_service.py ---------------------------------------------------------------------------------------------------------------
+#   Warm local query service. Every script used to start cold: import pandas, read the CSVs of the ticker it is interested in,
+# answer one question and exit. This long-running process keeps what those questions need in memory and answers them over HTTP
+# with JSON (see query_client for the client side):
+#   fundamentals   of a symbol, as computed by dcf_valuation.get_fundamentals
+#   prices         daily closes of symbols, aligned on dates (the price matrix)
+#   beta           regression beta of a symbol against BENCHMARK over the last BETA_MONTHS months, and the unlevered beta of its
+#                  industry from the reference data
+#   correlation    correlation matrix of the annual returns (at monthly granularity, as corr_mat) of symbols
+#   valuation      latest valuation of a symbol with its VPS matrix. Valued on demand (and then once a day, or when its statements
+#                  change) with the same settings as valuation_crawler
+#   vps            VPS matrix of many symbols, one row per symbol and one column per scenario (see valuation_report)
+#   latest         latest crawl results (see results_store) of symbols
+#
+#   Fundamentals, prices and valuations are kept in LRU caches of MAX_CACHED entries each. An entry remembers the size and mtime
+# of the files it was computed from and is recomputed when they change, so the service never answers with stale statements or
+# prices. The reference data, market rates and market snapshot are loaded once (see reference_data, market_rates and
+# market_snapshot) and the latest crawl results are reloaded whenever a crawl adds new ones.
+#
+#   Every answer is a JSON object with 'result' ('success' or 'failure') and 'reason for failure', like the functions of this
+# repo, plus the figures asked for. Dataframes are sent in pandas' 'split' orientation (index, columns, data).
+#
+# Usage: python query_service.py [--port PORT] [--preload N]
+#   GET /fundamentals?symbol=AAPL[&base=latest annual]
+#   GET /prices?symbols=AAPL,MSFT[&start=2015-01-01]
+#   GET /beta?symbol=AAPL[&industry=...][&months=60]
+#   GET /correlation?symbols=AAPL,MSFT,XOM[&start=2015-01-01]
+#   GET /valuation?symbol=AAPL[&industry=...][&refresh=1]
+#   GET /vps[?symbols=AAPL,MSFT]    (all the valuations in memory if no symbols are given)
+#   GET /latest?symbols=AAPL,MSFT
+#   GET /health, GET /stats
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from dcf_valuation import get_fundamentals, value_company
+from backfill import load_prices
+from reference_data import get_reference_data, unlevered_beta
+from market_rates import get_rates
+from market_snapshot import build_market_snapshot, load_market_snapshot
+from industry_aggregates import industry_target
+from valuation_report import valuation_row, valuations_table
+from failure_cache import failure_code, TTL_DAYS
+from results_store import latest_results, last_rowid
+from profiling import stage, count, profile_table
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from datetime import date, datetime
+import argparse
+
+# Parameters
+HOST = '127.0.0.1'
+PORT = 8765
+consolidated_prices_folder = '/home/dinesh/Documents/security_prices/usa'
+BENCHMARK = 'SPY'     # Symbol whose prices (<consolidated_prices_folder>/<BENCHMARK>.csv) stand for the market in betas
+BETA_MONTHS = 60      # Monthly returns a regression beta is computed on, as Yahoo finance does (see find_beta)
+MIN_BETA_MONTHS = 24  # Fewer months of returns give no beta
+CORR_MIN_MONTHS = 36  # Pairs with fewer overlapping annual returns get no correlation (see corr_mat)
+MAX_CACHED = {'fundamentals': 5000, 'prices': 5000, 'valuations': 2000} # LRU capacities
+
+_caches = dict([(name, OrderedDict()) for name in MAX_CACHED]) # In-process memo. name -> key -> (signature, value)
+_latest = {'rowid': None, 'table': None} # Latest crawl results, see latest
+_lock = threading.Lock()          # Guards the caches and the results store connection
+_compute_lock = threading.Lock()  # One valuation at a time: value_company and the market snapshot aren't thread safe
+_started = time.time()
+
+
+# Size and mtime of files (None for a missing one). Cached entries are valid as long as the signature of their files is the same
+def _file_signature(filenames):
+    signature = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+            signature.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append(None)
+    return(tuple(signature))
+
+
+def _statement_files(symbol, base='latest quarterly'):
+    period = 'annual' if base == 'latest annual' else 'quarterly'
+    return([consolidated_prices_folder + '/' + subfolder + '/' + symbol + '_' + period + '_' + suffix + '.csv'
+            for subfolder, suffix in [('balance_sheets', 'BS'), ('income_statements', 'IS'), ('cashflow_statements', 'CF')]])
+
+
+# _cached ------------------------------------------------------------------------------------------------------------------------
+#   LRU cache lookup. Returns the cached value of key if its signature is still the same, otherwise computes it with load(),
+#   caches it (evicting the least recently used entries beyond MAX_CACHED[name]) and returns it
+# --------------------------------------------------------------------------------------------------------------------------------
+def _cached(name, key, signature, load):
+    cache = _caches[name]
+    with _lock:
+        entry = cache.get(key)
+        if entry is not None and entry[0] == signature:
+            cache.move_to_end(key)
+            count('query cache ' + name, 'cache hits')
+            return(entry[1])
+    count('query cache ' + name, 'cache misses')
+    value = load() # Outside the lock, so that a slow load doesn't hold up the lookups of other threads
+    with _lock:
+        cache[key] = (signature, value)
+        cache.move_to_end(key)
+        while len(cache) > MAX_CACHED[name]:
+            cache.popitem(last=False)
+    return(value)
+
+
+def _forget(name, key):
+    with _lock:
+        _caches[name].pop(key, None)
+
+
+def _split_symbols(symbols):
+    if isinstance(symbols, str):
+        symbols = symbols.split(',')
+    return([symbol.strip().upper() for symbol in symbols if symbol.strip() != ''])
+
+
+# fundamentals -------------------------------------------------------------------------------------------------------------------
+#   Cached dcf_valuation.get_fundamentals. Recomputed when the statement files of the symbol change
+# --------------------------------------------------------------------------------------------------------------------------------
+def fundamentals(symbol, base='latest quarterly'):
+    signature = _file_signature(_statement_files(symbol, base))
+    return(_cached('fundamentals', (symbol, base), signature, lambda: get_fundamentals(symbol, base)))
+
+
+# Cached backfill.load_prices. Daily closes of a symbol sorted by date, or None
+def price_series(symbol):
+    signature = _file_signature([consolidated_prices_folder + '/' + symbol + '.csv'])
+    return(_cached('prices', symbol, signature, lambda: load_prices(symbol)))
+
+
+# price_matrix -------------------------------------------------------------------------------------------------------------------
+#   Daily closes of symbols aligned on dates
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure', 'prices' (dataframe indexed by date with one column per symbol that has prices)
+#   and 'missing' (symbols without prices)
+# --------------------------------------------------------------------------------------------------------------------------------
+def price_matrix(symbols, start=None):
+    response = {'result': 'failure', 'reason for failure': None, 'prices': None, 'missing': []}
+    series = {}
+    for symbol in _split_symbols(symbols):
+        prices = price_series(symbol)
+        if prices is None:
+            response['missing'].append(symbol)
+        else:
+            series[symbol] = prices
+    if len(series) == 0:
+        response['reason for failure'] = 'No prices available for ' + ', '.join(response['missing'])
+        return(response)
+    prices_df = pd.concat(series, axis=1).sort_index()
+    if start is not None:
+        prices_df = prices_df.loc[prices_df.index >= pd.Timestamp(start)]
+    response['result'] = 'success'
+    response['prices'] = prices_df
+    return(response)
+
+
+# Returns over periods months, computed on month end closes. Dataframe indexed by month with one column per symbol
+def monthly_returns(prices_df, periods=1):
+    return(prices_df.resample('ME').last().pct_change(periods))
+
+
+# beta ---------------------------------------------------------------------------------------------------------------------------
+#   Regression beta of a symbol against BENCHMARK over the last months monthly returns, and unlevered beta of its industry
+#
+# Inputs:
+#   industry: Industry name as in prof. Damodaran's spreadsheets. Defaults to the industry of the latest crawl result of symbol
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure', 'regression beta', 'r2', 'months', 'benchmark', 'industry' and 'unlevered beta'
+#   (None if the industry isn't known or isn't in the beta table)
+# --------------------------------------------------------------------------------------------------------------------------------
+def beta(symbol, industry=None, months=BETA_MONTHS):
+    response = {'result': 'failure', 'reason for failure': None, 'regression beta': None, 'r2': None, 'months': 0,
+                'benchmark': BENCHMARK, 'industry': None, 'unlevered beta': None}
+    industry = _industry(symbol) if industry is None else industry
+    if industry is not None:
+        response['industry'] = industry
+        response['unlevered beta'] = unlevered_beta(industry)
+
+    presponse = price_matrix([symbol, BENCHMARK])
+    if len(presponse['missing']) > 0:
+        response['reason for failure'] = 'No prices available for ' + ', '.join(presponse['missing'])
+        return(response)
+    returns_df = monthly_returns(presponse['prices']).dropna().iloc[-int(months):]
+    response['months'] = returns_df.shape[0]
+    if returns_df.shape[0] < MIN_BETA_MONTHS:
+        response['reason for failure'] = 'Too few months of overlapping prices with ' + BENCHMARK + ' for a regression beta'
+        return(response)
+
+    cov_mat = np.cov(returns_df[symbol.upper()].to_numpy(), returns_df[BENCHMARK].to_numpy())
+    response['regression beta'] = cov_mat[0, 1]/cov_mat[1, 1]
+    response['r2'] = cov_mat[0, 1]**2/(cov_mat[0, 0]*cov_mat[1, 1])
+    response['result'] = 'success'
+    return(response)
+
+
+# correlation --------------------------------------------------------------------------------------------------------------------
+#   Correlation matrix of the annual returns (computed every month, as corr_mat does) of symbols
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure', 'correlation' and 'samples' (number of overlapping annual returns) dataframes,
+#   and 'missing' (symbols without prices). Pairs with fewer than CORR_MIN_MONTHS samples have no correlation
+# --------------------------------------------------------------------------------------------------------------------------------
+def correlation(symbols, start=None):
+    response = {'result': 'failure', 'reason for failure': None, 'correlation': None, 'samples': None, 'missing': []}
+    presponse = price_matrix(symbols, start)
+    response['missing'] = presponse['missing']
+    if presponse['result'] == 'failure':
+        response['reason for failure'] = presponse['reason for failure']
+        return(response)
+    returns_df = monthly_returns(presponse['prices'], periods=12)
+    present = returns_df.notna().to_numpy(dtype=np.float64)
+    response['correlation'] = returns_df.corr(min_periods=CORR_MIN_MONTHS)
+    response['samples'] = pd.DataFrame(present.T @ present, index=returns_df.columns, columns=returns_df.columns).astype(int)
+    response['result'] = 'success'
+    return(response)
+
+
+# latest -------------------------------------------------------------------------------------------------------------------------
+#   Latest crawl result of every company (see results_store.latest_results). Reloaded only when the store has new results
+# --------------------------------------------------------------------------------------------------------------------------------
+def latest():
+    with _lock:
+        rowid = last_rowid()
+        if rowid != _latest['rowid']:
+            count('query cache latest', 'cache misses')
+            _latest['table'], _latest['rowid'] = latest_results(), rowid
+        else:
+            count('query cache latest', 'cache hits')
+        return(_latest['table'])
+
+
+# Industry of a symbol as per its latest crawl result, or None
+def _industry(symbol):
+    latest_df = latest()
+    if symbol not in latest_df.index:
+        return(None)
+    industry = latest_df.at[symbol, 'industry']
+    return(None if pd.isna(industry) else industry)
+
+
+# Values a company with the settings of valuation_crawler. One valuation at a time (see _compute_lock)
+def _value(symbol, industry, fundamentals_df):
+    with _compute_lock:
+        build_market_snapshot([symbol]) # Rereads the prices and balance sheet of the symbol only if they changed
+        target = industry_target(industry, 'roic')
+        return(value_company(symbol, industry, fundamentals_df, report=None, verbose=False,
+                             steady_state_roic=0.1 if target is None else target))
+
+
+# _valuation ---------------------------------------------------------------------------------------------------------------------
+#   Latest value_company result of a symbol. Valued again when the day changes, its statements change or refresh is True.
+#   Failures that could go away on a retry (TTL of 0 in failure_cache) aren't kept
+# --------------------------------------------------------------------------------------------------------------------------------
+def _valuation(symbol, industry=None, refresh=False):
+    industry = _industry(symbol) if industry is None else industry
+    if industry is None:
+        return({'result': 'failure', 'Symbol': symbol, 'Industry': None, 'value_df': None,
+                'reason for failure': 'Industry of ' + symbol + ' unknown. It has never been crawled, so pass it as industry'})
+    fresponse = fundamentals(symbol)
+    if fresponse['result'] == 'failure':
+        return({'result': 'failure', 'Symbol': symbol, 'Industry': industry, 'value_df': None,
+                'reason for failure': fresponse['reason for failure']})
+
+    if refresh:
+        _forget('valuations', symbol)
+    signature = (_file_signature(_statement_files(symbol)), str(date.today()), industry)
+    result = _cached('valuations', symbol, signature, lambda: _value(symbol, industry, fresponse['fundamentals']))
+    if result['result'] == 'failure' and TTL_DAYS[failure_code(result['reason for failure'])] == 0:
+        _forget('valuations', symbol)
+    return(result)
+
+
+# valuation ----------------------------------------------------------------------------------------------------------------------
+#   Latest valuation of a symbol (see _valuation)
+#
+# Outputs:
+#   A dict with 'result', 'reason for failure', the columns of valuation_report.valuation_row ('Share price', 'wacc', 'roic',
+#   'Min VPS', ...) and 'vps', the VPS matrix (ssBeta x gslope dataframe) on success
+# --------------------------------------------------------------------------------------------------------------------------------
+def valuation(symbol, industry=None, refresh=False):
+    result = _valuation(symbol, industry, refresh)
+    response = valuation_row(result)
+    response['reason for failure'] = result['reason for failure']
+    response['vps'] = result['value_df']
+    return(response)
+
+
+# vps_matrix ---------------------------------------------------------------------------------------------------------------------
+#   VPS matrix of many symbols (see valuation_report.valuations_table), indexed by symbol. Symbols that aren't valued yet are
+#   valued on demand. Without symbols, the matrix of all the valuations in memory
+# --------------------------------------------------------------------------------------------------------------------------------
+def vps_matrix(symbols=None):
+    response = {'result': 'failure', 'reason for failure': None, 'vps': None}
+    if symbols is None:
+        with _lock:
+            results = [entry[1] for entry in _caches['valuations'].values()]
+    else:
+        results = [_valuation(symbol) for symbol in _split_symbols(symbols)]
+    if len(results) == 0:
+        response['reason for failure'] = 'No valuations in memory'
+        return(response)
+    response['vps'] = valuations_table(results).set_index('Symbol')
+    response['result'] = 'success'
+    return(response)
+
+
+# warm_up ------------------------------------------------------------------------------------------------------------------------
+#   Loads the reference data, market rates, market snapshot and latest crawl results, and the fundamentals and prices of the n
+#   most recently crawled winners
+# --------------------------------------------------------------------------------------------------------------------------------
+def warm_up(n=0):
+    get_reference_data()
+    try:
+        get_rates()
+    except ValueError as e:
+        print('Warning: ', e)
+    load_market_snapshot()
+    latest_df = latest()
+    winners = latest_df.index[latest_df['result'] == 'success'][::-1][:n]
+    for symbol in winners:
+        fundamentals(symbol)
+        price_series(symbol)
+    return(len(winners))
+
+
+# JSON friendly version of a response. Dataframes and series in 'split' orientation, NaN as null, dates as ISO strings
+def _jsonable(x):
+    if isinstance(x, (pd.DataFrame, pd.Series)):
+        return(json.loads(x.to_json(orient='split', date_format='iso')))
+    if isinstance(x, dict):
+        return(dict([(str(key), _jsonable(value)) for key, value in x.items()]))
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return([_jsonable(value) for value in x])
+    if isinstance(x, np.generic):
+        x = x.item()
+    if isinstance(x, float) and not np.isfinite(x):
+        return(None)
+    if isinstance(x, (date, datetime, pd.Timestamp)):
+        return(None if pd.isna(x) else x.isoformat())
+    return(x)
+
+
+def _param(params, name, default=None, required=False):
+    if name in params:
+        return(params[name][-1])
+    if required:
+        raise ValueError('Missing parameter <' + name + '>')
+    return(default)
+
+
+def _latest_rows(params):
+    latest_df = latest()
+    symbols = _split_symbols(_param(params, 'symbols', required=True))
+    return({'result': 'success', 'reason for failure': None, 'latest': latest_df.loc[latest_df.index.intersection(symbols)],
+            'missing': [symbol for symbol in symbols if symbol not in latest_df.index]})
+
+
+def _stats(params):
+    with _lock:
+        sizes = dict([(name, len(cache)) for name, cache in _caches.items()])
+    profile_df = profile_table()
+    return({'result': 'success', 'reason for failure': None, 'cached': sizes, 'capacity': MAX_CACHED,
+            'profile': profile_df[[name.startswith('query') for name in profile_df.index]]})
+
+
+# path -> handler(params). Every handler returns a response dict
+ROUTES = {'/health': lambda params: {'result': 'success', 'reason for failure': None, 'uptime': time.time() - _started},
+          '/stats': _stats,
+          '/fundamentals': lambda params: fundamentals(_param(params, 'symbol', required=True).upper(),
+                                                       _param(params, 'base', 'latest quarterly')),
+          '/prices': lambda params: price_matrix(_param(params, 'symbols', required=True), _param(params, 'start')),
+          '/beta': lambda params: beta(_param(params, 'symbol', required=True).upper(), _param(params, 'industry'),
+                                       int(_param(params, 'months', BETA_MONTHS))),
+          '/correlation': lambda params: correlation(_param(params, 'symbols', required=True), _param(params, 'start')),
+          '/valuation': lambda params: valuation(_param(params, 'symbol', required=True).upper(), _param(params, 'industry'),
+                                                 _param(params, 'refresh', '0') in ['1', 'true', 'yes']),
+          '/vps': lambda params: vps_matrix(_param(params, 'symbols')),
+          '/latest': _latest_rows}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        start = time.perf_counter()
+        status = 200
+        if url.path not in ROUTES:
+            status, response = 404, {'result': 'failure', 'reason for failure': 'Unknown query ' + url.path +
+                                                                                 '. Valid queries are ' + ', '.join(ROUTES)}
+        else:
+            try:
+                with stage('query ' + url.path.strip('/')):
+                    response = ROUTES[url.path](parse_qs(url.query))
+            except ValueError as e:
+                status, response = 400, {'result': 'failure', 'reason for failure': str(e)}
+            except Exception as e:
+                status, response = 500, {'result': 'failure', 'reason for failure': 'Unexpected error: ' + repr(e)}
+        response = dict(response, ms=1000*(time.perf_counter() - start)) # A copy, as cached responses are shared
+        body = json.dumps(_jsonable(response)).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # One line per query is too much for a service answering in milliseconds
+        pass
+
+
+# serve --------------------------------------------------------------------------------------------------------------------------
+#   Warms up (see warm_up) and answers queries until interrupted
+# --------------------------------------------------------------------------------------------------------------------------------
+def serve(host=HOST, port=PORT, preload=0):
+    print('Warmed up with', warm_up(preload), 'companies preloaded')
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print('Query service listening on http://' + host + ':' + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Warm local query service for fundamentals, prices, betas and valuations")
+    parser.add_argument('--host', help="Defaults to " + HOST, default=HOST)
+    parser.add_argument('-p', '--port', help="Defaults to " + str(PORT), type=int, default=PORT)
+    parser.add_argument('-n', '--preload', help="Preload the fundamentals and prices of this many recently crawled winners",
+                        type=int, default=0)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.preload)
@@ -0,0 +1,199 @@
+# reference_data.py --------------------------------------------------------------------------------------------------------------
+#   Reference data used by every valuation: prof. Damodaran's industry betas, the interest coverage ratio -> synthetic rating ->
+# spread table, equity risk premium and tax rate. Parsing betaGlobal.xls/betas.xls for every company is slow, so the tables are
+# parsed once, stored as a pickled snapshot in the cache folder and served from memory afterwards.
+#
+#   A snapshot remembers the size, modification time and SHA1 of every source file it was built from. When a source file
+# changes, a new snapshot named after the date it was built on is written next to the old ones, so older valuations can be
+# reproduced by asking for the reference data as of an older date.
+#
+# NOTE: The rating table changes from time to time and needs to be updated from
+# https://pages.stern.nyu.edu/~adamodar/New_Home_Page/datafile/ratings.html. If <adamodaran_folder>/ratings.csv (columns
+# int_cov_ratio, rating, spread) exists, it takes precedence over the table below
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+import glob
+import pickle
+import hashlib
+from datetime import date
+
+from profiling import stage, profiled, count, count_file
+
+# Parameters
+adamodaran_folder = '/home/dinesh/Documents/Valuations/adamodaran'
+cache_folder = adamodaran_folder + '/cache'
+beta_files = {'global': 'betaGlobal.xls', 'usa': 'betas.xls'}
+rating_file = 'ratings.csv'
+
+DEFAULT_ERP = 4.78 # %. Equity risk premium for USA
+DEFAULT_TAX = 27 # %. Tax rate. We use marginal tax rate which might be too conservative
+DEFAULT_RATING_TABLE = {
+    'int_cov_ratio': [-np.inf, 0.2, 0.65, 0.8, 1.25, 1.5, 1.75, 2, 2.25, 2.5, 3, 4.25, 5.5, 6.5, 8.5],
+    'rating': ['D2/D', 'C2/C', 'Ca2/CC', 'Caa/CCC', 'B3/B-', 'B2/B', 'B1/B+', 'Ba2/BB', 'Ba1/BB+', 'Baa2/BBB', 'A3/A-', 'A2/A',
+               'A1/A+', 'Aa2/AA', 'Aaa/AAA'],
+    'spread': [20, 17.5, 15.78, 11.57, 7.37, 5.26, 4.55, 3.13, 2.42, 2.00, 1.62, 1.42, 1.23, 0.85, 0.69]} # percentage
+
+_snapshots = {} # In-process memo. as_of (None for latest) -> snapshot
+
+
+# Returns size, mtime and (optionally) SHA1 of a source file, or None if it doesn't exist
+def _file_signature(filename, with_hash=True):
+    if not os.path.exists(filename):
+        return(None)
+    stat = os.stat(filename)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': None}
+    if with_hash:
+        with open(filename, 'rb') as f:
+            signature['sha1'] = hashlib.sha1(f.read()).hexdigest()
+    return(signature)
+
+
+def _source_files():
+    return(dict([(name, adamodaran_folder + '/' + filename) for name, filename in beta_files.items()] +
+                [('ratings', adamodaran_folder + '/' + rating_file)]))
+
+
+# build_reference_data -----------------------------------------------------------------------------------------------------------
+#   Parses the source files and returns a new snapshot. Missing beta files result in empty beta tables
+#
+# Inputs:
+#   erp, tax: Percentages to be recorded in the snapshot
+#
+# Outputs:
+#   A dict with 'version' (date), 'sources' (file signatures), 'betas' ({'global': {industry: beta}, 'usa': {...}}),
+#   'rating_table' (dataframe sorted by int_cov_ratio), 'erp' and 'tax'
+# --------------------------------------------------------------------------------------------------------------------------------
+@profiled()
+def build_reference_data(erp=DEFAULT_ERP, tax=DEFAULT_TAX):
+    snapshot = {'version': date.today(), 'sources': {}, 'betas': {}, 'erp': erp, 'tax': tax}
+    for name, filename in _source_files().items():
+        snapshot['sources'][name] = _file_signature(filename)
+
+    for name, filename in beta_files.items():
+        filename = adamodaran_folder + '/' + filename
+        if os.path.exists(filename):
+            count_file('build_reference_data', filename)
+            tempdf = pd.read_excel(filename, 'Industry Averages', skiprows=9, index_col=0)
+            snapshot['betas'][name] = tempdf['Unlevered beta corrected for cash'].dropna().astype(float).to_dict()
+        else:
+            snapshot['betas'][name] = {}
+
+    filename = adamodaran_folder + '/' + rating_file
+    if os.path.exists(filename):
+        rating_table = pd.read_csv(filename)[['int_cov_ratio', 'rating', 'spread']]
+    else:
+        rating_table = pd.DataFrame(DEFAULT_RATING_TABLE)
+    snapshot['rating_table'] = rating_table.sort_values('int_cov_ratio').reset_index(drop=True)
+    return(snapshot)
+
+
+# Snapshot file names carry their version date so they sort chronologically
+def _snapshot_files():
+    return(sorted(glob.glob(cache_folder + '/refdata_*.pkl')))
+
+
+def _save(snapshot):
+    os.makedirs(cache_folder, exist_ok=True)
+    filename = cache_folder + '/refdata_' + snapshot['version'].strftime('%Y%m%d') + '.pkl'
+    with open(filename, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load(filename):
+    count_file('get_reference_data', filename)
+    with open(filename, 'rb') as f:
+        return(pickle.load(f))
+
+
+# Checks whether a snapshot was built from the source files as they are now. Files whose size and mtime didn't change are not
+# hashed. Files that were only touched (same SHA1) don't invalidate the snapshot
+def _is_current(snapshot):
+    for name, filename in _source_files().items():
+        cached = snapshot['sources'].get(name)
+        current = _file_signature(filename, with_hash=False)
+        if cached is None or current is None:
+            if cached != current:
+                return(False)
+            continue
+        if cached['size'] == current['size'] and cached['mtime'] == current['mtime']:
+            continue
+        if _file_signature(filename)['sha1'] != cached['sha1']:
+            return(False)
+    return(True)
+
+
+# get_reference_data -------------------------------------------------------------------------------------------------------------
+#   Returns the reference data snapshot. The first call of a process loads it from the cache folder (rebuilding it if a source
+#   file has changed), every later call is served from memory
+#
+# Inputs:
+#   as_of: Optional date. If given, the latest snapshot built on or before that date is returned as is (never rebuilt), so that
+#          older valuations can be reproduced
+#
+# Outputs:
+#   A snapshot dict (see build_reference_data)
+# --------------------------------------------------------------------------------------------------------------------------------
+def get_reference_data(as_of=None):
+    if as_of in _snapshots:
+        count('get_reference_data', 'cache hits')
+        return(_snapshots[as_of])
+    count('get_reference_data', 'cache misses')
+
+    files = _snapshot_files()
+    if as_of is not None:
+        as_of_name = cache_folder + '/refdata_' + as_of.strftime('%Y%m%d') + '.pkl'
+        older = [f for f in files if f <= as_of_name]
+        if len(older) == 0:
+            raise ValueError('No reference data snapshot available as of ' + str(as_of))
+        snapshot = _load(older[-1])
+    else:
+        snapshot = _load(files[-1]) if len(files) > 0 else None
+        if snapshot is None or not _is_current(snapshot):
+            snapshot = build_reference_data(erp = DEFAULT_ERP if snapshot is None else snapshot['erp'],
+                                            tax = DEFAULT_TAX if snapshot is None else snapshot['tax'])
+            _save(snapshot)
+
+    _snapshots[as_of] = snapshot
+    return(snapshot)
+
+
+# unlevered_beta -----------------------------------------------------------------------------------------------------------------
+#   O(1) lookup of the unlevered beta (corrected for cash) of an industry
+#
+# Inputs:
+#   industry: Industry name as in prof. Damodaran's spreadsheets (Ex. 'Software (System & Application)')
+#   beta_to_use: 'global' or 'usa'
+#   as_of: Optional date, see get_reference_data
+#
+# Outputs:
+#   The beta, or None if the industry isn't in the table
+# --------------------------------------------------------------------------------------------------------------------------------
+def unlevered_beta(industry, beta_to_use='global', as_of=None):
+    return(get_reference_data(as_of)['betas'][beta_to_use].get(industry))
+
+
+# rating_table -------------------------------------------------------------------------------------------------------------------
+#   Returns the interest coverage ratio -> rating -> spread table as a dataframe sorted by int_cov_ratio
+# --------------------------------------------------------------------------------------------------------------------------------
+def rating_table(as_of=None):
+    return(get_reference_data(as_of)['rating_table'])
+
+
+# update_rates -------------------------------------------------------------------------------------------------------------------
+#   Records a new equity risk premium and/or tax rate. A new snapshot dated today is written, so older snapshots keep the
+#   values that were in force when they were built
+# --------------------------------------------------------------------------------------------------------------------------------
+def update_rates(erp=None, tax=None):
+    snapshot = dict(get_reference_data())
+    snapshot['version'] = date.today()
+    if erp is not None:
+        snapshot['erp'] = erp
+    if tax is not None:
+        snapshot['tax'] = tax
+    _save(snapshot)
+    _snapshots.clear()
+    _snapshots[None] = snapshot
+    return(snapshot)
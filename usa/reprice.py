@@ -0,0 +1,58 @@
+# reprice.py ---------------------------------------------------------------------------------------------------------------------
+#   Re-prices valuations when only market data changes. ROIC, reinvestment rate, interest coverage and the other statement
+# driven figures of a value_company result stay valid until new statements come in (see dcf_valuation.get_statement_state), so
+# a move in share prices or rates only changes market cap, cost of capital, discounting and value per share. Here these are
+# recomputed for the whole universe at once: one cost_of_capital call and one fade_value call on a
+# (companies x ssbetas x gslopes) array, so a nightly re-pricing of thousands of companies takes seconds and makes no requests
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from dcf_engine import fade_value, inputs_table, scenario_frame
+from cost_of_capital import cost_of_capital
+
+
+# reprice_universe ---------------------------------------------------------------------------------------------------------------
+#   Re-values many companies with new share prices and/or rates
+#
+# Inputs:
+#   results: Iterable of value_company results (failed ones are skipped), or a dataframe as returned by dcf_engine.inputs_table
+#   prices: Optional pandas series, symbol -> new share price. Companies missing from it keep their old price. The number of
+#           outstanding shares is held constant, so market cap moves with the price
+#   rfr, erp: Optional new rates (%). Default to the rates each company was valued with
+#   ssbetas, gslopes: Scenarios to value, as in value_company
+#
+# Outputs:
+#   A pandas dataframe indexed by symbol with 'price', 'mv_equity', 'rfr', 'erp', 'wacc', 'Debt rating', one column per
+#   scenario (Ex. 'ssBeta=1|gslope=5', as in valuation_report.valuations_table) and 'Min VPS', 'Avg VPS', 'Max VPS'. Companies
+#   that value_company would now fail on (negative FCFF of a slow growing company) get NaN values per share
+# --------------------------------------------------------------------------------------------------------------------------------
+def reprice_universe(results, prices=None, rfr=None, erp=None, ssbetas=(0.8, 1, 1.2), gslopes=(3, 5, 7)):
+    inputs_df = results if isinstance(results, pd.DataFrame) else inputs_table(results)
+
+    price = inputs_df['price']
+    if prices is not None:
+        price = pd.Series(prices, dtype=np.float64).reindex(inputs_df.index).fillna(price)
+    price = price.to_numpy(dtype=np.float64)
+    mv_equity = price*inputs_df['outstanding_shares'].to_numpy()/1E6
+    rfr = inputs_df['rfr'].to_numpy() if rfr is None else np.full(price.shape, rfr, dtype=np.float64)
+    erp = inputs_df['erp'].to_numpy() if erp is None else np.full(price.shape, erp, dtype=np.float64)
+
+    coc = cost_of_capital(inputs_df['int_cov_ratio'].to_numpy(), inputs_df['bv_debt'].to_numpy(), mv_equity,
+                          inputs_df['unlevered_beta'].to_numpy(), rfr, erp, inputs_df['tax'].to_numpy())
+
+    column = lambda values: np.asarray(values, dtype=np.float64)[:, None, None]
+    values = fade_value(column(inputs_df['post_tax_opinc']), column(inputs_df['reinvestment']), column(inputs_df['roic']),
+                        column(inputs_df['rir']), column(coc['wacc']), column(rfr), column(erp), column(inputs_df['cash']),
+                        column(inputs_df['bv_debt']), column(inputs_df['outstanding_shares']),
+                        ssbeta=np.asarray(ssbetas, dtype=np.float64)[None, :, None],
+                        gslope=np.asarray(gslopes, dtype=np.float64)[None, None, :],
+                        steady_state_roic=column(inputs_df['steady_state_roic']))
+    growth = (inputs_df['roic']*inputs_df['rir']).to_numpy()
+    fcff = (inputs_df['post_tax_opinc'] - inputs_df['reinvestment']).to_numpy()
+    failed = (growth < rfr/100) & (fcff < 0) # Same as the 'Negative FCFF for base year' check of value_company
+    vps = np.where(failed[:, None, None], np.nan, values['vps'])
+
+    repriced_df = pd.DataFrame({'price': price, 'mv_equity': mv_equity, 'rfr': rfr, 'erp': erp, 'wacc': coc['wacc'],
+                                'Debt rating': coc['rating']}, index=inputs_df.index)
+    return(repriced_df.join(scenario_frame(vps, inputs_df.index, ssbetas, gslopes)))
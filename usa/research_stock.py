@@ -15,6 +15,7 @@ import os
 import sys
 import errno
 import argparse
+from query_client import close_prices
 
 # Parameters
 FMP_URL = "https://financialmodelingprep.com/api/v3"
@@ -46,17 +47,19 @@ else:
     sector = sample_df['GICS Sector'].values[0]
 
 # Main code
-filename = consolidated_prices_folder + '/' + symbol + '.csv'
-if not os.path.exists(filename): 
-    print("Sorry stock daily prices isn't available. Download it first")
-    sys.exit(errno.EIO)
+prices = close_prices(symbol) # From the warm query service if it is running (see query_service)
+if prices is None:
+    filename = consolidated_prices_folder + '/' + symbol + '.csv'
+    if not os.path.exists(filename): 
+        print("Sorry stock daily prices isn't available. Download it first")
+        sys.exit(errno.EIO)
 
-# Get price data
-try:    
-    prices = pd.read_csv(filename, index_col=0, parse_dates=True)
-except Exception as e:
-    print("Error while trying to open stock data for ", symbol, " Error: ", e)
-    sys.exit(errno.EIO)
+    # Get price data
+    try:    
+        prices = pd.read_csv(filename, index_col=0, parse_dates=True)
+    except Exception as e:
+        print("Error while trying to open stock data for ", symbol, " Error: ", e)
+        sys.exit(errno.EIO)
 
 # Get fundamentals
 # INCOME STATEMENT
@@ -0,0 +1,202 @@
+# results_store.py ---------------------------------------------------------------------------------------------------------------
+#   Local SQLite store of crawl results. Every company processed by valuation_crawler becomes one row of the crawl_results table,
+# winners and losers alike, and every run one row of crawl_runs. Rows are written in batches, each batch one executemany inside one
+# transaction, so appending a result costs the same whether the store holds one run or a thousand (the xlsx files it replaces had
+# to be reopened and rewritten at every commit).
+#
+#   The winners and losers lists the crawler used to append to winners.xlsx and losers.xlsx are the winners_v and losers_v views,
+# with the same columns. export_results writes them to xlsx files at the end of a run, or from the command line:
+#
+# Usage: python results_store.py export [--since YYYY-MM-DD] [--run RUN_ID]
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+import sqlite3
+import argparse
+from datetime import date, datetime
+
+# Parameters
+results_db = '/home/dinesh/Documents/Valuations/usa/valuations.db'
+valuations_folder = '/home/dinesh/Documents/Valuations/usa'
+
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS "crawl_runs" (
+                 "run_id"    INTEGER PRIMARY KEY AUTOINCREMENT,
+                 "run_date"  TEXT,
+                 "started"   TEXT,
+                 "industry"  TEXT
+             )''',
+          '''CREATE TABLE IF NOT EXISTS "crawl_results" (
+                 "run_id"              INTEGER REFERENCES "crawl_runs"("run_id"),
+                 "run_date"            TEXT,
+                 "symbol"              TEXT,
+                 "industry"            TEXT,
+                 "company_name"        TEXT,
+                 "result"              TEXT,
+                 "share_price"         NUMERIC,
+                 "analyst_target"      NUMERIC,
+                 "pe"                  NUMERIC,
+                 "debt_rating"         TEXT,
+                 "min_vps"             NUMERIC,
+                 "avg_vps"             NUMERIC,
+                 "max_vps"             NUMERIC,
+                 "reason_for_failure"  TEXT
+             )''',
+          'CREATE INDEX IF NOT EXISTS "crawl_results_symbol" ON "crawl_results"("symbol")',
+          'CREATE INDEX IF NOT EXISTS "crawl_results_industry" ON "crawl_results"("industry")',
+          'CREATE INDEX IF NOT EXISTS "crawl_results_run_date" ON "crawl_results"("run_date")',
+          '''CREATE VIEW IF NOT EXISTS "winners_v" AS
+             SELECT run_id, company_name AS "Company name", symbol AS "Symbol", industry AS "Industry", run_date AS "Date",
+                    share_price AS "Share price", analyst_target AS "Analyst target", pe AS "PE", debt_rating AS "Debt rating",
+                    min_vps AS "Min VPS", avg_vps AS "Avg VPS", max_vps AS "Max VPS"
+             FROM crawl_results WHERE result = 'success' ''',
+          '''CREATE VIEW IF NOT EXISTS "losers_v" AS
+             SELECT run_id, company_name AS "Company name", symbol AS "Symbol", industry AS "Industry", run_date AS "Date",
+                    share_price AS "Share price", analyst_target AS "Analyst target", pe AS "PE", debt_rating AS "Debt rating",
+                    reason_for_failure AS "reason for failure"
+             FROM crawl_results WHERE result = 'failure' ''']
+
+# Result dict key (as the crawler builds it) -> crawl_results column
+COLUMNS = {'symbol': 'symbol', 'industry': 'industry', 'Company name': 'company_name', 'result': 'result',
+           'Share price': 'share_price', 'Analyst target': 'analyst_target', 'PE': 'pe', 'Debt rating': 'debt_rating',
+           'Min VPS': 'min_vps', 'Avg VPS': 'avg_vps', 'Max VPS': 'max_vps', 'reason for failure': 'reason_for_failure'}
+
+_connections = {} # In-process memo. filename -> sqlite3 connection
+
+
+# open_store ---------------------------------------------------------------------------------------------------------------------
+#   Returns the connection to a results store (one per file and process), creating the tables, indexes and views if needed
+# --------------------------------------------------------------------------------------------------------------------------------
+def open_store(filename=None):
+    filename = results_db if filename is None else filename
+    if filename not in _connections:
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        connection = sqlite3.connect(filename, check_same_thread=False) # Callers with threads (Ex. query_service) serialize access
+        connection.execute('PRAGMA journal_mode=WAL') # Readers (Ex. an export) don't block the crawler's writes
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        _connections[filename] = connection
+    return(_connections[filename])
+
+
+def close_store(filename=None):
+    connection = _connections.pop(results_db if filename is None else filename, None)
+    if connection is not None:
+        connection.close()
+
+
+# start_run ----------------------------------------------------------------------------------------------------------------------
+#   Records the start of a crawl and returns its run_id
+# --------------------------------------------------------------------------------------------------------------------------------
+def start_run(industry=None, filename=None):
+    connection = open_store(filename)
+    with connection:
+        cursor = connection.execute('INSERT INTO crawl_runs (run_date, started, industry) VALUES (?, ?, ?)',
+                                    (str(date.today()), datetime.now().isoformat(timespec='seconds'), industry))
+    return(cursor.lastrowid)
+
+
+# Python value SQLite can store. NaN (and other missing values) becomes NULL
+def _value(x):
+    if x is None or (np.ndim(x) == 0 and not isinstance(x, str) and pd.isna(x)):
+        return(None)
+    if isinstance(x, np.generic):
+        return(x.item())
+    return(x)
+
+
+# insert_results -----------------------------------------------------------------------------------------------------------------
+#   Appends a batch of results to the store in one transaction
+#
+# Inputs:
+#   rows: List of dicts with the keys of COLUMNS ('result' is 'success' or 'failure'). Missing keys are stored as NULL
+#   run_id: As returned by start_run
+#   run_date: Date of the results. Defaults to today
+# --------------------------------------------------------------------------------------------------------------------------------
+def insert_results(rows, run_id, run_date=None, filename=None):
+    if len(rows) == 0:
+        return
+    run_date = str(date.today() if run_date is None else run_date)
+    keys = list(COLUMNS)
+    statement = ('INSERT INTO crawl_results (run_id, run_date, ' + ', '.join([COLUMNS[key] for key in keys]) + ') VALUES (' +
+                 ', '.join(['?']*(len(keys) + 2)) + ')')
+    connection = open_store(filename)
+    with connection:
+        connection.executemany(statement, [[run_id, run_date] + [_value(row.get(key)) for key in keys] for row in rows])
+
+
+# load_results -------------------------------------------------------------------------------------------------------------------
+#   Reads the winners or losers view as a dataframe
+#
+# Inputs:
+#   view: 'winners' or 'losers'
+#   since: Optional date. Only results from that date on
+#   run_id: Optional. Only the results of that run
+#
+# Outputs:
+#   A pandas dataframe with the columns of the xlsx files the crawler used to write, oldest first
+# --------------------------------------------------------------------------------------------------------------------------------
+def load_results(view='winners', since=None, run_id=None, filename=None):
+    if view not in ['winners', 'losers']:
+        raise ValueError('Invalid view. It should be either <winners> or <losers>')
+    conditions, params = [], []
+    if since is not None:
+        conditions.append('"Date" >= ?')
+        params.append(str(pd.Timestamp(since).date()))
+    if run_id is not None:
+        conditions.append('run_id = ?')
+        params.append(int(run_id))
+    query = 'SELECT * FROM ' + view + '_v' + (' WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else '') + ' ORDER BY rowid'
+    results_df = pd.read_sql_query(query, open_store(filename), params=params)
+    return(results_df.drop(columns='run_id'))
+
+
+# latest_results -----------------------------------------------------------------------------------------------------------------
+#   Most recent result of every company, from the last run that processed it
+#
+# Outputs:
+#   A pandas dataframe indexed by symbol with the columns of crawl_results and 'rowid' (order of insertion)
+# --------------------------------------------------------------------------------------------------------------------------------
+def latest_results(filename=None):
+    query = ('SELECT rowid, * FROM crawl_results WHERE rowid IN (SELECT MAX(rowid) FROM crawl_results GROUP BY symbol) '
+             'ORDER BY rowid')
+    return(pd.read_sql_query(query, open_store(filename), index_col='symbol'))
+
+
+# rowid of the last result stored (0 if there are none). A cheap way of finding out whether new results came in
+def last_rowid(filename=None):
+    return(open_store(filename).execute('SELECT COALESCE(MAX(rowid), 0) FROM crawl_results').fetchone()[0])
+
+
+# export_results -----------------------------------------------------------------------------------------------------------------
+#   Writes the winners and losers views to xlsx files (Summary sheet), replacing the files
+#
+# Inputs:
+#   since, run_id: See load_results
+#   folder: Folder of winners.xlsx and losers.xlsx. Defaults to valuations_folder
+#
+# Outputs:
+#   A dict view -> filename
+# --------------------------------------------------------------------------------------------------------------------------------
+def export_results(since=None, run_id=None, folder=None, filename=None):
+    folder = valuations_folder if folder is None else folder
+    filenames = {}
+    for view in ['winners', 'losers']:
+        filenames[view] = folder + '/' + view + '.xlsx'
+        with pd.ExcelWriter(filenames[view], engine='openpyxl') as writer:
+            load_results(view, since, run_id, filename).to_excel(writer, sheet_name='Summary', index=False)
+    return(filenames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crawl results store")
+    parser.add_argument('command', help="export: writes winners.xlsx and losers.xlsx from the store", choices=['export'])
+    parser.add_argument('-s', '--since', help="Only results from this date (YYYY-MM-DD) on")
+    parser.add_argument('-r', '--run', help="Only the results of this run", type=int)
+    parser.add_argument('-f', '--folder', help="Folder to write the xlsx files to. Defaults to " + valuations_folder)
+    args = parser.parse_args()
+    for view, xlsx_filename in export_results(args.since, args.run, args.folder).items():
+        print('Wrote', view, 'to', xlsx_filename)
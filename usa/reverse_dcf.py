@@ -0,0 +1,100 @@
+# reverse_dcf.py -----------------------------------------------------------------------------------------------------------------
+#   Reverse DCF: instead of asking what a company is worth, asks what the market price implies. Using the fade model of
+# value_company (see dcf_engine), we solve for
+#   - 'growth': the initial growth rate (ROIC held at its historical value, reinvestment rate solved for), or
+#   - 'roic': the ROIC (reinvestment rate held at its historical value)
+# that makes the value per share equal the share price.
+#
+#   The root is found by bisection over all the companies at once: every iteration is one fade_value call on arrays with one
+# entry per company. The fade model isn't continuous (the number of extraordinary growth years is an integer and the model
+# switches between its three cases), so a sign change that turns out to be a jump instead of a root is reported as NaN
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from dcf_engine import fade_value, inputs_table
+
+
+# Value per share of every company when ROIC and reinvestment rate are replaced by the given arrays
+def _vps(inputs_df, roic, rir, ssbeta, gslope):
+    return(fade_value(inputs_df['post_tax_opinc'].to_numpy(), inputs_df['reinvestment'].to_numpy(), roic, rir,
+                      inputs_df['wacc'].to_numpy(), inputs_df['rfr'].to_numpy(), inputs_df['erp'].to_numpy(),
+                      inputs_df['cash'].to_numpy(), inputs_df['bv_debt'].to_numpy(), inputs_df['outstanding_shares'].to_numpy(),
+                      ssbeta=ssbeta, gslope=gslope, steady_state_roic=inputs_df['steady_state_roic'].to_numpy())['vps'])
+
+
+# solve_implied ------------------------------------------------------------------------------------------------------------------
+#   Vectorized bracketed bisection for the ROIC or reinvestment rate that makes value per share equal the share price
+#
+# Inputs:
+#   inputs_df: One row per company, see dcf_engine.inputs_table
+#   solve_for: 'growth' (solve for the reinvestment rate at the historical ROIC) or 'roic' (at the historical reinvestment rate)
+#   ssbeta, gslope: Fade model scenario to use
+#   bracket: (low, high) of the variable solved for. Defaults to (0, 1) for the reinvestment rate and (0.0001, 2) for ROIC
+#   max_iter, tol: Bisection stops after max_iter iterations or when all brackets are narrower than tol
+#   price_tol: A converged point is accepted as a root only if value per share is within price_tol (fraction) of the price
+#
+# Outputs:
+#   A dict of arrays: 'implied_roic', 'implied_rir' and 'implied_growth' (NaN where the price isn't bracketed or there is no root)
+# --------------------------------------------------------------------------------------------------------------------------------
+def solve_implied(inputs_df, solve_for='growth', ssbeta=1, gslope=5, bracket=None, max_iter=60, tol=1e-7, price_tol=0.001):
+    if solve_for == 'growth':
+        bracket = (0, 1) if bracket is None else bracket
+        fixed = inputs_df['roic'].to_numpy()
+        vps = lambda x: _vps(inputs_df, fixed, x, ssbeta, gslope)
+    elif solve_for == 'roic':
+        bracket = (0.0001, 2) if bracket is None else bracket
+        fixed = inputs_df['rir'].to_numpy()
+        vps = lambda x: _vps(inputs_df, x, fixed, ssbeta, gslope)
+    else:
+        raise ValueError('Invalid solve_for. Valid inputs are <growth> or <roic>')
+
+    price = inputs_df['price'].to_numpy()
+    lo = np.full(price.shape, bracket[0], dtype=np.float64)
+    hi = np.full(price.shape, bracket[1], dtype=np.float64)
+    f_lo = vps(lo) - price
+    f_hi = vps(hi) - price
+    bracketed = np.isfinite(f_lo) & np.isfinite(f_hi) & (np.sign(f_lo) != np.sign(f_hi))
+
+    for i in range(max_iter):
+        mid = (lo + hi)/2
+        f_mid = vps(mid) - price
+        move_lo = np.sign(f_mid) == np.sign(f_lo)  # Root is in the upper half
+        lo = np.where(move_lo, mid, lo)
+        f_lo = np.where(move_lo, f_mid, f_lo)
+        hi = np.where(move_lo, hi, mid)
+        if np.all((hi - lo)[bracketed] < tol):
+            break
+
+    root = (lo + hi)/2
+    converged = bracketed & (np.abs(vps(root) - price) <= price_tol*np.abs(price))
+    root = np.where(converged, root, np.nan)
+
+    if solve_for == 'growth':
+        implied_roic, implied_rir = np.where(converged, fixed, np.nan), root
+    else:
+        implied_roic, implied_rir = root, np.where(converged, fixed, np.nan)
+    return({'implied_roic': implied_roic, 'implied_rir': implied_rir, 'implied_growth': implied_roic*implied_rir})
+
+
+# implied_expectations -----------------------------------------------------------------------------------------------------------
+#   Ranks the companies of a crawl by the expectations built into their share prices
+#
+# Inputs:
+#   results: Iterable of value_company results (failed ones are skipped)
+#   solve_for, ssbeta, gslope: See solve_implied
+#
+# Outputs:
+#   A pandas dataframe indexed by symbol with price, historical roic, rir and growth, the implied ones, and 'growth gap'
+#   (historical minus implied growth), sorted by growth gap, largest (market expects the least compared to history) first
+# --------------------------------------------------------------------------------------------------------------------------------
+def implied_expectations(results, solve_for='growth', ssbeta=1, gslope=5):
+    inputs_df = inputs_table(results)
+    implied = solve_implied(inputs_df, solve_for, ssbeta, gslope)
+
+    expectations_df = inputs_df[['price', 'roic', 'rir']].copy()
+    expectations_df['growth'] = expectations_df['roic']*expectations_df['rir']
+    for name, values in implied.items():
+        expectations_df[name] = values
+    expectations_df['growth gap'] = expectations_df['growth'] - expectations_df['implied_growth']
+    return(expectations_df.sort_values('growth gap', ascending=False))
@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 import os
 import sys
 import argparse
+from query_client import close_prices
 
 # Function definitions
 # calc_returns ------------------------------------------------------------------------------------
@@ -21,10 +22,11 @@ import argparse
 #
 # -------------------------------------------------------------------------------------------------
 def calc_returns(prices_filename, begin_year):
-    if not os.path.exists(prices_filename): 
-        return pd.Series([], dtype = 'float64')
-
-    stock_price = pd.read_csv(prices_filename, index_col=0, parse_dates=True)
+    stock_price = close_prices(os.path.basename(prices_filename)[:-len('.csv')]) # From the warm query service if it is running
+    if stock_price is None:
+        if not os.path.exists(prices_filename): 
+            return pd.Series([], dtype = 'float64')
+        stock_price = pd.read_csv(prices_filename, index_col=0, parse_dates=True)
 
     if stock_price.empty or stock_price.index.name != 'Date':   # Check for errors   
         return pd.Series([], dtype = 'float64')
@@ -0,0 +1,137 @@
+# sensitivity.py -----------------------------------------------------------------------------------------------------------------
+#   Sensitivity (tornado) analysis of DCF valuations. Instead of re-running value_company with edited constants, every input is
+# bumped down and up around the value used by value_company and all the bumped scenarios of all the companies are valued with
+# one dcf_engine.fade_value call on a (companies x scenarios) array. Only the inputs stored in the value_company results are
+# used, so nothing is downloaded or re-read: no OVERVIEW request, no beta workbook, no statements.
+#
+#   The inputs that can be bumped are rfr, erp, tax, steady_state_roic and extord_intercept (the y-intercept of the number of
+# extraordinary growth years, 3 in value_company). A change in rfr, erp or tax changes the cost of capital, which is recomputed
+# with cost_of_capital. A change in tax also changes post tax operating income and, with it, ROIC (which scales with 1-tax) and
+# reinvestment rate (which scales with 1/(1-tax)), so growth stays the same
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from dcf_engine import fade_value, inputs_table, ENGINE_INPUTS
+from cost_of_capital import cost_of_capital
+
+# Parameters
+DEFAULT_BUMPS = {'rfr': 0.5,                 # percentage points
+                 'erp': 0.5,                 # percentage points
+                 'tax': 2,                   # percentage points
+                 'steady_state_roic': 0.02,  # fraction
+                 'extord_intercept': 1}      # years
+EXTORD_INTERCEPT = 3 # As in value_company
+
+
+# scenario_values ----------------------------------------------------------------------------------------------------------------
+#   Values companies under changed rfr, erp, tax, steady state ROIC and extord intercept with the value_company math. The cost of
+#   capital is recomputed, and a tax change rescales post tax operating income, ROIC and reinvestment rate. Company inputs and
+#   scenario values are broadcast against each other, so the caller decides the layout (Ex. companies x scenarios)
+#
+# Inputs:
+#   inputs: dict of arrays, one per dcf_engine.ENGINE_INPUTS column
+#   rfr, erp, tax, steady_state_roic, extord_intercept: Scenario values (arrays)
+#   ssbeta, gslope: Fade model scenario
+#   rating_table: Optional, see cost_of_capital.synthetic_rating
+#
+# Outputs:
+#   A dict of arrays of the broadcast shape: 'vps' (NaN where value_company would fail: reinvestment rate > 100%, negative FCFF
+#   of a slow growing company, infinite values), 'wacc', 'cost_of_equity', 'roic', 'rir', 'case' and 'num_extord_years'
+# --------------------------------------------------------------------------------------------------------------------------------
+def scenario_values(inputs, rfr, erp, tax, steady_state_roic, extord_intercept=EXTORD_INTERCEPT, ssbeta=1, gslope=5,
+                    rating_table=None):
+    tax_factor = (1 - tax/100)/(1 - inputs['tax']/100)
+    post_tax_opinc = inputs['post_tax_opinc']*tax_factor
+    roic = inputs['roic']*tax_factor
+    rir = inputs['rir']/tax_factor
+    coc = cost_of_capital(inputs['int_cov_ratio'], inputs['bv_debt'], inputs['mv_equity'], inputs['unlevered_beta'], rfr, erp, tax,
+                          rating_table)
+
+    values = fade_value(post_tax_opinc, inputs['reinvestment'], roic, rir, coc['wacc'], rfr, erp, inputs['cash'], inputs['bv_debt'],
+                        inputs['outstanding_shares'], ssbeta=ssbeta, gslope=gslope, steady_state_roic=steady_state_roic,
+                        extord_intercept=extord_intercept)
+    fcff = post_tax_opinc - inputs['reinvestment']
+    valid = (rir <= 1) & ~((values['case'] == 0) & (fcff < 0)) & np.isfinite(values['vps']) # Same failures as value_company
+    return({'vps': np.where(valid, values['vps'], np.nan), 'wacc': coc['wacc'], 'cost_of_equity': coc['cost_of_equity'],
+            'roic': roic, 'rir': rir, 'case': values['case'], 'num_extord_years': values['num_extord_years']})
+
+
+# sensitivity --------------------------------------------------------------------------------------------------------------------
+#   Values every company with each input bumped down and up by the given amounts
+#
+# Inputs:
+#   inputs_df: One row per company, see dcf_engine.inputs_table
+#   bumps: dict input -> absolute amount by which it is moved down and up. Defaults to DEFAULT_BUMPS
+#   ssbeta, gslope: Fade model scenario to use
+#
+# Outputs:
+#   A dict with
+#     'base': pandas series (symbol -> value per share with the inputs unchanged)
+#     'inputs': dataframe (symbol x input) of the unchanged input values
+#     'down', 'up': dataframes (symbol x input) of value per share with one input moved down/up
+#     'elasticity': dataframe (symbol x input) of % change in value per share per % change in the input (central difference)
+#   Scenarios that value_company would have failed on (reinvestment rate > 100%, negative FCFF of a slow growing company,
+#   infinite values) are NaN
+# --------------------------------------------------------------------------------------------------------------------------------
+def sensitivity(inputs_df, bumps=None, ssbeta=1, gslope=5):
+    bumps = DEFAULT_BUMPS if bumps is None else bumps
+    for name in bumps:
+        if name not in DEFAULT_BUMPS:
+            raise ValueError('Invalid input ' + name + '. Valid inputs are <' + '>, <'.join(DEFAULT_BUMPS) + '>')
+    names = list(bumps)
+    num_scenarios = 1 + 2*len(names)  # Scenario 0 is the base case, then down and up for every input
+
+    column = lambda name: inputs_df[name].to_numpy(dtype=np.float64)[:, None]
+    base = {'rfr': column('rfr'), 'erp': column('erp'), 'tax': column('tax'),
+            'steady_state_roic': column('steady_state_roic'),
+            'extord_intercept': np.full((inputs_df.shape[0], 1), EXTORD_INTERCEPT, dtype=np.float64)}
+
+    # (companies x scenarios) arrays of the bumpable inputs
+    scenario = dict([(name, np.repeat(values, num_scenarios, axis=1)) for name, values in base.items()])
+    for i, name in enumerate(names):
+        scenario[name][:, 1 + 2*i] = scenario[name][:, 1 + 2*i] - bumps[name]
+        scenario[name][:, 2 + 2*i] = scenario[name][:, 2 + 2*i] + bumps[name]
+
+    values = scenario_values(dict([(name, column(name)) for name in ENGINE_INPUTS]), scenario['rfr'], scenario['erp'],
+                             scenario['tax'], scenario['steady_state_roic'], scenario['extord_intercept'], ssbeta, gslope)
+    vps = values['vps']
+
+    base_values = np.hstack([base[name] for name in names])
+    down = vps[:, 1::2]
+    up = vps[:, 2::2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        elasticity = ((up - down)/vps[:, [0]])/((2*np.array([bumps[name] for name in names]))/base_values)
+
+    frame = lambda values: pd.DataFrame(values, index=inputs_df.index, columns=names)
+    return({'base': pd.Series(vps[:, 0], index=inputs_df.index, name='vps'), 'inputs': frame(base_values),
+            'down': frame(down), 'up': frame(up), 'elasticity': frame(elasticity)})
+
+
+# tornado ------------------------------------------------------------------------------------------------------------------------
+#   Tornado table of one valuation
+#
+# Inputs:
+#   result: A successful value_company result
+#   bumps, ssbeta, gslope: See sensitivity
+#
+# Outputs:
+#   A pandas dataframe indexed by input with columns 'base input', 'low input', 'high input', 'vps at low', 'vps at high',
+#   'swing' (absolute difference of the two values per share) and 'elasticity', sorted by swing, largest first. The value per
+#   share of the base case is in the 'base vps' attribute of the dataframe
+# --------------------------------------------------------------------------------------------------------------------------------
+def tornado(result, bumps=None, ssbeta=1, gslope=5):
+    bumps = DEFAULT_BUMPS if bumps is None else bumps
+    symbol = result['Symbol']
+    sens = sensitivity(inputs_table([result]), bumps, ssbeta, gslope)
+
+    tornado_df = pd.DataFrame({'base input': sens['inputs'].loc[symbol]})
+    tornado_df['low input'] = tornado_df['base input'] - pd.Series(bumps)
+    tornado_df['high input'] = tornado_df['base input'] + pd.Series(bumps)
+    tornado_df['vps at low'] = sens['down'].loc[symbol]
+    tornado_df['vps at high'] = sens['up'].loc[symbol]
+    tornado_df['swing'] = (tornado_df['vps at high'] - tornado_df['vps at low']).abs()
+    tornado_df['elasticity'] = sens['elasticity'].loc[symbol]
+    tornado_df = tornado_df.sort_values('swing', ascending=False)
+    tornado_df.attrs['base vps'] = sens['base'].loc[symbol]
+    return(tornado_df)
@@ -0,0 +1,122 @@
+# stress_test.py -----------------------------------------------------------------------------------------------------------------
+#   Macro stress test of the whole valuation universe. A set of macro scenarios (rfr, erp, tax, steady state ROIC) is applied to
+# every company that has already been valued, with the same math as value_company (see sensitivity.scenario_values), and the
+# outcome is stored as one compact float32 cube of shape (scenarios x companies x metrics).
+#
+#   Only the inputs stored in the value_company results (or an inputs table built from them) are used, so a run makes no network
+# calls and reads nothing but the rating table. Scenarios are split into chunks that are valued in parallel on all the cores, each
+# chunk with one vectorized fade_value call on a (scenarios in chunk x companies) array
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+import itertools
+import multiprocessing
+from datetime import date
+
+from dcf_engine import inputs_table, ENGINE_INPUTS
+from sensitivity import scenario_values, EXTORD_INTERCEPT
+from reference_data import get_reference_data
+
+# Parameters
+valuations_folder = '/home/dinesh/Documents/Valuations/usa'
+SCENARIO_COLUMNS = ['rfr', 'erp', 'tax', 'steady_state_roic']
+METRICS = ['vps', 'upside', 'wacc', 'cost_of_equity', 'roic', 'rir', 'growth', 'case', 'num_extord_years']
+MAX_CHUNK_CELLS = 200000 # Max (scenarios x companies) cells valued by one fade_value call. Keeps the year by year arrays small
+
+_worker_inputs = {} # Company inputs of a worker process, set once by _init_worker instead of being sent with every chunk
+
+
+# scenario_grid ------------------------------------------------------------------------------------------------------------------
+#   Returns every combination of the given rfr, erp, tax (percentages) and steady state ROIC (fraction) values as a dataframe with
+#   one scenario per row
+# --------------------------------------------------------------------------------------------------------------------------------
+def scenario_grid(rfrs, erps, taxes, steady_state_roics):
+    return(pd.DataFrame(list(itertools.product(rfrs, erps, taxes, steady_state_roics)), columns=SCENARIO_COLUMNS, dtype=np.float64))
+
+
+def _init_worker(inputs, rating_table, ssbeta, gslope):
+    _worker_inputs.update({'inputs': inputs, 'rating_table': rating_table, 'ssbeta': ssbeta, 'gslope': gslope})
+
+
+# Values a chunk of scenarios (rows of a 2-D array laid out like SCENARIO_COLUMNS) and returns its (scenarios x companies x metrics)
+# block of the cube
+def _stress_chunk(scenarios):
+    inputs = _worker_inputs['inputs']
+    scenario = lambda j: scenarios[:, j][:, None]
+    values = scenario_values(inputs, scenario(0), scenario(1), scenario(2), scenario(3), EXTORD_INTERCEPT,
+                             _worker_inputs['ssbeta'], _worker_inputs['gslope'], _worker_inputs['rating_table'])
+    values['upside'] = values['vps']/inputs['price'] - 1
+    values['growth'] = values['roic']*values['rir']
+    shape = values['vps'].shape
+    return(np.stack([np.broadcast_to(values[metric], shape) for metric in METRICS], axis=-1).astype(np.float32))
+
+
+# stress_test --------------------------------------------------------------------------------------------------------------------
+#   Values every company under every scenario
+#
+# Inputs:
+#   results: Iterable of value_company results (failed ones are skipped), or a dataframe as returned by dcf_engine.inputs_table
+#   scenarios: Dataframe with SCENARIO_COLUMNS (see scenario_grid)
+#   ssbeta, gslope: Fade model scenario
+#   processes: Number of worker processes. Defaults to the number of cores. 1 runs everything in this process
+#   filename: Optional. If given, the cube is saved there (see save_cube)
+#
+# Outputs:
+#   A dict with 'cube' (float32 array of shape (scenarios, companies, METRICS), NaN values per share where value_company would
+#   fail), 'symbols', 'scenarios' and 'metrics'
+# --------------------------------------------------------------------------------------------------------------------------------
+def stress_test(results, scenarios, ssbeta=1, gslope=5, processes=None, filename=None):
+    inputs_df = results if isinstance(results, pd.DataFrame) else inputs_table(results)
+    inputs = dict([(name, inputs_df[name].to_numpy(dtype=np.float64)[None, :]) for name in ENGINE_INPUTS])
+    rating_table = get_reference_data()['rating_table']
+    scenario_array = scenarios[SCENARIO_COLUMNS].to_numpy(dtype=np.float64)
+
+    processes = os.cpu_count() if processes is None else processes
+    chunk_size = max(1, min(MAX_CHUNK_CELLS//max(inputs_df.shape[0], 1),
+                            int(np.ceil(scenario_array.shape[0]/processes)))) # At least one chunk per process if possible
+    chunks = [scenario_array[start:start+chunk_size] for start in range(0, scenario_array.shape[0], chunk_size)]
+
+    if processes == 1 or len(chunks) == 1:
+        _init_worker(inputs, rating_table, ssbeta, gslope)
+        blocks = [_stress_chunk(chunk) for chunk in chunks]
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(inputs, rating_table, ssbeta, gslope)) as pool:
+            blocks = pool.map(_stress_chunk, chunks)
+
+    cube_response = {'cube': np.concatenate(blocks, axis=0), 'symbols': inputs_df.index.to_numpy(dtype=str),
+                     'scenarios': scenarios[SCENARIO_COLUMNS].reset_index(drop=True), 'metrics': list(METRICS)}
+    if filename is not None:
+        save_cube(cube_response, filename)
+    return(cube_response)
+
+
+# save_cube ----------------------------------------------------------------------------------------------------------------------
+#   Saves a stress_test result as a compressed .npz file. filename defaults to <valuations_folder>/stress_<today>.npz
+# --------------------------------------------------------------------------------------------------------------------------------
+def save_cube(cube_response, filename=None):
+    if filename is None:
+        filename = valuations_folder + '/stress_' + date.today().strftime('%Y%m%d') + '.npz'
+    np.savez_compressed(filename, cube=cube_response['cube'], symbols=cube_response['symbols'],
+                        scenarios=cube_response['scenarios'].to_numpy(dtype=np.float64),
+                        metrics=np.asarray(cube_response['metrics']))
+    return(filename)
+
+
+# load_cube ----------------------------------------------------------------------------------------------------------------------
+#   Loads a cube saved by save_cube. Returns a dict laid out like the stress_test result
+# --------------------------------------------------------------------------------------------------------------------------------
+def load_cube(filename):
+    with np.load(filename) as npz:
+        return({'cube': npz['cube'], 'symbols': npz['symbols'], 'metrics': [str(metric) for metric in npz['metrics']],
+                'scenarios': pd.DataFrame(npz['scenarios'], columns=SCENARIO_COLUMNS)})
+
+
+# cube_frame ---------------------------------------------------------------------------------------------------------------------
+#   Returns one metric of a cube as a (scenario x symbol) dataframe, with the scenario values as a multiindex
+# --------------------------------------------------------------------------------------------------------------------------------
+def cube_frame(cube_response, metric='vps'):
+    index = pd.MultiIndex.from_frame(cube_response['scenarios'])
+    return(pd.DataFrame(cube_response['cube'][:, :, cube_response['metrics'].index(metric)], index=index,
+                        columns=cube_response['symbols']))
@@ -1,137 +1,401 @@
 # valuation_crawler.py ---------------------------------------------------------------------------------------------
 #   Crawls through list of U.S. public companies to carry out fundamental valuation and store the results for later
 # sorting and selection of companies for manual re-valuation
+#
+#   The crawl is a pipeline, so that the network isn't idle while companies are being valued and the cores aren't idle
+# while statements are being downloaded:
+#   1. Fetch stage (a thread): leases companies from the work queue (see work_queue), downloads their statements, and
+#      their OVERVIEW when the local market snapshot can't stand in for it. Companies whose statements haven't changed
+#      since their last valuation go no further, and neither do companies whose last failure (see failure_cache) is still
+#      live; expired failures are valued again. All the requests go through the Alpha Vantage rate limiter of
+#      download_statements, so this stage runs as fast as the API quota allows. Fetched companies wait in a bounded queue
+#      (QUEUE_SIZE), which holds the fetch stage back when the compute stage can't keep up
+#   2. Compute stage (a pool of worker processes): reads the statements, computes the fundamentals and values the
+#      company. Workers make no API requests. When cyclicals are skipped, the main process first scores every batch of
+#      fetched companies at once (see screen_cyclicals) and hands the fundamentals of the others to the workers
+#   3. Writer stage (the main process): the only one that writes anything. It commits winners and losers to the results
+#      store (see results_store) in batches along with the states of the work queue and the failure cache, and collects the
+#      detailed reports. At the end of the run, it refreshes the industry aggregates and exports the winners and losers
+#      views to winners.xlsx and losers.xlsx
+#
+#   Ctrl-C cancels the crawl cleanly: no more companies are fetched or handed to the workers, the companies being valued
+# are finished, everything received so far is committed and the companies that were leased but not valued go back to the
+# queue. If the process dies instead, their leases expire and a later crawl picks them up
 # ------------------------------------------------------------------------------------------------------------------
 import numpy as np
 import pandas as pd
-from dcf_valuation import get_statements, get_fundamentals, value_company
-from random import randint
-from openpyxl import load_workbook
+from dcf_valuation import get_statements, get_fundamentals, get_fundamentals_batch, value_company
+from download_statements import av_get, AV_KEY
+from valuation_report import write_valuation_workbook
+from monte_carlo import monte_carlo_value
+from industry_aggregates import refresh_industry_aggregates, industry_target
+from profiling import stage, count, reset_profile, save_profile, take_profile, merge_profile
+from market_rates import update_market_rates
+from market_snapshot import build_market_snapshot, market_data, cached_overview, store_overview
+from cyclicality import cyclicality
+from work_queue import seed_queue, requeue_due, lease, complete, release, statements_info
+from failure_cache import record_failures, clear_failures, failure_table, cached_failure
+from results_store import start_run, insert_results, export_results
 import os
+import signal
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import date
 import time
+import argparse
 
-# Use exchange names to shortlist companies 
+# Parameters
+indname_file = '/home/dinesh/Documents/Valuations/adamodaran/indname.xlsx'
+EXCLUDED_INDUSTRIES = ['Investments & Asset Management', 'Brokerage & Investment Banking', 'R.E.I.T.', 'Bank (Money Center)']
+QUEUE_SIZE = 8          # Fetched companies waiting for a worker
+LEASE_BATCH = 8         # Companies leased from the work queue at a time
+TASKS_PER_WORKER = 2    # Companies handed to the pool per worker at a time. The rest wait in the queue
+RESULTS_PER_COMMIT = 10  # Results are committed to the results store in batches of this size to prevent unexpected data loss
+
+
+# Response of a company that failed before value_company was called
+def _failure(symbol, reason):
+    response = dict.fromkeys(['Share price', 'Analyst target', 'PE'], np.nan)
+    response.update({'result': 'failure', 'Company name': symbol, 'Debt rating': '', 'reason for failure': reason})
+    return(response)
+
+
+# Requests the OVERVIEW of a symbol and caches it. If the Alpha Vantage limit is reached, waits 60 seconds and tries one more time
+def _fetch_overview(symbol):
+    query_params = { "function": 'OVERVIEW', "symbol": symbol, "apikey": AV_KEY}
+    for attempt in range(2):
+        with stage('overview'):
+            try:
+                overview = av_get(query_params)
+            except Exception as e:
+                return({})
+        if not ('Note' in overview or 'Information' in overview):
+            break
+        time.sleep(60)
+    if overview and not ('Note' in overview or 'Information' in overview):
+        store_overview(symbol, overview)
+    return(overview)
+
+
+# Leases up to num_stocks companies from the work queue, LEASE_BATCH at a time, and yields them. Leased symbols are added
+# to leased. Nothing more is leased once stop is set
+def _leased(num_stocks, industry_name, leased, stop):
+    remaining = num_stocks
+    while remaining > 0 and not stop.is_set():
+        items = lease(min(LEASE_BATCH, remaining), industry=industry_name, exclude=EXCLUDED_INDUSTRIES)
+        if len(items) == 0:
+            break
+        leased.update([item['symbol'] for item in items])
+        remaining = remaining - len(items)
+        for item in items:
+            yield(item)
+
+
+# fetch_stage ------------------------------------------------------------------------------------------------------
+#   Fetches the statements (and OVERVIEW where needed) of every company of selected (dicts with 'symbol', 'industry'
+#   and 'statements', see work_queue.lease) and puts a task dict per company on the fetched queue, followed by None.
+#   Tasks of companies whose statements have the same signature as at their last valuation are marked 'unchanged',
+#   unless the valuation failed and that failure has expired (see failure_cache). Stops early once stop is set
+# ------------------------------------------------------------------------------------------------------------------
+def fetch_stage(selected, fetched, stop):
+    for item in selected:
+        if stop.is_set():
+            break
+        symbol = item['symbol']
+        print('Fetching ', symbol)
+        with stage('fetch'):
+            get_statements(symbol)
+            signature, latest_statement = statements_info(symbol)
+            unchanged = signature is not None and signature == item['statements']
+            if unchanged and item['last result'] == 'failed': # Valued again once the failure expires (Ex. new rates or betas)
+                failure = cached_failure(symbol)
+                unchanged = failure is not None and not failure['expired']
+            overview = None
+            if not unchanged and (market_data(symbol) is None or cached_overview(symbol) is None):
+                overview = _fetch_overview(symbol)
+        task = {'symbol': symbol, 'industry': item['industry'], 'overview': overview, 'unchanged': unchanged, 'fundamentals': None,
+                'last result': item['last result'], 'statements': signature, 'latest statement': latest_statement}
+        while not stop.is_set():
+            try:
+                fetched.put(task, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+    while True: # The end of the fetch stage is always signalled, even when stopped
+        try:
+            fetched.put(None, timeout=0.5)
+            break
+        except queue.Full:
+            if stop.is_set():
+                break
+
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C is handled by the main process, which lets workers finish their company
+    reset_profile() # Totals inherited from the main process would be counted twice
+
+
+# value_symbol -----------------------------------------------------------------------------------------------------
+#   Compute stage of one company. Runs in a worker process
+#
+# Inputs:
+#   task: Dict with 'symbol', 'industry', 'overview', 'fundamentals' (see fetch_stage and screen_cyclicals),
+#         'steady_state_roic' and 'monte_carlo'
+#
+# Outputs:
+#   A dict with 'symbol', 'industry', 'fundamentals' (None if they couldn't be computed), 'response' (value_company
+#   response or a failure response) and 'profile' (see profiling.take_profile)
+# ------------------------------------------------------------------------------------------------------------------
+def value_symbol(task):
+    symbol, industry = task['symbol'], task['industry']
+    result = {'symbol': symbol, 'industry': industry, 'fundamentals': None, 'statements': task['statements'],
+              'latest statement': task['latest statement']}
+
+    fundamentals = task['fundamentals']
+    if fundamentals is None:
+        fresponse = get_fundamentals(symbol)
+        if fresponse['result'] == 'failure':
+            result['response'] = _failure(symbol, fresponse['reason for failure'])
+            result['profile'] = take_profile()
+            return(result)
+        fundamentals = fresponse['fundamentals']
+    result['fundamentals'] = fundamentals
+
+    response = value_company(symbol, industry, fundamentals, report=None, verbose=False,
+                             steady_state_roic=task['steady_state_roic'], overview=task['overview'])
+    if response['result'] == 'success' and task['monte_carlo']:
+        response['monte_carlo'] = monte_carlo_value(response)
+    result['response'] = response
+    result['profile'] = take_profile()
+    return(result)
+
+
+# Result of a finished compute stage future. An unexpected error in a worker fails only its company
+def _collect(future, task):
+    try:
+        return(future.result())
+    except Exception as e:
+        return({'symbol': task['symbol'], 'industry': task['industry'], 'fundamentals': None, 'profile': {},
+                'statements': task['statements'], 'latest statement': task['latest statement'],
+                'response': _failure(task['symbol'], 'Unexpected error while valuing: ' + repr(e))})
+
+
+# screen_cyclicals -------------------------------------------------------------------------------------------------
+#   Writer stage side of the cyclicality check. Computes the fundamentals of a batch of fetched companies with one
+#   get_fundamentals_batch call and scores them with one cyclicality call. The linear fade of the DCF overvalues
+#   cyclicals, so they are written (see write_result) as failures, for a normalized earnings valuation, along with the
+#   companies whose fundamentals couldn't be computed
+#
+# Outputs:
+#   The tasks of the other companies, with their 'fundamentals'
+# ------------------------------------------------------------------------------------------------------------------
+def screen_cyclicals(tasks, state):
+    if len(tasks) == 0:
+        return(tasks)
+    with stage('cyclicality'):
+        fresponse = get_fundamentals_batch([task['symbol'] for task in tasks])
+        panel = fresponse['fundamentals']
+        cycle_df = cyclicality(panel) if panel is not None else None
+
+    screened = []
+    for task in tasks:
+        symbol = task['symbol']
+        result = {'symbol': symbol, 'industry': task['industry'], 'fundamentals': None, 'profile': {},
+                  'statements': task['statements'], 'latest statement': task['latest statement']}
+        if symbol in fresponse['failures']:
+            result['response'] = _failure(symbol, fresponse['failures'][symbol])
+            write_result(result, state)
+            continue
+        fundamentals = panel.loc[symbol].reset_index(drop=True) # As get_fundamentals returns them
+        cycle = cycle_df.loc[symbol]
+        if cycle['cyclical']:
+            result['fundamentals'] = fundamentals
+            result['response'] = _failure(symbol, 'Cyclical company (' + str(cycle['cycle period']) + ' year cycle, strength ' +
+                                                  str(round(cycle['cycle strength'], 2)) + '). Value it with normalized earnings')
+            write_result(result, state)
+            continue
+        task['fundamentals'] = fundamentals
+        screened.append(task)
+    return(screened)
+
+
+# write_result -----------------------------------------------------------------------------------------------------
+#   Writer stage of one company. Adds the result of value_symbol to the results of the run (state) and, once there are
+#   enough of them or final is True, commits them to the results store and the work queue. Fundamentals are kept in state
+#   for the refresh of the industry aggregates at the end of the run
+# ------------------------------------------------------------------------------------------------------------------
+def write_result(result, state, final=False):
+    if result is not None:
+        merge_profile(result['profile'])
+        symbol, industry, response = result['symbol'], result['industry'], result['response']
+        if state['industry_roic'] and result['fundamentals'] is not None:
+            state['fundamentals'][symbol], state['industries'][symbol] = result['fundamentals'], industry
+
+        row = dict([(column, response[column]) for column in ['Company name', 'Share price', 'Analyst target', 'PE', 'Debt rating']])
+        row.update({'symbol': symbol, 'industry': industry, 'result': response['result']})
+        if response['result'] == 'failure':
+            row['reason for failure'] = response['reason for failure']
+            state['failures'].append({'symbol': symbol, 'reason for failure': response['reason for failure'],
+                                      'statements': result['statements'], 'latest statement': result['latest statement']})
+            print('Failed to process ', symbol, ' because;')
+            print(response['reason for failure'])
+        else:
+            vps = response['value_df'].to_numpy() # Same figures as valuation_report.valuation_row
+            row.update({'Min VPS': np.nanmin(vps), 'Avg VPS': np.nanmean(vps), 'Max VPS': np.nanmax(vps)})
+            state['valuations'].append(response)
+            state['successes'].append(symbol)
+            print('Successfully processed ', symbol)
+        state['results'].append(row)
+        state['completed'].append({'symbol': symbol, 'state': 'done' if response['result'] == 'success' else 'failed',
+                                   'statements': result['statements'], 'latest statement': result['latest statement']})
+
+    if len(state['completed']) >= RESULTS_PER_COMMIT or (final and len(state['completed']) > 0):
+        with stage('results store'):
+            insert_results(state['results'], state['run_id'])
+            record_failures(state['failures'])
+            clear_failures(state['successes'])
+            complete(state['completed'])
+        state['leased'].difference_update([row['symbol'] for row in state['completed']])
+        state['results'], state['completed'], state['failures'], state['successes'] = [], [], [], []
+
+
+# Use exchange names to shortlist companies
 # Throw away all the companies that are financial
-def valuation_crawler(industry_name = None): 
-    indname_df = pd.read_excel('/home/dinesh/Documents/Valuations/adamodaran/indname.xlsx').fillna('') # Extract stocks, industry list
+# Companies are picked from the work queue (see work_queue), which is seeded with the companies of indname, so no company is
+# valued twice before all the others are and a run resumes where the last one stopped. Companies whose last failure is still
+# live in the failure cache (not expired and same statements) are left out
+# If monte_carlo is True, value per share quantiles from monte_carlo_value are added to the detailed valuation reports
+# If industry_roic is True, the median ROIC of the industry (where known) is used as the steady state ROIC instead of 10%. The
+# medians are read once when the run starts, so every company of a run gets the same target whatever the number of workers,
+# and the industry aggregates are refreshed with the statements of every company processed only once the run is over
+# If skip_cyclicals is True, companies whose revenue and operating income go through cycles (see cyclicality) are not valued
+# with the DCF but listed among the losers (and stay in the failure cache, see failure_cache.FAILURE_CODES)
+# workers is the number of compute processes (defaults to the number of cores). With 1, companies are valued in this process
+# If export_xlsx is True, winners.xlsx and losers.xlsx are rewritten from the results store at the end of the run
+# Time spent in every stage of the run (see profiling) is written to a profile_<date>_<time>.csv file next to the results
+def valuation_crawler(industry_name = None, monte_carlo = False, industry_roic = False, skip_cyclicals = False, num_stocks = 10,
+                      workers = None, export_xlsx = True):
+    reset_profile()
+    run_start = time.perf_counter()
+
+    rates_response = update_market_rates() # Incremental. Valuations use the stored rates even if this fails (Ex. offline)
+    if rates_response['result'] == 'failure':
+        print(rates_response['reason for failure'])
+    indname_df = pd.read_excel(indname_file).fillna('') # Extract stocks, industry list
     us_stocks = indname_df[indname_df['Exchange:Ticker'].str.contains("Nasdaq|NYSE")] # Extract a sublist containing stocks listed in US exchanges
-    us_stocks.reset_index(inplace=True) # Reset the index to start from 0 and increment sequentially (so they can be selected using a random number generator
-   
-    if industry_name == None: 
+    us_stocks.reset_index(inplace=True)
+    with stage('work queue'):
+        seed_queue(pd.DataFrame({'symbol': us_stocks['Exchange:Ticker'].str.split(':').str[1], 'industry': us_stocks['Industry Group']}))
+        failures_df = failure_table()
+        changed = np.array([statements_info(symbol)[0] != signature for symbol, signature in failures_df['statements'].items()], 
+                           dtype=bool) # New statements were downloaded since the failure (Ex. by download_statements)
+        live = ~failures_df['expired'].to_numpy() & ~changed
+        requeue_due(skip=list(failures_df.index[live]), force=list(failures_df.index[~live]))
+
+    if industry_name == None:
         sel_stocks = us_stocks
     else:
         try:
             sel_stocks = us_stocks[us_stocks['Industry Group'] == industry_name]
         except:
-            print("Invalid indistry name") 
-    
-    sel_stocks.reset_index(inplace=True) # Reset the index to start from 0 and increment sequentially (so they can be selected using a random number generator
-    
-    # Create two dataframes, one for companies that get successfully evaluated and one for companies which failed during valuation for whatever reason
-    winners_df = pd.DataFrame(columns=['Company name', 'Symbol', 'Industry', 'Date', 'Share price', 'Analyst target', 'PE', 'Debt rating', 'Min VPS', 'Avg VPS', 'Max VPS'])
-    losers_df = pd.DataFrame(columns=['Company name', 'Symbol', 'Industry', 'Date', 'Share price', 'Analyst target', 'PE', 'Debt rating', 'reason for failure'])
-    winners_filename = '/home/dinesh/Documents/Valuations/usa/winners.xlsx'
-    losers_filename = '/home/dinesh/Documents/Valuations/usa/losers.xlsx'
-    
-    win_idx = 0
-    lose_idx = 0
-    num_stocks = 10
-    for i in range(0,num_stocks): # Process 100 random stocks per run of this code
-        random_index = randint(0, sel_stocks.shape[0]-1)
-        
-        symbol = sel_stocks.loc[random_index,'Exchange:Ticker'].split(':')[1]
-        industry = sel_stocks.loc[random_index,'Industry Group']
-    
-        if industry in ['Investments & Asset Management', 'Brokerage & Investment Banking', 'R.E.I.T.', 'Bank (Money Center)']:
-            continue # We don't want to value these companies. They don't fit into traditional valuation methods
-    
-        print('Processing ', symbol)    
-        
-        sresponse = get_statements(symbol)
-        fresponse = get_fundamentals(symbol)
-        if fresponse['result'] == 'failure':
-            losers_df.loc[lose_idx, 'Company name'] = symbol # Workaround to the problem that we don't have the company name at this stage 
-            losers_df.loc[lose_idx, 'Symbol'] = symbol 
-            losers_df.loc[lose_idx, 'Industry'] = industry
-            losers_df.loc[lose_idx, 'Date'] = date.today()
-            losers_df.loc[lose_idx, 'Share price'] = np.nan
-            losers_df.loc[lose_idx, 'Analyst target'] = np.nan
-            losers_df.loc[lose_idx, 'PE'] = np.nan
-            losers_df.loc[lose_idx, 'Debt rating'] = ''
-            losers_df.loc[lose_idx, 'reason for failure'] = fresponse['reason for failure']
-            lose_idx = lose_idx + 1
-            print('Failed to process ', symbol, ' because;')        
-            print(fresponse['reason for failure']) 
-    
-            if lose_idx > 3 or i == (num_stocks-1): # Once we have assembled 10 losers, commit the df to the excel file to prevent unexpected data loss
-                print('Committing losers to file')
-                if os.path.exists(losers_filename):
-                    writer = pd.ExcelWriter(losers_filename, mode='a', if_sheet_exists='overlay', engine = 'openpyxl')
-                    losers_df.to_excel(writer, 'Summary', index=False, header=False, startrow = writer.book['Summary'].max_row)
-                else:
-                    writer = pd.ExcelWriter(losers_filename, engine = 'openpyxl')
-                    losers_df.to_excel(writer, 'Summary', index=False, header=True)
-                writer.close()
-                lose_idx = 0
-            continue 
-        
-        response = value_company(symbol, industry, fresponse['fundamentals'])
-        if response['result'] == 'failure' and 'Alpha Vantage' in response['reason for failure']:
-            time.sleep(60) # Wait 60 seconds and try one more time
-            response = value_company(symbol, industry, fresponse['fundamentals'])
-             
-        if response['result'] == 'failure':
-            losers_df.loc[lose_idx, 'Company name'] = response['Company name']
-            losers_df.loc[lose_idx, 'Symbol'] = symbol 
-            losers_df.loc[lose_idx, 'Industry'] = industry
-            losers_df.loc[lose_idx, 'Date'] = date.today()
-            losers_df.loc[lose_idx, 'Share price'] = response['Share price']
-            losers_df.loc[lose_idx, 'Analyst target'] = response['Analyst target']
-            losers_df.loc[lose_idx, 'PE'] = response['PE']
-            losers_df.loc[lose_idx, 'Debt rating'] = response['Debt rating']
-            losers_df.loc[lose_idx, 'reason for failure'] = response['reason for failure']
-            lose_idx = lose_idx + 1
-            print('Failed to process ', symbol, ' because;')        
-            print(response['reason for failure']) 
-            if lose_idx > 3 or i == (num_stocks-1): # Once we have assembled 10 losers, commit the df to the excel file to prevent unexpected data loss
-                print('Committing losers to file')
-                if os.path.exists(losers_filename):
-                    writer = pd.ExcelWriter(losers_filename, mode='a', if_sheet_exists='overlay', engine = 'openpyxl')
-                    losers_df.to_excel(writer, 'Summary', index=False, header=False, startrow = writer.book['Summary'].max_row)
-                else:
-                    writer = pd.ExcelWriter(losers_filename, engine = 'openpyxl')
-                    losers_df.to_excel(writer, 'Summary', index=False, header=True)
-                writer.close()
-                lose_idx = 0
-        
-        elif response['result'] == 'success':
-            winners_df.loc[win_idx, 'Company name'] = response['Company name']
-            winners_df.loc[win_idx, 'Symbol'] = symbol 
-            winners_df.loc[win_idx, 'Industry'] = industry
-            winners_df.loc[win_idx, 'Date'] = date.today()
-            winners_df.loc[win_idx, 'Share price'] = response['Share price']
-            winners_df.loc[win_idx, 'Analyst target'] = response['Analyst target']
-            winners_df.loc[win_idx, 'PE'] = response['PE']
-            winners_df.loc[win_idx, 'Debt rating'] = response['Debt rating']
-            winners_df.loc[win_idx, 'Min VPS'] = response['value_df'].min().min()
-            winners_df.loc[win_idx, 'Avg VPS'] = response['value_df'].min().min()
-            winners_df.loc[win_idx, 'Max VPS'] = response['value_df'].max().max()
-            win_idx = win_idx + 1
-            print('Successfully processed ', symbol)        
-            
-            
-            if win_idx > 0 or i == (num_stocks-1): # Once we have assembled 10 winners, commit the df to the excel file to prevent unexpected data loss
-                print('Committing winners to file')
-                if os.path.exists(winners_filename):
-                    writer = pd.ExcelWriter(winners_filename, mode='a', if_sheet_exists='overlay', engine = 'openpyxl')
-                    winners_df.to_excel(writer, 'Summary', index=False, header=False, startrow = writer.book['Summary'].max_row)
+            print("Invalid indistry name")
+
+    sel_stocks.reset_index(inplace=True)
+
+    # Share prices and market caps of the selected stocks come from the locally downloaded prices instead of OVERVIEW requests
+    with stage('market snapshot'):
+        build_market_snapshot([ticker.split(':')[1] for ticker in sel_stocks['Exchange:Ticker']])
+
+    targets = {} # Industry -> steady state ROIC target, fixed for the whole run
+    if industry_roic:
+        with stage('industry aggregates'):
+            targets = dict([(industry, industry_target(industry, 'roic')) for industry in sel_stocks['Industry Group'].unique()])
+
+    report_filename = '/home/dinesh/Documents/Valuations/usa/valuations_' + str(date.today()) + '.xlsx'
+    state = {'results': [], 'completed': [], 'failures': [], 'successes': [], 'fundamentals': {}, 'industries': {},
+             'leased': set(), 'valuations': [], 'industry_roic': industry_roic,
+             'run_id': start_run(industry_name)} # Valuations of all the winners are written to one workbook at the end
+    # We don't want to value the companies of EXCLUDED_INDUSTRIES. They don't fit into traditional valuation methods
+    stop = threading.Event()
+    selected = _leased(num_stocks, industry_name, state['leased'], stop)
+    workers = os.cpu_count() if workers is None else max(1, workers)
+    fetched = queue.Queue(maxsize=QUEUE_SIZE)
+    fetcher = threading.Thread(target=fetch_stage, args=(selected, fetched, stop), daemon=True)
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers, initializer=_init_worker)
+        executor.submit(os.getpid).result() # Starts the workers before the fetch thread. Forking while threads run is unsafe
+    pending = {} # future -> task
+    fetching = True
+    fetcher.start()
+    try:
+        while fetching or len(pending) > 0:
+            tasks = [] # Fetched companies to hand to the workers
+            while fetching and len(pending) + len(tasks) < workers*TASKS_PER_WORKER:
+                try:
+                    task = fetched.get(block=len(tasks) == 0, timeout=0.1 if len(pending) > 0 else 0.5) # Takes what's there
+                except queue.Empty:
+                    break
+                if task is None:
+                    fetching = False
+                    break
+                if task['unchanged']:
+                    print('Statements of ', task['symbol'], ' have not changed since its last valuation. Skipping')
+                    state['completed'].append({'symbol': task['symbol'], 'state': task['last result'] or 'done', 'valued': False})
+                    continue
+                tasks.append(task)
+            if skip_cyclicals:
+                tasks = screen_cyclicals(tasks, state)
+            for task in tasks:
+                target = targets.get(task['industry'])
+                task.update({'steady_state_roic': 0.1 if target is None else target, 'monte_carlo': monte_carlo})
+                if executor is None:
+                    write_result(value_symbol(task), state)
                 else:
-                    writer = pd.ExcelWriter(winners_filename, engine = 'openpyxl')
-                    winners_df.to_excel(writer, 'Summary', index=False, header=True)
-                writer.close()
-                win_idx = 0
-        
-        else:
-            print('WTF! We should not be here')
-    
+                    pending[executor.submit(value_symbol, task)] = task
+            if len(pending) > 0:
+                for future in wait(list(pending), timeout=0.1, return_when=FIRST_COMPLETED)[0]:
+                    write_result(_collect(future, pending.pop(future)), state)
+    except KeyboardInterrupt:
+        print('Cancelling the crawl. Companies being valued are finished and everything received so far is committed')
+        stop.set()
+        for future in pending:
+            future.cancel()
+        for future in wait(list(pending))[0]:
+            if not future.cancelled():
+                write_result(_collect(future, pending[future]), state)
+    finally:
+        stop.set()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        write_result(None, state, final=True)
+        fetcher.join(timeout=1)
+        release(list(state['leased'])) # Leased but not valued. Back to the queue
+        if len(state['fundamentals']) > 0: # Once, after the run, so that no valuation of the run depends on another
+            with stage('industry aggregates'):
+                refresh_industry_aggregates(pd.concat(state['fundamentals']), pd.Series(state['industries']))
+
+    if export_xlsx:
+        with stage('xlsx export'):
+            print('Exporting winners and losers to ', export_results())
+    if len(state['valuations']) > 0:
+        print('Writing detailed valuation reports to ', report_filename)
+        write_valuation_workbook(state['valuations'], report_filename)
+
+    count('valuation_crawler', 'calls')
+    count('valuation_crawler', 'seconds', time.perf_counter() - run_start)
+    print('Writing run profile to ', save_profile())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Values randomly selected U.S. companies and stores the results")
+    parser.add_argument('-i', '--industry', help="Industry group as in indname. All industries if not supplied")
+    parser.add_argument('-n', '--num_stocks', help="Number of companies to pick", type=int, default=10)
+    parser.add_argument('-w', '--workers', help="Number of compute processes. Defaults to the number of cores", type=int)
+    parser.add_argument('-m', '--monte_carlo', help="Add Monte Carlo value per share quantiles to the reports", action='store_true')
+    parser.add_argument('--industry-roic', help="Fade to the median ROIC of the industry instead of 10%%", action='store_true')
+    parser.add_argument('--skip-cyclicals', help="List cyclical companies among the losers instead of valuing them", action='store_true')
+    args = parser.parse_args()
+    valuation_crawler(args.industry, monte_carlo=args.monte_carlo, industry_roic=args.industry_roic,
+                      skip_cyclicals=args.skip_cyclicals, num_stocks=args.num_stocks, workers=args.workers)
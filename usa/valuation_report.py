@@ -0,0 +1,253 @@
+# valuation_report.py ------------------------------------------------------------------------------------------------------------
+#   Report stage of the valuation pipeline. dcf_valuation.value_company returns a result dict that holds everything needed to
+# describe a valuation and this module turns such results into reports. Each workbook is opened exactly once and is written
+# row by row with xlsxwriter in constant memory mode, so a report costs one sequential write no matter how many companies it
+# holds. For high throughput crawls, the Excel step can be skipped altogether and the results exported as Parquet or JSON.
+# ------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from dcf_engine import path_frame
+from profiling import profiled
+
+# Parameters
+valuations_folder = '/home/dinesh/Documents/Valuations/usa'
+
+
+# summary_blocks -----------------------------------------------------------------------------------------------------------------
+#   Lays out the Summary section of a valuation as a list of (heading, dataframe, write index, write header) blocks
+#
+# Inputs:
+#   result: A successful value_company result
+#
+# Outputs:
+#   A list of tuples. heading is None for blocks whose dataframe columns already act as the heading
+# --------------------------------------------------------------------------------------------------------------------------------
+def summary_blocks(result):
+    inputs = result['inputs']
+    top_df = pd.DataFrame({'value': [result['Company name'], result['Symbol'], result['Date'], result['Currency'], result['Industry']]},
+                          index = ['Company name', 'Symbol', 'Date', 'Currency', 'Industry'])
+    rates_df = pd.DataFrame([['risk-free rate', inputs['rfr']], ['equity risk premium', inputs['erp']], ['tax', inputs['tax']]],
+                            columns=['RATES','percentage'])
+    market_df = pd.DataFrame([['market cap', inputs['mv_equity']], ['stock price', inputs['price']],
+                              ['outstanding shares', inputs['outstanding_shares']], ['unlevered beta', inputs['unlevered_beta']],
+                              ['debt rating', result['Debt rating']]], columns=['MARKET FIGURES',''])
+    derived_df = derived_figures(result)
+
+    return([(None, top_df, True, False),
+            (None, rates_df, False, True),
+            (None, market_df, False, True),
+            ('FUNDAMENTALS', result['fundamentals'], False, True),
+            (None, derived_df, False, True),
+            ('VPS MATRIX', result['value_df'], True, True)])
+
+
+# derived_figures ----------------------------------------------------------------------------------------------------------------
+#   Returns the derived figures (cost of capital, return on capital, growth) of a valuation as a dataframe
+# --------------------------------------------------------------------------------------------------------------------------------
+def derived_figures(result):
+    inputs = result['inputs']
+    return(pd.DataFrame([['levered beta', inputs['levered_beta']], ['cost of equity', inputs['cost_of_equity']],
+                         ['cost of debt', inputs['cost_of_debt']], ['wacc', inputs['wacc']],
+                         ['return on capital', inputs['roic']*100], ['reinv rate', inputs['rir']*100],
+                         ['growth rate', inputs['roic']*inputs['rir']*100]],
+                        columns=['DERIVED FIGURES','percentage']))
+
+
+# detail_blocks ------------------------------------------------------------------------------------------------------------------
+#   Lays out the Details section (year by year DCF figures of every ssBeta x gslope scenario) of a valuation
+# --------------------------------------------------------------------------------------------------------------------------------
+def detail_blocks(result):
+    inputs = result['inputs']
+    blocks = []
+    for index_num, ssbeta in enumerate(inputs['ssbetas']):
+        for col_num, gslope in enumerate(inputs['gslopes']):
+            pv_df = path_frame(result['grid'], (index_num, col_num, 0), inputs['base_year'])
+            blocks.append(('ssBeta = ' + str(ssbeta) + ', gslope = ' + str(gslope), pv_df, False, True))
+    return(blocks)
+
+
+# Columns of the one-row-per-company tables
+TABLE_COLUMNS = ['Company name', 'Symbol', 'Industry', 'Date', 'Share price', 'Analyst target', 'PE', 'Debt rating',
+                 'wacc', 'roic', 'rir', 'Min VPS', 'Avg VPS', 'Max VPS', 'MC P5', 'MC P50', 'MC P95', 'result', 'reason for failure']
+
+
+# Writes a value in a way xlsxwriter understands. NaN becomes an empty cell
+def _cell(value):
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return(None)
+    if isinstance(value, np.generic):
+        return(value.item())
+    if isinstance(value, pd.Timestamp):
+        return(value.to_pydatetime())
+    return(value)
+
+
+# write_blocks -------------------------------------------------------------------------------------------------------------------
+#   Writes blocks of dataframes one below the other, strictly row by row, as required by xlsxwriter's constant memory mode
+#
+# Inputs:
+#   worksheet: xlsxwriter worksheet
+#   row: Row to start from
+#   blocks: As returned by summary_blocks/detail_blocks
+#
+# Outputs:
+#   The next free row
+# --------------------------------------------------------------------------------------------------------------------------------
+def write_blocks(worksheet, row, blocks):
+    for heading, df, with_index, with_header in blocks:
+        if heading is not None:
+            worksheet.write(row, 0, heading)
+            row = row+1
+        offset = 1 if with_index else 0
+        if with_header:
+            worksheet.write_row(row, offset, [str(c) for c in df.columns])
+            row = row+1
+        for label, values in zip(df.index, df.itertuples(index=False, name=None)):
+            if with_index:
+                worksheet.write(row, 0, _cell(label))
+            worksheet.write_row(row, offset, [_cell(v) for v in values])
+            row = row+1
+        row = row+1 # Leave a blank row between blocks
+    return(row)
+
+
+def _new_workbook(filename):
+    return(xlsxwriter.Workbook(filename, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'}))
+
+
+# write_valuation_report ---------------------------------------------------------------------------------------------------------
+#   Writes the Summary and Details sheets of one valuation to <valuations_folder>/<symbol>.xlsx in a single pass
+#
+# Inputs:
+#   result: A successful value_company result
+#   filename: Optional. Defaults to <valuations_folder>/<symbol>.xlsx
+#
+# Outputs:
+#   The name of the file written
+# --------------------------------------------------------------------------------------------------------------------------------
+@profiled()
+def write_valuation_report(result, filename=None):
+    if filename is None:
+        filename = valuations_folder + '/' + result['Symbol'] + '.xlsx'
+
+    workbook = _new_workbook(filename)
+    write_blocks(workbook.add_worksheet('Summary'), 0, summary_blocks(result))
+    write_blocks(workbook.add_worksheet('Details'), 0, detail_blocks(result))
+    workbook.close()
+    return(filename)
+
+
+# write_valuation_workbook -------------------------------------------------------------------------------------------------------
+#   Writes many valuations into one workbook: a 'Summary' sheet with one row per company, and one sheet per company with its
+#   summary followed by its details. Results are consumed one at a time, so a generator keeps memory use constant
+#
+# Inputs:
+#   results: Iterable of value_company results. Failed valuations only get a row in the Summary sheet
+#   filename: Name of the workbook
+#
+# Outputs:
+#   Number of companies written
+# --------------------------------------------------------------------------------------------------------------------------------
+@profiled()
+def write_valuation_workbook(results, filename):
+    workbook = _new_workbook(filename)
+    summary_sheet = workbook.add_worksheet('Summary')
+    summary_sheet.write_row(0, 0, TABLE_COLUMNS)
+
+    count = 0
+    for result in results:
+        count = count+1
+        summary_sheet.write_row(count, 0, [_cell(v) for v in valuation_row(result).values()])
+        if result['result'] != 'success':
+            continue
+        sheet_name = result['Symbol'][:31]  # Excel doesn't allow longer sheet names
+        if workbook.get_worksheet_by_name(sheet_name) is not None:
+            sheet_name = (str(count) + '_' + result['Symbol'])[:31]
+        worksheet = workbook.add_worksheet(sheet_name)
+        row = write_blocks(worksheet, 0, summary_blocks(result))
+        worksheet.write(row+1, 0, 'DETAILS')
+        write_blocks(worksheet, row+2, detail_blocks(result))
+
+    workbook.close()
+    return(count)
+
+
+# valuation_row ------------------------------------------------------------------------------------------------------------------
+#   Flattens a value_company result (success or failure) into one row of scalar values
+# --------------------------------------------------------------------------------------------------------------------------------
+def valuation_row(result):
+    row = dict.fromkeys(TABLE_COLUMNS, np.nan)
+    for key in ['Company name', 'Symbol', 'Industry', 'Date', 'Share price', 'Analyst target', 'PE', 'Debt rating',
+                'result', 'reason for failure']:
+        if result.get(key) is not None:
+            row[key] = result[key]
+    if result['result'] == 'success':
+        row['wacc'] = result['inputs']['wacc']
+        row['roic'] = result['inputs']['roic']
+        row['rir'] = result['inputs']['rir']
+        row['Min VPS'] = np.nanmin(result['value_df'].values)
+        row['Avg VPS'] = np.nanmean(result['value_df'].values)
+        row['Max VPS'] = np.nanmax(result['value_df'].values)
+    if result.get('monte_carlo') is not None: # See monte_carlo
+        quantiles = result['monte_carlo']['quantiles']
+        for column, q in [('MC P5', 0.05), ('MC P50', 0.5), ('MC P95', 0.95)]:
+            row[column] = quantiles.get(q, np.nan)
+    return(row)
+
+
+# valuations_table ---------------------------------------------------------------------------------------------------------------
+#   One row per valuation, plus one column per cell of the VPS matrix (Ex. 'ssBeta=1|gslope=5')
+# --------------------------------------------------------------------------------------------------------------------------------
+def valuations_table(results):
+    rows = []
+    for result in results:
+        row = valuation_row(result)
+        if result['result'] == 'success':
+            for ssbeta_label, vps_row in result['value_df'].iterrows():
+                for gslope_label, vps in vps_row.items():
+                    row[ssbeta_label + '|' + gslope_label] = vps
+        rows.append(row)
+    return(pd.DataFrame(rows))
+
+
+# export_valuations --------------------------------------------------------------------------------------------------------------
+#   Skips Excel and writes the valuations table as Parquet (needs pyarrow or fastparquet) or as JSON lines
+#
+# Inputs:
+#   results: Iterable of value_company results
+#   filename: Output file name
+#   fmt: 'parquet' or 'json'
+# --------------------------------------------------------------------------------------------------------------------------------
+def export_valuations(results, filename, fmt='parquet'):
+    table = valuations_table(results)
+    table['Date'] = table['Date'].astype(str)
+    if fmt == 'parquet':
+        table.to_parquet(filename, index=False)
+    elif fmt == 'json':
+        table.to_json(filename, orient='records', lines=True, date_format='iso')
+    else:
+        raise ValueError('Invalid fmt. Valid inputs are <parquet> or <json>')
+    return(filename)
+
+
+# print_summary ------------------------------------------------------------------------------------------------------------------
+#   Prints out a summary of a valuation on the console
+# --------------------------------------------------------------------------------------------------------------------------------
+def print_summary(result):
+    print('\n')
+    print('------------------ VALUATION SUMMARY ----------------------')
+    print('\n')
+    print(result['Company name'], '\n')
+    print('Latest statement date:', result['fundamentals'].loc[0,'date'])
+    print('Industry: ', result['Industry'])
+    print('Share price: ', result['Share price'], '\n')
+    print('Analyst target: ', result['Analyst target'], '\n')
+    print('PE: ', result['PE'], '\n')
+    print('Debt rating: ', result['Debt rating'], '\n')
+    print('VPS Matrix')
+    print(result['value_df'].to_markdown())
+    print('\n Derived Figures')
+    print(derived_figures(result).to_markdown())
+    print('-----------------------------------------------------------')
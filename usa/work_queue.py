@@ -0,0 +1,253 @@
+# work_queue.py ------------------------------------------------------------------------------------------------------------------
+#   Persistent work queue of the valuation crawler, in the work_queue table of the results store (see results_store). Every
+# company of the indname universe has one row with its state:
+#   pending      waiting to be valued. Pending companies are leased in the order of a random priority drawn when they became
+#                pending, so a crawl samples the universe without replacement
+#   in-progress  leased by a crawler until lease_expires. A lease that expires (Ex. the crawler died) makes the company
+#                available again, so a crawl resumes where the last one stopped
+#   done         valued, or skipped because its statements hadn't changed
+#   failed       couldn't be valued
+# along with the dates it was last valued and last checked, the outcome of its last valuation ('done' or 'failed'), the date of
+# its latest statement and a signature of its statements.
+#
+#   Leasing is one UPDATE inside a BEGIN IMMEDIATE transaction, so several crawler processes can lease from the same queue without
+# ever getting the same company. Done and failed companies become pending again (requeue_due) only when a new statement can have
+# been published since the latest one they were valued with, and a company whose downloaded statements turn out to have the same
+# signature as last time is marked done without being valued again
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+import os
+import time
+import socket
+import sqlite3
+import hashlib
+from datetime import date, timedelta
+
+# Parameters
+queue_db = '/home/dinesh/Documents/Valuations/usa/valuations.db'
+consolidated_prices_folder = '/home/dinesh/Documents/security_prices/usa'
+LEASE_SECONDS = 3600      # A leased company that isn't completed within this time is leased again
+STATEMENT_CYCLE_DAYS = 91 # Days between quarterly statements
+REPORT_LAG_DAYS = 45      # Days between the end of a quarter and the publication of its statements
+RECHECK_DAYS = 30         # Companies whose new statement is late are checked again after this many days
+MAX_AGE_DAYS = 365        # Companies are valued again after this many days even if no new statement is expected
+STATES = ['pending', 'in-progress', 'done', 'failed']
+
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS "work_queue" (
+                 "symbol"            TEXT,
+                 "industry"          TEXT,
+                 "state"             TEXT,
+                 "priority"          REAL,
+                 "lease_owner"       TEXT,
+                 "lease_expires"     REAL,
+                 "attempts"          INTEGER DEFAULT 0,
+                 "last_valued"       TEXT,
+                 "last_result"       TEXT,
+                 "last_checked"      TEXT,
+                 "latest_statement"  TEXT,
+                 "statements"        TEXT,
+                 PRIMARY KEY("symbol")
+             )''',
+          'CREATE INDEX IF NOT EXISTS "work_queue_state" ON "work_queue"("state", "priority")']
+
+
+# Short lived connection. Every call opens its own, so the queue can be used from any thread or process. Waits for the locks of
+# other processes instead of failing
+def _connect(filename=None):
+    filename = queue_db if filename is None else filename
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    connection = sqlite3.connect(filename, timeout=60, isolation_level=None) # Transactions are begun explicitly
+    connection.execute('PRAGMA journal_mode=WAL')
+    for statement in SCHEMA:
+        connection.execute(statement)
+    return(connection)
+
+
+def lease_owner():
+    return(socket.gethostname() + ':' + str(os.getpid()))
+
+
+# statements_info ----------------------------------------------------------------------------------------------------------------
+#   Signature (SHA1 of the three locally stored quarterly statement files) and date of the latest quarterly balance sheet of a
+#   symbol. Either is None if the files can't be read
+# --------------------------------------------------------------------------------------------------------------------------------
+def statements_info(symbol):
+    digest = hashlib.sha1()
+    try:
+        for subfolder, suffix in [('balance_sheets', 'BS'), ('income_statements', 'IS'), ('cashflow_statements', 'CF')]:
+            with open(consolidated_prices_folder + '/' + subfolder + '/' + symbol + '_quarterly_' + suffix + '.csv', 'rb') as f:
+                digest.update(f.read())
+        signature = digest.hexdigest()
+    except OSError:
+        signature = None
+    try:
+        latest = pd.read_csv(consolidated_prices_folder + '/balance_sheets/' + symbol + '_quarterly_BS.csv',
+                             usecols=['fiscalDateEnding'], nrows=1)['fiscalDateEnding'].iloc[0]
+        latest = str(pd.Timestamp(latest).date())
+    except Exception as e:
+        latest = None
+    return(signature, latest)
+
+
+# seed_queue ---------------------------------------------------------------------------------------------------------------------
+#   Adds the companies of a universe that aren't in the queue yet, as pending, and updates the industry of the others
+#
+# Inputs:
+#   universe: Dataframe with 'symbol' and 'industry' columns
+#
+# Outputs:
+#   Number of companies added
+# --------------------------------------------------------------------------------------------------------------------------------
+def seed_queue(universe, filename=None):
+    universe = universe.drop_duplicates('symbol')
+    priorities = np.random.default_rng().random(universe.shape[0])
+    connection = _connect(filename)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        before = connection.execute('SELECT COUNT(*) FROM work_queue').fetchone()[0]
+        connection.executemany('''INSERT INTO work_queue (symbol, industry, state, priority) VALUES (?, ?, 'pending', ?)
+                                  ON CONFLICT(symbol) DO UPDATE SET industry = excluded.industry''',
+                               zip(universe['symbol'], universe['industry'], priorities.tolist()))
+        added = connection.execute('SELECT COUNT(*) FROM work_queue').fetchone()[0] - before
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    return(added)
+
+
+# requeue_due --------------------------------------------------------------------------------------------------------------------
+#   Makes done and failed companies pending again (with a new random priority) if a statement newer than the one they were last
+#   valued with can have been published by now (latest statement + STATEMENT_CYCLE_DAYS + REPORT_LAG_DAYS) and they haven't been
+#   checked in the last RECHECK_DAYS, or if they were last valued more than max_age_days ago
+#
+# Inputs:
+#   skip: Optional list of symbols that are not requeued whatever their dates (Ex. live failures, see failure_cache)
+#   force: Optional list of symbols that are requeued whatever their dates (Ex. expired failures)
+#
+# Outputs:
+#   Number of companies requeued
+# --------------------------------------------------------------------------------------------------------------------------------
+def requeue_due(max_age_days=MAX_AGE_DAYS, skip=(), force=(), filename=None):
+    today = date.today()
+    statement_before = str(today - timedelta(days=STATEMENT_CYCLE_DAYS + REPORT_LAG_DAYS))
+    checked_before = str(today - timedelta(days=RECHECK_DAYS))
+    valued_before = str(today - timedelta(days=max_age_days))
+    connection = _connect(filename)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute('CREATE TEMP TABLE requeue_flags (symbol TEXT PRIMARY KEY, flag INTEGER)')
+        connection.executemany('INSERT OR REPLACE INTO requeue_flags VALUES (?, ?)',
+                               [(symbol, 0) for symbol in skip] + [(symbol, 1) for symbol in force])
+        cursor = connection.execute('''UPDATE work_queue SET state = 'pending', priority = random()/18446744073709551616.0 + 0.5
+                                       WHERE state IN ('done', 'failed') AND
+                                             COALESCE((SELECT flag FROM requeue_flags WHERE requeue_flags.symbol = work_queue.symbol),
+                                                      ((latest_statement IS NULL OR latest_statement <= ?) AND
+                                                       (last_checked IS NULL OR last_checked <= ?)) OR last_valued <= ?)''',
+                                    (statement_before, checked_before, valued_before))
+        requeued = cursor.rowcount
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    return(requeued)
+
+
+# lease --------------------------------------------------------------------------------------------------------------------------
+#   Leases up to n companies: pending ones and in-progress ones whose lease has expired, lowest priority first
+#
+# Inputs:
+#   n: Number of companies
+#   owner: Lease owner. Defaults to lease_owner() (host:pid)
+#   industry: Optional. Only companies of this industry
+#   exclude: Optional list of industries whose companies are never leased
+#
+# Outputs:
+#   A list of dicts with 'symbol', 'industry', 'statements' (signature of the statements of the last valuation, or None) and
+#   'last result' ('done' or 'failed', None if never valued)
+# --------------------------------------------------------------------------------------------------------------------------------
+def lease(n, owner=None, industry=None, exclude=(), lease_seconds=LEASE_SECONDS, filename=None):
+    owner = lease_owner() if owner is None else owner
+    now = time.time()
+    conditions, params = ["(state = 'pending' OR (state = 'in-progress' AND lease_expires < ?))"], [now]
+    if industry is not None:
+        conditions.append('industry = ?')
+        params.append(industry)
+    if len(exclude) > 0:
+        conditions.append('industry NOT IN (' + ', '.join(['?']*len(exclude)) + ')')
+        params.extend(exclude)
+
+    connection = _connect(filename)
+    try:
+        connection.execute('BEGIN IMMEDIATE') # Takes the write lock, so no other process can lease the same rows in between
+        rows = connection.execute('SELECT symbol, industry, statements, last_result FROM work_queue WHERE ' + ' AND '.join(conditions) +
+                                  ' ORDER BY priority LIMIT ?', params + [int(n)]).fetchall()
+        connection.executemany('''UPDATE work_queue SET state = 'in-progress', lease_owner = ?, lease_expires = ?,
+                                                       attempts = attempts + 1 WHERE symbol = ?''',
+                               [(owner, now + lease_seconds, row[0]) for row in rows])
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    return([{'symbol': row[0], 'industry': row[1], 'statements': row[2], 'last result': row[3]} for row in rows])
+
+
+# complete -----------------------------------------------------------------------------------------------------------------------
+#   Records the outcome of a batch of leased companies in one transaction
+#
+# Inputs:
+#   rows: List of dicts with 'symbol', 'state' ('done' or 'failed'), and optionally 'statements' and 'latest statement' (see
+#         statements_info) and 'valued' (False if the company was skipped, which leaves its last valued date and last result
+#         as they were)
+# --------------------------------------------------------------------------------------------------------------------------------
+def complete(rows, filename=None):
+    if len(rows) == 0:
+        return
+    for row in rows:
+        if row['state'] not in ['done', 'failed']:
+            raise ValueError('Invalid state ' + str(row['state']) + '. It should be either <done> or <failed>')
+    today = str(date.today())
+    connection = _connect(filename)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany('''UPDATE work_queue SET state = ?, lease_owner = NULL, lease_expires = NULL, attempts = 0,
+                                         last_valued = CASE WHEN ? THEN ? ELSE last_valued END, last_checked = ?,
+                                         last_result = CASE WHEN ? THEN ? ELSE last_result END,
+                                         statements = COALESCE(?, statements),
+                                         latest_statement = COALESCE(?, latest_statement)
+                                  WHERE symbol = ?''',
+                               [(row['state'], row.get('valued', True), today, today, row.get('valued', True), row['state'],
+                                 row.get('statements'), row.get('latest statement'),
+                                 row['symbol']) for row in rows])
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+
+
+# release ------------------------------------------------------------------------------------------------------------------------
+#   Hands leased companies that won't be processed (Ex. the crawl was cancelled) back to the queue, as pending
+# --------------------------------------------------------------------------------------------------------------------------------
+def release(symbols, owner=None, filename=None):
+    if len(symbols) == 0:
+        return
+    owner = lease_owner() if owner is None else owner
+    connection = _connect(filename)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany('''UPDATE work_queue SET state = 'pending', lease_owner = NULL, lease_expires = NULL
+                                  WHERE symbol = ? AND state = 'in-progress' AND lease_owner = ?''',
+                               [(symbol, owner) for symbol in symbols])
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+
+
+# queue_status -------------------------------------------------------------------------------------------------------------------
+#   Number of companies in each state
+# --------------------------------------------------------------------------------------------------------------------------------
+def queue_status(filename=None):
+    connection = _connect(filename)
+    try:
+        counts = dict(connection.execute('SELECT state, COUNT(*) FROM work_queue GROUP BY state').fetchall())
+    finally:
+        connection.close()
+    return(pd.Series([counts.get(state, 0) for state in STATES], index=STATES))
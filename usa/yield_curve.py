@@ -0,0 +1,124 @@
+# yield_curve.py -----------------------------------------------------------------------------------------------------------------
+#   Treasury yield curve for maturity matched discounting. Curve points (one row per date, one column per maturity, laid out like
+# quandl's USTREASURY/YIELD) are stored in a local csv file, so valuations don't need a slow web request and can be done as of
+# past dates.
+#
+#   The curve of a date is interpolated with a shape preserving piecewise cubic (PCHIP) through the points of that date, and is
+# flat beyond the shortest and the longest maturity. The fitted piecewise polynomial coefficients are cached per as-of date, so
+# the curve is fitted once per run no matter how many companies are valued, and yields of any number of maturities (and
+# companies) come from one array evaluation. Yields are treated as annually compounded spot rates, which is close enough for
+# discounting yearly cashflows
+# --------------------------------------------------------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+from scipy.interpolate import PchipInterpolator
+
+import os
+
+# Parameters
+rates_folder = '/home/dinesh/Documents/Valuations/rates'
+curve_file = 'treasury_curve.csv'
+MATURITIES = {'1 MO': 1/12, '2 MO': 2/12, '3 MO': 0.25, '6 MO': 0.5, '1 YR': 1, '2 YR': 2, '3 YR': 3, '5 YR': 5, '7 YR': 7,
+              '10 YR': 10, '20 YR': 20, '30 YR': 30} # Column name -> maturity in years
+MAX_TERM_YEARS = 100 # Number of yearly maturities for which maturity matched discount rates are evaluated
+
+_curve_points = {} # In-process memo of the stored curve points ('points' -> dataframe)
+_fits = {} # In-process memo. Date of the curve points -> fitted curve
+
+
+# load_curve_points --------------------------------------------------------------------------------------------------------------
+#   Returns the stored curve points as a dataframe indexed by date (sorted ascending) with one column (%) per maturity. The file
+#   is read once per process
+# --------------------------------------------------------------------------------------------------------------------------------
+def load_curve_points():
+    if 'points' not in _curve_points:
+        filename = rates_folder + '/' + curve_file
+        if os.path.exists(filename):
+            points = pd.read_csv(filename, index_col=0, parse_dates=True)
+        else:
+            points = pd.DataFrame(columns=list(MATURITIES), index=pd.DatetimeIndex([], name='Date'), dtype=np.float64)
+        _curve_points['points'] = points[[c for c in MATURITIES if c in points.columns]].sort_index()
+    return(_curve_points['points'])
+
+
+# store_curve_points -------------------------------------------------------------------------------------------------------------
+#   Adds curve points to the local store. Rows of dates that are already stored are replaced
+#
+# Inputs:
+#   points_df: Dataframe indexed by date with maturity columns (see MATURITIES) in %, Ex. quandl.get('USTREASURY/YIELD')
+# --------------------------------------------------------------------------------------------------------------------------------
+def store_curve_points(points_df):
+    points_df = points_df[[c for c in MATURITIES if c in points_df.columns]].astype(np.float64)
+    points_df.index = pd.to_datetime(points_df.index)
+    stored = load_curve_points()
+    points = pd.concat([stored[~stored.index.isin(points_df.index)], points_df]).sort_index()
+    points.index.name = 'Date'
+
+    os.makedirs(rates_folder, exist_ok=True)
+    points.to_csv(rates_folder + '/' + curve_file)
+    _curve_points['points'] = points
+    _fits.clear()
+    return(points)
+
+
+# get_curve ----------------------------------------------------------------------------------------------------------------------
+#   Returns the fitted curve as of a date: the curve of the latest stored date on or before as_of (found with a binary search)
+#
+# Inputs:
+#   as_of: Optional date. Defaults to the latest stored date
+#
+# Outputs:
+#   A dict with 'date' (of the curve points used), 'breakpoints' (maturities in years) and 'coefficients' (4 x number of intervals
+#   array of cubic coefficients, highest power first, as in scipy's PPoly)
+# --------------------------------------------------------------------------------------------------------------------------------
+def get_curve(as_of=None):
+    points = load_curve_points()
+    if points.shape[0] == 0:
+        raise ValueError('No yield curve points stored in ' + rates_folder + '/' + curve_file)
+    if as_of is None:
+        position = points.shape[0] - 1
+    else:
+        position = np.searchsorted(points.index.to_numpy(), np.datetime64(pd.Timestamp(as_of)), side='right') - 1
+        if position < 0:
+            raise ValueError('No yield curve available as of ' + str(as_of))
+
+    curve_date = points.index[position]
+    if curve_date not in _fits:
+        row = points.iloc[position].dropna()
+        maturities = np.array([MATURITIES[c] for c in row.index])
+        order = np.argsort(maturities)
+        if order.shape[0] < 2:
+            raise ValueError('Too few yield curve points on ' + str(curve_date.date()))
+        spline = PchipInterpolator(maturities[order], row.to_numpy(dtype=np.float64)[order])
+        _fits[curve_date] = {'date': curve_date.date(), 'breakpoints': spline.x, 'coefficients': spline.c}
+    return(_fits[curve_date])
+
+
+# curve_yields -------------------------------------------------------------------------------------------------------------------
+#   Evaluates a fitted curve (see get_curve) at any array of maturities (years). Returns yields in %
+# --------------------------------------------------------------------------------------------------------------------------------
+def curve_yields(curve, maturities):
+    breakpoints, coefficients = curve['breakpoints'], curve['coefficients']
+    maturities = np.clip(np.asarray(maturities, dtype=np.float64), breakpoints[0], breakpoints[-1]) # Flat beyond the ends
+    interval = np.clip(np.searchsorted(breakpoints, maturities, side='right') - 1, 0, breakpoints.shape[0] - 2)
+    dt = maturities - breakpoints[interval]
+    return(((coefficients[0, interval]*dt + coefficients[1, interval])*dt + coefficients[2, interval])*dt + coefficients[3, interval])
+
+
+# term_wacc ----------------------------------------------------------------------------------------------------------------------
+#   Maturity matched WACC of every year 0..MAX_TERM_YEARS-1. The rfr in cost of equity and cost of debt is replaced by the yield
+#   of the matching maturity, i.e. wacc(t) = wacc + (yield(t) - rfr)*(E/V + (1-tax)*D/V). All inputs are broadcast, so many
+#   companies are handled with one evaluation
+#
+# Inputs:
+#   curve: Fitted curve, see get_curve
+#   wacc, rfr, tax: Percentages, as used for the flat WACC
+#   mv_equity, bv_debt: Used for the weights
+#
+# Outputs:
+#   Array of shape broadcast shape + (MAX_TERM_YEARS,) with the WACC (%) of every year, to be passed to dcf_engine.fade_value
+# --------------------------------------------------------------------------------------------------------------------------------
+def term_wacc(curve, wacc, rfr, tax, mv_equity, bv_debt):
+    wacc, rfr, tax, mv_equity, bv_debt = [np.asarray(x, dtype=np.float64)[..., None] for x in (wacc, rfr, tax, mv_equity, bv_debt)]
+    rfr_weight = (mv_equity + (1 - tax/100)*bv_debt)/(mv_equity + bv_debt)
+    return(wacc + (curve_yields(curve, np.arange(MAX_TERM_YEARS)) - rfr)*rfr_weight)